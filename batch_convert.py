@@ -0,0 +1,139 @@
+# Copyright (C) 2015  Thomas Wilson, email:supertwilson@Sourceforge.net
+#
+#    This module is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License Version 3 as published by
+#    the Free Software Foundation see <http://www.gnu.org/licenses/>.
+#
+#batch_convert.py
+#Converts many pictures to G-code without the GUI, one process per core.
+#Run with: python batch_convert.py PICTURE|DIRECTORY|GLOB [...] [--size WxH] [--path MODE] [--workers N] [--dither MODE] [--density PERCENT] [--tiled] [--estimate] [--output DIR] [--no-cache]
+
+
+import os
+import sys
+import glob
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from PIL import Image
+from engraver_lib import Pic_To_Gcode, Path_Optimizer, Contour_Tracer, Conversion_Cache, Job_Stats
+
+
+def find_pictures(patterns):
+    """Expands files, directories and glob patterns into a sorted list of picture files without duplicates."""
+    extensions = Image.registered_extensions()
+    found = set()
+    for pattern in patterns:
+        for path in glob.glob(pattern, recursive=True) or [pattern]:
+            if os.path.isdir(path):
+                found.update(os.path.join(path, name) for name in os.listdir(path)
+                             if os.path.splitext(name)[1].lower() in extensions and os.path.isfile(os.path.join(path, name)))
+            elif os.path.isfile(path):
+                found.add(path)
+    return sorted(found)
+
+def set_path(ptg, mode):
+    """Sets up ptg for a --path mode, 'contour' traces outlines instead of reordering the raster."""
+    if mode == 'contour':
+        ptg.contour_tracer = Contour_Tracer()
+    elif mode is not None:
+        ptg.path_optimizer = Path_Optimizer(mode)
+
+def convert_one(filename, size, mode, output_dir, pictures_dir, cache_dir=None, cache_bytes=0, dither='floyd-steinberg', density=None, tiled=False):
+    """Converts one picture in a worker process, through the cache in cache_dir if given.
+    Returns (G-code file name, seconds, path steps or None, cache hit)."""
+    started = time.perf_counter()
+    cache = None
+    if cache_dir is not None:
+        cache = Conversion_Cache(cache_dir, cache_bytes)
+    ptg = Pic_To_Gcode(cache=cache, dither=dither, density=density, tiled=tiled)
+    set_path(ptg, mode)
+    if size is None:
+        size = ptg.image_size(filename)
+    g_code_file_name = ptg.convert_file_save_in_folder(filename, size, output_dir, pictures_dir)
+    steps = None
+    if ptg.path_stats() is not None:
+        steps = ptg.path_stats().steps_before, ptg.path_stats().steps_after
+    return g_code_file_name, time.perf_counter() - started, steps, ptg.cache_hit
+
+def estimate_one(filename, size, mode, dither, density, lase_time, tiled=False):
+    """Dot count and estimated run time in ms of one picture, nothing is written."""
+    ptg = Pic_To_Gcode(dither=dither, density=density, tiled=tiled)
+    set_path(ptg, mode)
+    if size is None:
+        size = ptg.image_size(filename)
+    return ptg.dot_estimate(filename, size, 1, lase_time)
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Convert pictures to 2D laser engraver G-code in parallel.")
+    parser.add_argument("pictures", nargs='+', help="picture files, directories or glob patterns such as 'in/**/*.png'")
+    parser.add_argument("--size", help="maximum size WxH in points, aspect ratio is kept. Defaults to each picture's own size")
+    parser.add_argument("--path", choices=Path_Optimizer.modes + ('contour',), default=None,
+                        help="path optimization, default is plain raster order. contour engraves outlines only, for line art")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="conversion processes, defaults to the core count")
+    parser.add_argument("--output", default=Pic_To_Gcode.gcode_dir, help="G-code folder")
+    parser.add_argument("--pictures-output", default=Pic_To_Gcode.pictures_dir, help="folder for the black and white copies")
+    parser.add_argument("--dither", choices=Pic_To_Gcode.dither_modes, default='floyd-steinberg', help="black and white conversion")
+    parser.add_argument("--density", type=float, default=None, help="wanted share of black dots in percent, default keeps each picture's tone")
+    parser.add_argument("--tiled", action='store_true', help="read pictures in bands, for pictures too large to decode whole")
+    parser.add_argument("--estimate", action='store_true', help="only print dot counts and run times, write nothing")
+    parser.add_argument("--lase-time", type=int, default=100, help="milliseconds per dot for --estimate")
+    parser.add_argument("--cache", default="cache", help="conversion cache folder, shared with the GUI")
+    parser.add_argument("--cache-size", type=int, default=512, help="conversion cache limit in MB")
+    parser.add_argument("--no-cache", action='store_true', help="always convert from scratch")
+    args = parser.parse_args()
+    size = None
+    if args.size:
+        size = tuple(int(value) for value in args.size.lower().split('x'))
+    mode = None if args.path == 'raster' else args.path
+    filenames = find_pictures(args.pictures)
+    if not filenames:
+        print("No pictures found")
+        sys.exit(1)
+    density = args.density/100 if args.density is not None else None
+    if args.estimate:
+        total_ms = 0
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = {executor.submit(estimate_one, filename, size, mode, args.dither, density, args.lase_time, args.tiled): filename for filename in filenames}
+            for future in as_completed(futures):
+                try:
+                    dots, time_ms = future.result()
+                except Exception as error:
+                    print("FAILED %s: %s" % (futures[future], error))
+                    continue
+                total_ms += time_ms
+                print("%s: %d dots, %s" % (futures[future], dots, Job_Stats.time_string(time_ms)))
+        print("Total run time", Job_Stats.time_string(total_ms))
+        sys.exit(0)
+    os.makedirs(args.output, exist_ok=True)
+    os.makedirs(args.pictures_output, exist_ok=True)
+    cache_dir = None if args.no_cache else args.cache
+    started = time.perf_counter()
+    failures = []
+    hits = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(convert_one, filename, size, mode, args.output, args.pictures_output, cache_dir, args.cache_size*2**20, args.dither, density, args.tiled): filename for filename in filenames}
+        for done, future in enumerate(as_completed(futures), 1):
+            filename = futures[future]
+            try:
+                g_code_file_name, seconds, steps, hit = future.result()
+            except Exception as error:
+                failures.append(filename)
+                print("[%d/%d] FAILED %s: %s" % (done, len(filenames), filename, error))
+            else:
+                line = "[%d/%d] %.2f s %s -> %s" % (done, len(filenames), seconds, filename, g_code_file_name)
+                if steps is not None:
+                    line += " (steps %d -> %d)" % steps
+                if hit:
+                    hits += 1
+                    line += " cached"
+                print(line)
+            sys.stdout.flush()
+    print("Converted %d of %d pictures in %.2f s with %d workers" % (len(filenames)-len(failures), len(filenames), time.perf_counter()-started, args.workers))
+    if cache_dir is not None:
+        stats = Conversion_Cache(cache_dir, args.cache_size*2**20).stats()
+        print("Cache hits %d of %d, %d entries using %.1f MB" % (hits, len(filenames)-len(failures), stats['entries'], stats['bytes']/2**20))
+    if failures:
+        print("Failed:", *failures, sep="\n  ")
+        sys.exit(1)
@@ -0,0 +1,470 @@
+# Copyright (C) 2015  Thomas Wilson, email:supertwilson@Sourceforge.net
+#
+#    This module is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License Version 3 as published by
+#    the Free Software Foundation see <http://www.gnu.org/licenses/>.
+#
+#benchmark.py
+#Run with: python benchmark.py [name ...]
+
+
+import sys
+import time
+import random
+import numpy
+import os
+import tempfile
+import tracemalloc
+import struct
+from PIL import Image, ImageDraw
+from engraver_lib import Pic_To_Gcode, Interpreter, Job_Stats, Binary_Job, Job, Serial_Manager, Path_Optimizer
+
+
+def legacy_convert_PIL_image(im):
+    """Pixel by pixel converter kept as the reference for speed and output comparison."""
+    pixel_map = im.load()
+    script = []
+    for y in range(0, im.size[1]):
+        y_val = im.size[1] - y - 1
+        if y%2==0:
+            for x in range(0, im.size[0]):
+                if pixel_map[x, y_val] < 10:
+                    script.append([x, y])
+        else:
+            for x in range(im.size[0]-1, -1, -1):
+                if pixel_map[x, y_val] < 10:
+                    script.append([x, y])
+    min_x = im.size[0]
+    min_y = im.size[1]
+    for cords in script:
+        x, y = cords
+        if x < min_x:
+            min_x = x
+        if y < min_y:
+            min_y = y
+    for cords in script:
+        cords[0] = cords[0] - min_x
+        cords[1] = cords[1] - min_y
+    g_code = ""
+    for cords in script:
+        g_code += 'x'+str(cords[0])+" y"+str(cords[1])+'\n'
+    return g_code
+
+def legacy_condition_image(image, size):
+    """Pixel by pixel alpha flattening kept as the reference for speed comparison."""
+    image.thumbnail(size, Image.LANCZOS)
+    pixel_map = image.load()
+    for x in range(0, image.size[0]):
+        for y in range(0, image.size[1]):
+            if pixel_map[x, y][3] < 10:
+                image.putpixel((x, y), (255, 255, 255, 0))
+    return image.convert('1')
+
+def test_image(size, seed=0):
+    """Dithered noise image, roughly half the pixels black."""
+    rand = random.Random(seed)
+    im = Image.frombytes('L', (size, size), bytes(rand.getrandbits(8) for n in range(size*size)))
+    return im.convert('1')
+
+def test_logo(size):
+    """RGBA image with a transparent background around an opaque gradient square."""
+    im = Image.new('RGBA', (size, size), (0, 0, 0, 0))
+    square = Image.linear_gradient('L').resize((size, size)).convert('RGBA')
+    mask = Image.new('L', (size, size), 0)
+    mask.paste(255, (size//4, size//4, 3*size//4, 3*size//4))
+    im.paste(square, (0, 0), mask)
+    return im
+
+def test_sparse(size, shapes=60, seed=0):
+    """Sparse artwork, filled circles scattered over a white page."""
+    rand = random.Random(seed)
+    im = Image.new('L', (size, size), 255)
+    draw = ImageDraw.Draw(im)
+    for shape in range(shapes):
+        x, y, diameter = rand.randrange(size), rand.randrange(size), rand.randrange(3, max(size//15, 4))
+        draw.ellipse((x, y, x+diameter, y+diameter), fill=0)
+    return im.convert('1')
+
+def timed(function, *args):
+    """Returns (seconds, result) of a single call."""
+    start = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - start, result
+
+def bench_convert(sizes=(250, 500, 1000, 2000)):
+    """Legacy loop converter against the array converter."""
+    ptg = Pic_To_Gcode()
+    print("convert_PIL_image")
+    print("%10s %12s %12s %9s %s" % ("size", "legacy s", "array s", "speedup", "identical"))
+    for size in sizes:
+        im = test_image(size)
+        legacy_time, legacy_out = timed(legacy_convert_PIL_image, im)
+        new_time, new_out = timed(ptg.convert_PIL_image, im)
+        print("%10s %12.3f %12.3f %8.1fx %s" % ("%dx%d" % (size, size), legacy_time, new_time, legacy_time/new_time, legacy_out == new_out))
+
+def bench_condition(sizes=(250, 500, 1000, 2000)):
+    """Legacy putpixel alpha flattening against whole image channel operations."""
+    ptg = Pic_To_Gcode()
+    print("condition_image, transparent RGBA logo")
+    print("%10s %12s %12s %12s %12s" % ("size", "legacy s", "dither s", "threshold s", "dither s/MP"))
+    for size in sizes:
+        legacy_time, legacy_out = timed(legacy_condition_image, test_logo(size), (size, size))
+        new_time, new_out = timed(ptg.condition_image, test_logo(size), (size, size))
+        threshold_time, threshold_out = timed(ptg.condition_image, test_logo(size), (size, size), 128)
+        print("%10s %12.3f %12.3f %12.3f %12.3f" % ("%dx%d" % (size, size), legacy_time, new_time, threshold_time, new_time/(size*size/1e6)))
+
+def peak_memory(function, *args):
+    """Returns (seconds, peak traced bytes) of a single call."""
+    tracemalloc.start()
+    seconds, result = timed(function, *args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+def bench_stream(sizes=(500, 1000, 2000)):
+    """Whole string G-code writing against the streaming row writer."""
+    ptg = Pic_To_Gcode()
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, "G code - bench.txt")
+    def whole(im):
+        with open(filename, 'w') as g_code_file_handle:
+            g_code_file_handle.write(ptg.convert_PIL_image(im))
+    def streamed(im):
+        ptg.write_gcode(ptg.gcode_lines(im), filename)
+    print("G-code file writing, peak Python memory")
+    print("%10s %12s %12s %12s %12s" % ("size", "whole s", "whole MB", "stream s", "stream MB"))
+    for size in sizes:
+        im = test_image(size)
+        whole_time, whole_peak = peak_memory(whole, im)
+        stream_time, stream_peak = peak_memory(streamed, im)
+        print("%10s %12.3f %12.1f %12.3f %12.1f" % ("%dx%d" % (size, size), whole_time, whole_peak/1e6, stream_time, stream_peak/1e6))
+    os.remove(filename)
+    os.rmdir(directory)
+
+def legacy_open_text(filename):
+    """Line by line parse as Window.__menu_open_gcode did, once for the estimator and once for the preview."""
+    with open(filename, 'r', encoding='utf-8') as text_file:
+        script = [line for line in text_file.read().split('\n') if len(line) > 0 and line[0] != '#']
+    for decode_pass in range(2):
+        interp = Interpreter(1)
+        for line_num, line in enumerate(script):
+            interp.decode_string_line(line, line_num)
+    return script
+
+def open_text(filename):
+    """Single batch parse as Window.__menu_open_gcode does."""
+    with open(filename, 'r', encoding='utf-8') as text_file:
+        x_cords, y_cords = Interpreter(1).decode_script(text_file.read())
+    Interpreter.estimate_positions(x_cords, y_cords)
+    return x_cords, y_cords
+
+def bench_job_open(sizes=(500, 1000, 2000)):
+    """Opening and estimating a text G-code file against a memory mapped binary job."""
+    ptg = Pic_To_Gcode()
+    directory = tempfile.mkdtemp()
+    text_filename = os.path.join(directory, "G code - bench.txt")
+    job_filename = os.path.join(directory, "G code - bench.ejb")
+    print("Job open and estimate")
+    print("%10s %10s %12s %12s %12s %12s" % ("size", "points", "legacy s", "text s", "binary s", "binary B/pt"))
+    for size in sizes:
+        im = test_image(size)
+        ptg.write_gcode(ptg.gcode_lines(im), text_filename)
+        Binary_Job.write(job_filename, *ptg.raster_positions(im))
+        def open_binary():
+            job = Binary_Job(job_filename)
+            Interpreter.estimate_positions(job.x, job.y)
+            return job
+        legacy_time, script = timed(legacy_open_text, text_filename)
+        text_time, x_y = timed(open_text, text_filename)
+        binary_time, job = timed(open_binary)
+        print("%10s %10d %12.3f %12.3f %12.3f %12.1f" % ("%dx%d" % (size, size), len(job), legacy_time, text_time, binary_time, os.path.getsize(job_filename)/len(job)))
+        del job
+    os.remove(text_filename)
+    os.remove(job_filename)
+    os.rmdir(directory)
+
+def bench_job_memory(sizes=(500, 1000, 2000)):
+    """Memory held by a loaded Job against the old list of script lines and int64 x, y arrays."""
+    ptg = Pic_To_Gcode()
+    directory = tempfile.mkdtemp()
+    text_filename = os.path.join(directory, "G code - bench.txt")
+    job_filename = os.path.join(directory, "G code - bench.ejb")
+    print("Loaded job memory, bytes per point")
+    print("%10s %10s %12s %12s %12s %12s" % ("size", "points", "lines B/pt", "int64 B/pt", "text B/pt", "binary B/pt"))
+    for size in sizes:
+        im = test_image(size)
+        ptg.write_gcode(ptg.gcode_lines(im), text_filename)
+        Binary_Job.write(job_filename, *ptg.raster_positions(im))
+        def retained(function):
+            tracemalloc.start()
+            result = function()
+            held = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            return held, result
+        def open_lines():
+            with open(text_filename, 'r', encoding='utf-8') as text_file:
+                return [line for line in text_file.read().split('\n') if len(line) > 0]
+        def open_arrays():
+            with open(text_filename, 'r', encoding='utf-8') as text_file:
+                return Interpreter(1).decode_script(text_file.read())
+        lines_bytes, lines = retained(open_lines)
+        arrays_bytes, arrays = retained(open_arrays)
+        text_bytes, text_job = retained(lambda: Job.from_file(text_filename))
+        binary_job = Job.from_file(job_filename)
+        points = len(text_job)
+        print("%10s %10d %12.1f %12.1f %12.2f %12.2f" % ("%dx%d" % (size, size), points, lines_bytes/points, arrays_bytes/points,
+              text_bytes/points, binary_job.nbytes()/points))
+        del lines, arrays, text_job, binary_job
+    os.remove(text_filename)
+    os.remove(job_filename)
+    os.rmdir(directory)
+
+def legacy_estimator(script, multiplier=1):
+    """Loop estimator kept as the reference for speed comparison."""
+    max_x = max_y = min_x = min_y = 0
+    steps = points = x_0 = y_0 = 0
+    interp = Interpreter(multiplier)
+    for line_num, line in enumerate(script):
+        x_1, y_1 = interp.decode_string_line(line, line_num)
+        min_x, max_x = min(min_x, x_1), max(max_x, x_1)
+        min_y, max_y = min(min_y, y_1), max(max_y, y_1)
+        steps += max(abs(x_1 - x_0), abs(y_1 - y_0))
+        x_0, y_0 = x_1, y_1
+        points += 1
+    return points, steps, (max_x-min_x+1, max_y-min_y+1)
+
+def bench_estimate(sizes=(500, 1000, 2000)):
+    """Loop estimator against cached Job_Stats, multiplier change and elapsed time lookup."""
+    ptg = Pic_To_Gcode()
+    print("Estimator")
+    print("%10s %10s %12s %12s %14s %14s" % ("size", "points", "legacy s", "stats s", "multiplier us", "elapsed us"))
+    for size in sizes:
+        x_cords, y_cords = ptg.raster_positions(test_image(size))
+        script = ptg.format_gcode(x_cords, y_cords).split('\n')[:-1]
+        legacy_time, legacy_result = timed(legacy_estimator, script, 2)
+        stats_time, job_stats = timed(Job_Stats, x_cords, y_cords)
+        multiplier_time, result = timed(job_stats.estimate, 2)
+        elapsed_time, elapsed = timed(job_stats.elapsed_ms, len(x_cords)//2, 2, 100)
+        assert result == legacy_result
+        print("%10s %10d %12.3f %12.3f %14.1f %14.1f" % ("%dx%d" % (size, size), len(x_cords), legacy_time, stats_time, multiplier_time*1e6, elapsed_time*1e6))
+
+class Null_Serial(object):
+    """Serial port stand in that counts write calls and always replies OK."""
+    def __init__(self):
+        self.writes = 0
+    def write(self, data):
+        self.writes += 1
+    def flushInput(self):
+        pass
+    def readline(self):
+        return b'OK\r\n'
+
+class Null_Transport(object):
+    """Job_Runner transport stand in that counts write calls and answers every frame OK at once."""
+    def __init__(self):
+        self.writes = 0
+    async def open(self):
+        pass
+    def write(self, frames):
+        self.writes += 1
+    async def readline(self):
+        return b'OK\r\n'
+    def reset_input(self):
+        pass
+    def close(self):
+        pass
+
+def legacy_send_positions(serial_man, positions):
+    """Byte at a time frame writer kept as the reference for speed comparison."""
+    for axis, value in (('x', positions[0]), ('y', positions[1])):
+        serial_man.ser.write(struct.pack('B', ord(axis)))
+        for char in serial_man.int_to_3hex(value):
+            serial_man.ser.write(struct.pack('B', ord(char)))
+    serial_man.ser.flushInput()
+    return serial_man.ser.readline() == b'OK\r\n'
+
+def bench_frames(points=200000):
+    """Host side cost of framing, byte writes against pre-encoded frames (no port latency)."""
+    import asyncio
+    from job_runner import Job_Runner
+    x_cords = numpy.arange(points) % 3329
+    y_cords = numpy.arange(points)//3329
+    serial_man = Serial_Manager()
+    print("Serial framing, %d points" % points)
+    print("%24s %12s %12s" % ("method", "seconds", "writes/pt"))
+    serial_man.ser = Null_Serial()
+    def legacy():
+        for positions in zip(x_cords.tolist(), y_cords.tolist()):
+            legacy_send_positions(serial_man, positions)
+    legacy_time, result = timed(legacy)
+    print("%24s %12.3f %12.1f" % ("legacy 8 writes", legacy_time, serial_man.ser.writes/points))
+    for window in (1, 4):
+        transport = Null_Transport()
+        send_time, result = timed(asyncio.run, Job_Runner(x_cords, y_cords, transport, 1, window).run())
+        print("%24s %12.3f %12.1f" % ("Job_Runner window %d" % window, send_time, transport.writes/points))
+
+def bench_link(points=200, lase_ms=2, step_ms=0.05):
+    """End to end Job_Runner throughput against firmware_sim.py at 9600 baud (Linux only).
+    widest is the most points a bad reply could not be narrowed down from."""
+    import asyncio
+    from firmware_sim import Firmware_Simulator
+    from job_runner import Job_Runner, Async_Serial
+    x_cords = numpy.arange(points) % 64
+    y_cords = numpy.arange(points)//64
+    print("Serial link to simulated firmware, %d points, lase %g ms, step %g ms" % (points, lase_ms, step_ms))
+    print("%18s %10s %12s %10s %10s %8s" % ("mode", "seconds", "points/s", "errors", "injected", "widest"))
+    runs = [("window %d" % window, window, 0) for window in (1, 2, 4, 8)] + [("window 1, faults", 1, 0.05), ("window 4, faults", 4, 0.05)]
+    for name, window, fault_rate in runs:
+        with Firmware_Simulator(lase_ms, step_ms, drop_rate=fault_rate, garble_rate=fault_rate, seed=1) as simulator:
+            runner = Job_Runner(x_cords, y_cords, Async_Serial(simulator.port_name, timeout=0.25), 1, window)
+            seconds, state = timed(asyncio.run, runner.run())
+            widest = max([last-first+1 for first, last in runner.failed] + [0])
+            print("%18s %10.3f %12.1f %10d %10d %8d" % (name, seconds, points/seconds, runner.errors, simulator.dropped+simulator.garbled, widest))
+
+def bench_journal(points=200000):
+    """Instant dry runs with and without a Job_Journal, and the cost of one checkpoint call."""
+    import asyncio
+    from job_runner import Job_Runner, Job_Journal, Dry_Run_Transport
+    x_cords = numpy.arange(points) % 640
+    y_cords = numpy.arange(points)//640
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, "bench.journal")
+    print("Job journal overhead, instant dry run of %d points" % points)
+    print("%18s %10s %12s %10s %12s" % ("journal", "seconds", "points/s", "fsyncs", "us/point"))
+    baseline = None
+    for name, interval in (("none", None), ("every 1 s", 1.0), ("every 0.1 s", 0.1), ("every point", 0)):
+        journal = Job_Journal(filename, x_cords, y_cords, 1, interval) if interval != None else None
+        runner = Job_Runner(x_cords, y_cords, Dry_Run_Transport(100, 0), 1, 4, journal=journal)
+        seconds, state = timed(asyncio.run, runner.run())
+        if baseline == None:
+            baseline = seconds
+        print("%18s %10.3f %12.1f %10d %12.2f" % (name, seconds, points/seconds, journal.syncs if journal else 0, (seconds-baseline)/points*1e6))
+    #A checkpoint between records only checks the clock
+    journal = Job_Journal(filename, x_cords, y_cords, 1, 3600)
+    journal.open()
+    journal.checkpoint(0, force=True)
+    seconds, result = timed(lambda: [journal.checkpoint(index) for index in range(1, points)])
+    journal.close(done=True)
+    print("Skipped checkpoint call %.3f us" % (seconds/points*1e6))
+    os.rmdir(directory)
+
+def bench_daemon(points=200000, client_counts=(0, 10, 50)):
+    """Instant dry run through Engraver_Daemon while streaming clients follow every progress event."""
+    import asyncio
+    import socket
+    import shutil
+    import threading
+    from job_runner import Dry_Run_Transport
+    from engraver_daemon import Engraver_Daemon, Daemon_Client
+    directory = tempfile.mkdtemp()
+    job_filename = os.path.join(directory, "bench.ejb")
+    Job.from_positions(numpy.arange(points) % 640, numpy.arange(points)//640).save(job_filename)
+    print("Daemon dry run of %d points with streaming clients" % points)
+    print("%10s %10s %12s %12s" % ("clients", "seconds", "points/s", "events/client"))
+    for clients in client_counts:
+        state_dir = os.path.join(directory, "daemon%d" % clients)
+        address = os.path.join(state_dir, "bench.sock") if hasattr(socket, 'AF_UNIX') else ("127.0.0.1", 8788)
+        daemon = Engraver_Daemon(["bench"], state_dir, 4, lambda port: Dry_Run_Transport(100, 0))
+        thread = threading.Thread(target=asyncio.run, args=(daemon.serve(address),))
+        thread.start()
+        client = Daemon_Client(address)
+        while not client.available():
+            time.sleep(0.05)
+        counts = []
+        def follow():
+            count = 0
+            for event in client.events():
+                count += 1
+                if event['state'] == 'done':
+                    break
+            counts.append(count)
+        followers = [threading.Thread(target=follow) for number in range(clients)]
+        for follower in followers:
+            follower.start()
+        started = time.perf_counter()
+        job_id = client.submit_file(job_filename)['id']
+        while client.job(job_id)['state'] != 'done':
+            time.sleep(0.01)
+        seconds = time.perf_counter() - started
+        for follower in followers:
+            follower.join()
+        daemon.stop()
+        thread.join()
+        print("%10d %10.3f %12.1f %12.1f" % (clients, seconds, points/seconds, sum(counts)/clients if clients else 0))
+    shutil.rmtree(directory)
+
+def bench_path(sizes=(500, 1000, 2000), time_budget=5.0):
+    """Path optimizer modes on sparse artwork, steps from Interpreter.estimator before and after."""
+    ptg = Pic_To_Gcode()
+    print("Path optimization, sparse artwork, %g s budget" % time_budget)
+    print("%10s %10s %10s %12s %12s %10s" % ("size", "points", "mode", "steps before", "steps after", "seconds"))
+    for size in sizes:
+        x_cords, y_cords = ptg.raster_positions(test_sparse(size))
+        for mode in Path_Optimizer.modes[1:]:
+            optimizer = Path_Optimizer(mode, time_budget)
+            seconds, result = timed(optimizer.optimize, x_cords, y_cords)
+            print("%10s %10d %10s %12d %12d %10.2f" % ("%dx%d" % (size, size), len(x_cords), mode, optimizer.steps_before, optimizer.steps_after, seconds))
+
+#Child for bench_startup, prints once the main window has been drawn
+first_window_script = """
+import sys
+import tkinter
+import script_from_file_GUI
+root = tkinter.Tk()
+window = script_from_file_GUI.Window(root)
+window.pack()
+root.update()
+print('shown', *[name for name in ('PIL', 'serial', 'asyncio', 'multiprocessing') if name in sys.modules], flush=True)
+root.destroy()
+"""
+
+def bench_startup(repeats=5):
+    """Wall time of fresh interpreters, from launch to an importable engraver_lib and to the first GUI window drawn."""
+    import subprocess
+    from engraver_lib import Port_Finder
+    folder = os.path.dirname(os.path.abspath(__file__))
+    #Measure as a user would see it, with cached bytecode
+    env = dict(os.environ)
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    def launch(code, wait_for=None):
+        """Best seconds until the child exits, or prints a line starting with wait_for, and that line."""
+        best, output = None, ""
+        for repeat in range(repeats+1):
+            started = time.perf_counter()
+            child = subprocess.Popen([sys.executable, "-c", code], cwd=folder, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+            if wait_for:
+                output = child.stdout.readline().strip()
+            else:
+                child.wait()
+            seconds = time.perf_counter() - started
+            child.communicate()
+            if wait_for and not output.startswith(wait_for):
+                return None, output
+            #First launch only warms the bytecode and disk caches
+            if repeat and (best == None or seconds < best):
+                best = seconds
+        return best, output
+    print("Startup, best of %d fresh interpreters" % repeats)
+    print("%36s %10s  %s" % ("launch", "ms", "heavy modules loaded"))
+    for name, code in (("python alone", "pass"), ("import engraver_lib", "import engraver_lib"),
+                       ("eager PIL, pyserial, asyncio imports", "import PIL.Image, PIL.ImageTk, serial, multiprocessing, asyncio, engraver_lib")):
+        seconds, output = launch(code)
+        print("%36s %10.1f" % (name, seconds*1000))
+    seconds, output = launch(first_window_script, "shown")
+    if seconds == None:
+        print("%36s %10s  %s" % ("first window", "-", "no display"))
+    else:
+        print("%36s %10.1f  %s" % ("first window", seconds*1000, " ".join(output.split()[1:]) or "none"))
+    finder = Port_Finder()
+    started = time.perf_counter()
+    seconds, result = timed(finder.refresh)
+    while finder.scans == 0:
+        time.sleep(0.001)
+    print("Port_Finder.refresh returned in %.3f ms, scan found %d ports in %.1f ms" % (seconds*1000, len(finder.ports), (time.perf_counter()-started)*1000))
+
+benchmarks = {"convert": bench_convert, "condition": bench_condition, "stream": bench_stream, "job_open": bench_job_open, "job_memory": bench_job_memory, "estimate": bench_estimate, "frames": bench_frames, "link": bench_link, "journal": bench_journal, "daemon": bench_daemon, "path": bench_path, "startup": bench_startup}
+
+if __name__=="__main__":
+    names = sys.argv[1:] or list(benchmarks)
+    for name in names:
+        benchmarks[name]()
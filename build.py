@@ -20,7 +20,9 @@ sys.argv.append('build')
 
 
 from cx_Freeze import setup, Executable
-build_exe_options = {"includes": ["serial"], "packages": ["serial"],
+#Modules the GUI imports lazily are invisible to cx_Freeze, list them
+build_exe_options = {"includes": ["serial", "serial.tools.list_ports", "PIL.Image", "PIL.ImageTk", "job_runner", "engraver_daemon", "multiprocessing"],
+                    "packages": ["serial", "PIL"],
                     "include_files": ["resource", "pictures", "G code"],
                     "icon": r"resource\icon.ico",
                     "build_exe": r".\dist\build",
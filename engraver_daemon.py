@@ -0,0 +1,613 @@
+# Copyright (C) 2015  Thomas Wilson, email:supertwilson@Sourceforge.net
+#
+#    This module is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License Version 3 as published by
+#    the Free Software Foundation see <http://www.gnu.org/licenses/>.
+#
+#engraver_daemon.py
+#Headless daemon owning the engravers and a persistent job queue, driven over a small local HTTP API.
+#Run with: python engraver_daemon.py serve --ports PORT [PORT ...] [--dry-run SCALE] [--address PATH|HOST:PORT]
+#Clients:  python engraver_daemon.py list|watch|submit FILE|convert PICTURE|cancel ID|pause ID|resume ID|requeue ID
+
+
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import http.client
+from threading import Thread
+from concurrent.futures import ProcessPoolExecutor
+from engraver_lib import Interpreter, Job, Pic_To_Gcode
+from job_runner import Job_Runner, Job_Journal, Async_Serial, Dry_Run_Transport, Progress_Bridge, Progress
+import batch_convert
+
+
+class Daemon_Job(object):
+    """One job owned by the daemon. Points are kept as a binary job file in the daemon folder, so the queue
+    survives restarts; a run cut short resumes from its journal."""
+    #'queued', 'running', 'paused', 'done', 'failed' or 'cancelled'. A paused job without a runner is held until resumed
+    fields = ('id', 'name', 'state', 'port', 'machine', 'multiplier', 'points', 'index', 'errors', 'rate', 'submitted', 'error')
+
+    def __init__(self, id, name, multiplier=1, points=0, port=None):
+        self.id = id
+        self.name = name
+        self.state = 'queued'
+        #Port the job must run on, None for any
+        self.port = port
+        #Port it last ran on
+        self.machine = None
+        self.multiplier = multiplier
+        self.points = points
+        self.index = -1
+        self.errors = 0
+        self.rate = 0
+        self.submitted = time.time()
+        self.error = None
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.fields}
+
+    def from_dict(values):
+        job = Daemon_Job(values['id'], values['name'])
+        for field in Daemon_Job.fields:
+            setattr(job, field, values.get(field, getattr(job, field)))
+        return job
+#
+class Engraver_Daemon(object):
+    """Owns one Job_Runner thread per engraver port and a persistent FIFO job queue. The API runs on its own
+    event loop, apart from the runner threads, and progress reaches clients through each runner's coalescing
+    Progress_Bridge, so any number of clients or slow readers never hold up the serial loop."""
+    #Seconds between progress polls of running jobs
+    poll_interval = 0.05
+    #Progress events buffered per streaming client, older ones are dropped for slow clients
+    client_buffer = 256
+    #Largest request body accepted, G-code text included
+    max_body = 256*2**20
+    #Seconds a stopping daemon waits for each runner to write its last checkpoint and close its port
+    stop_timeout = 10
+
+    def __init__(self, ports, state_dir="daemon", window=1, transport_factory=Async_Serial, lase_time=100):
+        self.ports = list(ports)
+        self.state_dir = state_dir
+        self.window = window
+        self.transport_factory = transport_factory
+        self.lase_time = lase_time
+        os.makedirs(os.path.join(state_dir, "jobs"), exist_ok=True)
+        self.jobs = {}
+        self.runners = {}
+        self.subscribers = set()
+        self.executor = None
+        #Set whenever a job may have become runnable
+        self.changed = asyncio.Event()
+        self.stopping = asyncio.Event()
+        self.connections = set()
+        self.loop = None
+        self.load()
+
+    def job_path(self, job_id, extension):
+        return os.path.join(self.state_dir, "jobs", job_id + extension)
+
+    def load(self):
+        """Reads the queue. Jobs cut short by a stop are queued again to resume from their journals, paused ones stay held."""
+        try:
+            with open(os.path.join(self.state_dir, "jobs.json"), 'r', encoding='utf-8') as queue_file:
+                saved = json.load(queue_file)
+        except (OSError, ValueError):
+            saved = []
+        for values in saved:
+            job = Daemon_Job.from_dict(values)
+            if job.state == 'running':
+                job.state = 'queued'
+            self.jobs[job.id] = job
+        self.next_id = max([int(job_id) for job_id in self.jobs] + [0]) + 1
+
+    def save(self):
+        with Pic_To_Gcode.atomic_file(os.path.join(self.state_dir, "jobs.json"), 'w', encoding='utf-8') as queue_file:
+            json.dump([job.to_dict() for job in self.jobs.values()], queue_file, indent=1)
+
+    def submit(self, job, name, port=None):
+        """Queues a Job under name, optionally pinned to one port. Returns the Daemon_Job."""
+        if port != None and port not in self.ports:
+            raise Exception("Unknown port: ", port)
+        daemon_job = Daemon_Job("%06d" % self.next_id, name, job.multiplier, len(job), port)
+        self.next_id += 1
+        job.save(self.job_path(daemon_job.id, ".ejb"))
+        self.jobs[daemon_job.id] = daemon_job
+        self.save()
+        self.__notify(daemon_job)
+        self.changed.set()
+        return daemon_job
+
+    async def convert(self, picture, size=None, path=None, dither='floyd-steinberg', density=None, tiled=False):
+        """Converts a picture in a worker process like batch_convert.py. Returns (G-code file name, seconds)."""
+        if self.executor == None:
+            self.executor = ProcessPoolExecutor(max_workers=1)
+        output_dir = os.path.join(self.state_dir, "G code")
+        pictures_dir = os.path.join(self.state_dir, "pictures")
+        os.makedirs(output_dir, exist_ok=True)
+        os.makedirs(pictures_dir, exist_ok=True)
+        size = tuple(size) if size else None
+        g_code_file_name, seconds, steps, hit = await asyncio.get_running_loop().run_in_executor(self.executor, batch_convert.convert_one,
+            picture, size, path, output_dir, pictures_dir, "cache", 512*2**20, dither, density, tiled)
+        return g_code_file_name, seconds
+
+    def cancel(self, job_id):
+        job = self.__job(job_id)
+        if job.state in ('queued', 'paused', 'failed'):
+            job.state = 'cancelled'
+        if job.id in self.runners:
+            job.state = 'cancelled'
+            self.runners[job.id].abort()
+        self.save()
+        self.__notify(job)
+        return job
+
+    def pause(self, job_id):
+        """Pauses a running job, or holds a queued one until it is resumed."""
+        job = self.__job(job_id)
+        if job.id in self.runners:
+            self.runners[job.id].pause()
+        elif job.state == 'queued':
+            self.__hold(job, 'paused')
+        return job
+
+    def resume(self, job_id):
+        job = self.__job(job_id)
+        if job.id in self.runners:
+            self.runners[job.id].resume()
+        elif job.state == 'paused':
+            self.__hold(job, 'queued')
+            self.changed.set()
+        return job
+
+    def step(self, job_id):
+        """Sends one more point of a paused running job."""
+        job = self.__job(job_id)
+        if job.id in self.runners:
+            self.runners[job.id].step()
+        return job
+
+    def __hold(self, job, state):
+        job.state = state
+        self.save()
+        self.__notify(job)
+
+    def requeue(self, job_id):
+        """Queues a failed or cancelled job again, it resumes after the last confirmed point if it gets the same port."""
+        job = self.__job(job_id)
+        if job.state in ('failed', 'cancelled'):
+            job.state = 'queued'
+            job.error = None
+            self.save()
+            self.__notify(job)
+            self.changed.set()
+        return job
+
+    def __job(self, job_id):
+        if job_id not in self.jobs:
+            raise KeyError(job_id)
+        return self.jobs[job_id]
+
+    def __notify(self, job):
+        """Queues a snapshot of job for every streaming client, dropping the oldest for clients that fall behind."""
+        event = job.to_dict()
+        for queue in self.subscribers:
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    def stop(self):
+        """Stops serve(), safe from any thread. Running jobs are stopped and resume from their journals next time."""
+        if self.loop != None:
+            self.loop.call_soon_threadsafe(self.stopping.set)
+
+    async def serve(self, address):
+        """Serves the API on a Unix socket path or a (host, port) pair until stop() or cancellation."""
+        self.loop = asyncio.get_running_loop()
+        self.changed.set()
+        if isinstance(address, str):
+            if os.path.exists(address):
+                os.remove(address)
+            server = await asyncio.start_unix_server(self.__handle, address)
+        else:
+            server = await asyncio.start_server(self.__handle, *address)
+        workers = [asyncio.ensure_future(self.__worker(port)) for port in self.ports]
+        try:
+            async with server:
+                await self.stopping.wait()
+        finally:
+            runners = list(self.runners.values())
+            for task in workers + list(self.connections):
+                task.cancel()
+            for runner in runners:
+                runner.abort()
+            await asyncio.gather(*workers, *self.connections, return_exceptions=True)
+            #Runner threads are daemon threads, wait for their last checkpoint and port close before the process exits
+            for runner in runners:
+                await self.loop.run_in_executor(None, runner.join, self.stop_timeout)
+            self.save()
+            self.loop = None
+            if self.executor != None:
+                self.executor.shutdown()
+            if isinstance(address, str) and os.path.exists(address):
+                os.remove(address)
+
+    def __next_job(self, port):
+        for job in self.jobs.values():
+            if job.state == 'queued' and (job.port == None or job.port == port):
+                return job
+        return None
+
+    async def __worker(self, port):
+        """Runs queued jobs one after another on port."""
+        while True:
+            job = self.__next_job(port)
+            if job == None:
+                self.changed.clear()
+                await self.changed.wait()
+                continue
+            await self.__run(job, port)
+            #Another worker may have been waiting for this one's state change
+            self.changed.set()
+
+    async def __run(self, job, port):
+        points = Job.from_file(self.job_path(job.id, ".ejb"))
+        transport = self.transport_factory(port)
+        #Dry runs engrave nothing, a checkpoint from one would skip points on the real machine
+        journal = None
+        start = 0
+        if not isinstance(transport, Dry_Run_Transport):
+            journal = Job_Journal(self.job_path(job.id, ".journal"), points.x, points.y, points.multiplier, machine=port)
+            start = journal.resume_index()
+        runner = Job_Runner(points.x, points.y, transport, points.multiplier, self.window, start=start, journal=journal)
+        job.state = 'running'
+        job.machine = port
+        job.error = None
+        self.runners[job.id] = runner
+        self.save()
+        self.__notify(job)
+        runner.start()
+        try:
+            #The runner has its own thread and loop, only its coalesced progress is read here
+            while runner.thread.is_alive():
+                await asyncio.sleep(self.poll_interval)
+                self.__take_progress(job, runner)
+        finally:
+            del self.runners[job.id]
+        self.__take_progress(job, runner)
+        if runner.state == 'done':
+            job.state = 'done'
+        elif job.state != 'cancelled':
+            job.state = 'failed'
+            job.error = str(runner.error) if runner.error != None else "stopped"
+        self.save()
+        self.__notify(job)
+
+    def __take_progress(self, job, runner):
+        progress = runner.bridge.take()
+        if progress == None:
+            return
+        job.index, job.errors, job.rate = progress.index, progress.errors, progress.rate
+        if progress.state in ('running', 'paused', 'stepping') and job.state != 'cancelled':
+            state = 'running' if progress.state == 'running' else 'paused'
+            if state != job.state:
+                #Saved, so a job paused when the daemon stops is still held after a restart
+                job.state = state
+                self.save()
+        self.__notify(job)
+
+    async def __handle(self, reader, writer):
+        """One HTTP/1.1 request per connection, JSON in and out. GET /events streams newline delimited JSON."""
+        self.connections.add(asyncio.current_task())
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            if len(request_line) < 2:
+                await self.__respond(writer, 400, {'error': "malformed request line"})
+                return
+            headers = {}
+            malformed = None
+            while True:
+                line = (await reader.readline()).decode('latin-1')
+                if line in ('\r\n', '\n', ''):
+                    break
+                name, colon, value = line.partition(':')
+                if colon == '':
+                    malformed = "malformed header: %s" % line.strip()
+                headers[name.strip().lower()] = value.strip()
+            length = headers.get('content-length', '0')
+            if not length.isdigit():
+                malformed = "malformed content-length: %s" % length
+            if malformed != None:
+                await self.__respond(writer, 400, {'error': malformed})
+                return
+            method, path = request_line[0], request_line[1]
+            length = int(length)
+            if length > self.max_body:
+                await self.__respond(writer, 413, {'error': "request too large"})
+                return
+            body = {}
+            if length:
+                try:
+                    body = json.loads(await reader.readexactly(length))
+                except ValueError:
+                    await self.__respond(writer, 400, {'error': "request body is not JSON"})
+                    return
+            if method == 'GET' and path == '/events':
+                await self.__stream_events(writer)
+                return
+            try:
+                status, result = 200, await self.__route(method, path.strip('/').split('/'), body)
+            except KeyError as error:
+                status, result = 404, {'error': "not found: %s" % error.args[0]}
+            except Exception as error:
+                status, result = 400, {'error': " ".join(str(arg) for arg in error.args)}
+            await self.__respond(writer, status, result)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            #Daemon stopping, streaming clients see the connection close
+            pass
+        finally:
+            self.connections.discard(asyncio.current_task())
+            writer.close()
+
+    async def __route(self, method, parts, body):
+        if parts == ['jobs'] and method == 'GET':
+            return [job.to_dict() for job in self.jobs.values()]
+        if parts == ['machines'] and method == 'GET':
+            busy = {job.machine: job.id for job in self.jobs.values() if job.id in self.runners}
+            return [{'port': port, 'job': busy.get(port)} for port in self.ports]
+        if parts == ['jobs'] and method == 'POST':
+            if 'gcode' in body:
+                job = Job.from_positions(*Interpreter(1).decode_script(body['gcode']), body.get('multiplier', 1))
+            else:
+                job = Job.from_file(body['file'])
+                if 'multiplier' in body:
+                    job = Job(job.data, body['multiplier'])
+            return self.submit(job, body.get('name', body.get('file', "G-code")), body.get('port')).to_dict()
+        if parts == ['convert'] and method == 'POST':
+            g_code_file_name, seconds = await self.convert(body['picture'], body.get('size'), body.get('path'),
+                body.get('dither', 'floyd-steinberg'), body.get('density'), body.get('tiled', False))
+            result = {'gcode': g_code_file_name, 'seconds': seconds, 'job': None}
+            if body.get('submit', True):
+                result['job'] = self.submit(Job.from_file(g_code_file_name), os.path.basename(body['picture']), body.get('port')).to_dict()
+            return result
+        if len(parts) == 2 and parts[0] == 'jobs' and method == 'GET':
+            return self.__job(parts[1]).to_dict()
+        if len(parts) == 2 and parts[0] == 'jobs' and method == 'DELETE':
+            return self.cancel(parts[1]).to_dict()
+        if len(parts) == 3 and parts[0] == 'jobs' and method == 'POST' and parts[2] in ('pause', 'resume', 'step', 'requeue', 'cancel'):
+            return getattr(self, parts[2])(parts[1]).to_dict()
+        raise KeyError("/".join(parts))
+
+    async def __respond(self, writer, status, result):
+        body = json.dumps(result).encode()
+        writer.write(b"HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % (
+            status, http.client.responses[status].encode(), len(body)) + body)
+        await writer.drain()
+
+    async def __stream_events(self, writer):
+        """Sends every job once, then each change as it happens, until the client goes away."""
+        queue = asyncio.Queue(self.client_buffer)
+        for job in self.jobs.values():
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(job.to_dict())
+        self.subscribers.add(queue)
+        try:
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\nConnection: close\r\n\r\n")
+            while True:
+                writer.write(json.dumps(await queue.get()).encode() + b"\n")
+                await writer.drain()
+        finally:
+            self.subscribers.discard(queue)
+#
+class Daemon_Client(object):
+    """Blocking client of Engraver_Daemon's API, for the GUI and the command line."""
+    def __init__(self, address=None, timeout=10):
+        self.address = address if address != None else Daemon_Client.default_address()
+        self.timeout = timeout
+
+    def default_address():
+        """Unix socket in the daemon folder where there are Unix sockets, else a fixed local TCP port."""
+        if hasattr(socket, 'AF_UNIX'):
+            return os.path.join("daemon", "engraver.sock")
+        return ("127.0.0.1", 8787)
+
+    def parse_address(text):
+        """'HOST:PORT' as a (host, port) pair, anything else is a Unix socket path."""
+        host, _, port = text.rpartition(':')
+        if host and port.isdigit():
+            return (host, int(port))
+        return text
+
+    def connection(self, timeout):
+        """HTTPConnection to the daemon, timeout None blocks."""
+        if isinstance(self.address, str):
+            connection = http.client.HTTPConnection("localhost", timeout=timeout)
+            connection.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.sock.settimeout(timeout)
+            connection.sock.connect(self.address)
+            return connection
+        return http.client.HTTPConnection(*self.address, timeout=timeout)
+
+    def request(self, method, path, body=None):
+        """Sends a request and returns the decoded JSON reply. API errors raise Exception with the daemon's message."""
+        connection = self.connection(self.timeout)
+        try:
+            data = json.dumps(body).encode() if body != None else None
+            connection.request(method, path, data, {'Content-Type': 'application/json'} if data else {})
+            response = connection.getresponse()
+            result = json.loads(response.read())
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise Exception("Daemon error: ", result.get('error'))
+        return result
+
+    def available(self):
+        """True if a daemon answers at address."""
+        try:
+            self.request('GET', '/machines')
+            return True
+        except Exception:
+            return False
+
+    def jobs(self):
+        return self.request('GET', '/jobs')
+
+    def job(self, job_id):
+        return self.request('GET', '/jobs/' + job_id)
+
+    def submit_file(self, filename, multiplier=None, port=None):
+        body = {'file': os.path.abspath(filename), 'name': os.path.basename(filename), 'port': port}
+        if multiplier != None:
+            body['multiplier'] = multiplier
+        return self.request('POST', '/jobs', body)
+
+    def convert(self, picture, size=None, path=None, dither='floyd-steinberg', density=None, tiled=False, submit=True, port=None):
+        return self.request('POST', '/convert', {'picture': os.path.abspath(picture), 'size': size, 'path': path, 'dither': dither,
+                                                'density': density, 'tiled': tiled, 'submit': submit, 'port': port})
+
+    def control(self, job_id, command):
+        """command is 'pause', 'resume', 'step', 'cancel' or 'requeue'."""
+        return self.request('POST', '/jobs/%s/%s' % (job_id, command))
+
+    def events(self):
+        """Yields job snapshots as they change, starting with every job. Blocks between events."""
+        connection = self.connection(None)
+        try:
+            connection.request('GET', '/events')
+            response = connection.getresponse()
+            for line in response:
+                yield json.loads(line)
+        finally:
+            connection.close()
+#
+class Remote_Runner(object):
+    """Runs a job on the daemon with the control interface of Job_Runner, so the GUI drives either the same way.
+    Progress arrives from the daemon's event stream on a thread and is handed over through a Progress_Bridge."""
+    def __init__(self, client, filename, multiplier=1, port=None):
+        self.client = client
+        self.filename = filename
+        self.multiplier = multiplier
+        self.port = port
+        self.bridge = Progress_Bridge()
+        self.telemetry = None
+        self.job_id = None
+        self.index = -1
+        self.errors = 0
+        self.state = 'idle'
+        self.error = None
+        self.thread = None
+
+    def start(self, paused=False):
+        self.job_id = self.client.submit_file(self.filename, self.multiplier, self.port)['id']
+        self.state = 'running'
+        self.thread = Thread(target=self.__follow, daemon=True)
+        self.thread.start()
+
+    def __follow(self):
+        states = {'queued': 'running', 'running': 'running', 'paused': 'paused', 'done': 'done', 'failed': 'failed', 'cancelled': 'aborted'}
+        try:
+            for event in self.client.events():
+                if event['id'] != self.job_id:
+                    continue
+                self.index, self.errors, self.error = event['index'], event['errors'], event['error']
+                self.state = states[event['state']]
+                self.bridge.publish(Progress(self.index, None, self.errors, event['rate'], self.state))
+                if self.finished():
+                    return
+        except Exception as error:
+            self.error = error
+            self.state = 'failed'
+            self.bridge.publish(Progress(self.index, None, self.errors, 0, self.state))
+
+    def pause(self):
+        self.client.control(self.job_id, 'pause')
+
+    def resume(self):
+        self.client.control(self.job_id, 'resume')
+
+    def step(self):
+        self.client.control(self.job_id, 'step')
+
+    def abort(self):
+        if self.job_id != None and not self.finished():
+            self.client.control(self.job_id, 'cancel')
+
+    def join(self, timeout=None):
+        if self.thread != None:
+            self.thread.join(timeout)
+
+    def finished(self):
+        return self.state in ('aborted', 'done', 'failed')
+#
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Headless 2D laser engraver daemon and its command line client.")
+    parser.add_argument("--address", help="Unix socket path or HOST:PORT, defaults to daemon/engraver.sock or 127.0.0.1:8787")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve = commands.add_parser("serve", help="run the daemon")
+    serve.add_argument("--ports", nargs='+', required=True, help="serial ports of the engravers, or names for a dry run")
+    serve.add_argument("--window", type=int, default=1, help="frames in flight per machine")
+    serve.add_argument("--state-dir", default="daemon", help="folder for the queue, jobs and journals")
+    serve.add_argument("--dry-run", type=float, default=None, metavar="TIME_SCALE", help="simulate the machines, 0 is instant")
+    serve.add_argument("--lase-time", type=int, default=100, help="milliseconds per point for dry runs")
+    commands.add_parser("list", help="list jobs")
+    commands.add_parser("watch", help="print job changes as they happen")
+    submit = commands.add_parser("submit", help="queue a G-code or binary job")
+    submit.add_argument("file")
+    submit.add_argument("--multiplier", type=int, default=None)
+    submit.add_argument("--port", help="run only on this port")
+    convert = commands.add_parser("convert", help="convert a picture and queue it")
+    convert.add_argument("picture")
+    convert.add_argument("--size", help="maximum size WxH in points")
+    convert.add_argument("--path", choices=batch_convert.Path_Optimizer.modes + ('contour',), default=None)
+    convert.add_argument("--dither", choices=Pic_To_Gcode.dither_modes, default='floyd-steinberg')
+    convert.add_argument("--density", type=float, default=None, help="share of black dots in percent")
+    convert.add_argument("--tiled", action='store_true')
+    convert.add_argument("--no-submit", action='store_true', help="only convert")
+    for command in ("cancel", "pause", "resume", "step", "requeue"):
+        commands.add_parser(command, help=command + " a job").add_argument("id")
+    args = parser.parse_args()
+    address = Daemon_Client.parse_address(args.address) if args.address else Daemon_Client.default_address()
+    if args.command == "serve":
+        if args.dry_run != None:
+            daemon = Engraver_Daemon(args.ports, args.state_dir, args.window, lambda port: Dry_Run_Transport(args.lase_time, args.dry_run), args.lase_time)
+        else:
+            daemon = Engraver_Daemon(args.ports, args.state_dir, args.window)
+        print("Serving", address, "with", len(daemon.jobs), "jobs")
+        try:
+            asyncio.run(daemon.serve(address))
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+    client = Daemon_Client(address)
+    def line(job):
+        return "%s %-9s %8d/%-8d errors %-4d %8.1f points/s  %s" % (job['id'], job['state'], job['index']+1, job['points'], job['errors'], job['rate'], job['name'])
+    if args.command == "list":
+        for job in client.jobs():
+            print(line(job))
+    elif args.command == "watch":
+        try:
+            for job in client.events():
+                print(line(job))
+                sys.stdout.flush()
+        except KeyboardInterrupt:
+            pass
+    elif args.command == "submit":
+        print(line(client.submit_file(args.file, args.multiplier, args.port)))
+    elif args.command == "convert":
+        size = [int(value) for value in args.size.lower().split('x')] if args.size else None
+        density = args.density/100 if args.density != None else None
+        result = client.convert(args.picture, size, args.path, args.dither, density, args.tiled, not args.no_submit)
+        print("Converted to", result['gcode'], "in %.2f s" % result['seconds'])
+        if result['job'] != None:
+            print(line(result['job']))
+    else:
+        print(line(client.control(args.id, args.command)))
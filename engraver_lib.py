@@ -7,6 +7,20 @@
 #2D engraver library
 
 
+import numpy
+import importlib
+class Lazy_Module(object):
+    """Stands in for a module until an attribute is first used, then imports it.
+    Keeps PIL and pyserial off the import path of engraver_lib and the GUI until a picture or port is touched."""
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+    
+    def __getattr__(self, attribute):
+        if self.module == None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
+#
 class Table_State(object):
     """Used by Interpreter to retain state information."""
     def __init__(self, x=0, y=0):
@@ -42,79 +56,560 @@ class Interpreter(object):
         if positions[1] == None:
             positions[1] = self.state.y
         return positions
-        
+    
+    def decode_script(self, script):
+        """Parses a whole script (list of lines or text) in one pass. Returns x, y int64 arrays with single axis updates
+        carried forward. Blank and comment lines are skipped, errors report the line number counting from 1."""
+        if not isinstance(script, str):
+            script = '\n'.join(script)
+        try:
+            decoded = self.__scan_bytes(numpy.frombuffer(script.encode('ascii'), dtype=numpy.uint8))
+        except UnicodeEncodeError:
+            decoded = None
+        if decoded is None:
+            #Not plain 'xN yN' lines, fall back to line by line decoding
+            decoded = self.__decode_lines(script.split('\n'))
+        x_cords, y_cords, line_nums = decoded
+        out_of_range = (x_cords < 0) | (x_cords > 3328) | (y_cords < 0) | (y_cords > 3328)
+        if out_of_range.any():
+            raise Exception("Invalid range on line: ", int(line_nums[numpy.argmax(out_of_range)]))
+        if len(x_cords):
+            self.state.x = int(x_cords[-1])
+            self.state.y = int(y_cords[-1])
+        return x_cords, y_cords
+    
+    def __decode_lines(self, lines):
+        """decode_string_line over every line, returns x, y and line number arrays."""
+        x_cords = []
+        y_cords = []
+        line_nums = []
+        for line_num, line in enumerate(lines, 1):
+            try:
+                positions = self.decode_string_line(line, line_num)
+            except ValueError:
+                raise Exception("Invalid syntax on line: ", line_num)
+            if positions != False:
+                x_cords.append(positions[0])
+                y_cords.append(positions[1])
+                line_nums.append(line_num)
+        return numpy.array(x_cords, dtype=numpy.int64), numpy.array(y_cords, dtype=numpy.int64), numpy.array(line_nums, dtype=numpy.int64)
+    
+    #Character classes for __scan_bytes: 0 invalid, 1 digit, 2 axis letter, 3 white space
+    char_classes = numpy.zeros(256, dtype=numpy.uint8)
+    char_classes[numpy.frombuffer(b'0123456789', dtype=numpy.uint8)] = 1
+    char_classes[numpy.frombuffer(b'xXyY', dtype=numpy.uint8)] = 2
+    char_classes[numpy.frombuffer(b' \t\r\n', dtype=numpy.uint8)] = 3
+    
+    def __scan_bytes(self, data):
+        """Array scanner for scripts made only of x/y tokens, white space and comment lines. Returns None for anything else."""
+        size = len(data)
+        newlines = numpy.flatnonzero(data == ord('\n'))
+        line_starts = numpy.concatenate(([0], newlines+1))
+        line_lengths = numpy.concatenate((newlines, [size])) - line_starts
+        comment = line_lengths > 0
+        comment[comment] = data[line_starts[comment]] == ord('#')
+        #Padded with white space so digit runs can be read past the end
+        data = numpy.concatenate((data, numpy.full(11, ord(' '), dtype=numpy.uint8)))
+        classes = self.char_classes[data]
+        if comment.any():
+            classes[:size][numpy.repeat(comment, line_lengths+1)[:size]] = 3
+        if (classes == 0).any():
+            return None
+        #Each letter is followed by a run of digits, read up to 10 digits for all tokens at once
+        letter_pos = numpy.flatnonzero(classes == 2)
+        values = numpy.zeros(len(letter_pos), dtype=numpy.int64)
+        lengths = numpy.zeros(len(letter_pos), dtype=numpy.int64)
+        reading = numpy.ones(len(letter_pos), dtype=bool)
+        for offset in range(1, 11):
+            reading &= classes[letter_pos+offset] == 1
+            if not reading.any():
+                break
+            values = numpy.where(reading, values*10 + data[letter_pos+offset] - ord('0'), values)
+            lengths += reading
+        else:
+            return None
+        #Letters without a number, or digits not belonging to a letter
+        if (lengths == 0).any() or lengths.sum() != numpy.count_nonzero(classes == 1):
+            return None
+        #Last token of each axis on a line wins, like decode_string_line
+        is_y = (data[letter_pos] | 0x20) == ord('y')
+        token_lines = numpy.searchsorted(newlines, letter_pos)
+        keep = numpy.flatnonzero((line_lengths > 0) & ~comment)
+        axis_cords = []
+        for axis, start in ((~is_y, self.state.x), (is_y, self.state.y)):
+            line_values = numpy.full(len(line_starts), -1, dtype=numpy.int64)
+            line_values[token_lines[axis]] = values[axis]
+            line_values = line_values[keep]
+            #Carry forward the last given value for lines without this axis
+            last = numpy.maximum.accumulate(numpy.where(line_values >= 0, numpy.arange(len(keep)), -1))
+            axis_cords.append(numpy.where(last >= 0, line_values[numpy.maximum(last, 0)]*self.multiplier, start))
+        return axis_cords[0], axis_cords[1], keep+1
+    
     def estimator(script, multiplier=1):
-        """Calculates properties of a given G-code script."""
-        max_x = 0
-        max_y = 0
-        min_x = 0
-        min_y = 0
-        line_num=0
-        steps = 0
-        points = 0
-        x_0 = 0
-        y_0 = 0
-        interp = Interpreter(multiplier)
-        for line in script:
-            temp = interp.decode_string_line(line, line_num)
-            line_num+=1
-            if temp == False:
+        """Calculates properties of a given G-code script, Binary_Job or Job."""
+        if isinstance(script, (Binary_Job, Job)):
+            return Interpreter.estimate_positions(script.x, script.y, multiplier)
+        return Interpreter.estimate_positions(*Interpreter(1).decode_script(script), multiplier=multiplier)
+    
+    def estimate_positions(x_cords, y_cords, multiplier=1):
+        """Calculates points, steps and size of x, y arrays, moving from 0, 0 with the axes stepping together."""
+        return Job_Stats(x_cords, y_cords).estimate(multiplier)
+#
+
+class Time_Model(object):
+    """Run time of one point in milliseconds: lase_time + overhead_ms + step_ms*steps + root_ms*sqrt(steps) + move_ms if it moves.
+    Steps include the multiplier. The square root term covers acceleration on short moves. Defaults are the original fixed constants."""
+    terms = ('overhead_ms', 'step_ms', 'root_ms', 'move_ms')
+    
+    def __init__(self, overhead_ms=12, step_ms=1, root_ms=0, move_ms=0):
+        self.overhead_ms = overhead_ms
+        self.step_ms = step_ms
+        self.root_ms = root_ms
+        self.move_ms = move_ms
+    
+    def point_ms(self, steps, lase_time):
+        """Time of points moving steps, steps may be an array."""
+        steps = numpy.asarray(steps)
+        return lase_time + self.overhead_ms + self.step_ms*steps + self.root_ms*numpy.sqrt(steps) + self.move_ms*(steps > 0)
+    
+    def cost(self, points, steps, roots, moves, multiplier, lase_time):
+        """Time of points with summed raw steps, square roots of raw steps and moves, scaled to multiplier."""
+        return (points*(lase_time+self.overhead_ms) + self.step_ms*steps*multiplier
+                + self.root_ms*roots*multiplier**0.5 + self.move_ms*moves)
+    
+    def features(steps):
+        """Least squares design matrix of point times less lase time, one row per point of steps."""
+        steps = numpy.asarray(steps, dtype=numpy.float64)
+        return numpy.column_stack((numpy.ones(len(steps)), steps, numpy.sqrt(steps), steps > 0))
+    
+    def from_normal_equations(xtx, xty):
+        """Fits a Time_Model from summed Time_Model.features products. Terms that fit negative are dropped and the rest refit."""
+        xtx = numpy.asarray(xtx, dtype=numpy.float64)
+        xty = numpy.asarray(xty, dtype=numpy.float64)
+        active = [term for term in range(len(xty)) if xtx[term, term] > 0]
+        coefficients = numpy.zeros(len(xty))
+        while active:
+            fitted = numpy.linalg.lstsq(xtx[numpy.ix_(active, active)], xty[active], rcond=None)[0]
+            if (fitted >= 0).all():
+                coefficients[active] = fitted
                 break
-            x_1 = temp[0]
-            y_1 = temp[1]
-            if x_1 < min_x:
-                min_x = x_1
-            elif x_1 > max_x:
-                max_x = x_1
-            if y_1 < min_y:
-                min_y = y_1
-            elif y_1 > max_y:
-                max_y = y_1
-            deltax = abs(x_1 - x_0)
-            deltay = abs(y_1 - y_0)
-            if deltax > deltay:
-                steps += deltax
-            else:
-                steps += deltay
-            x_0 = x_1
-            y_0 = y_1
-            points += 1
-        return points, steps, (max_x-min_x+1, max_y-min_y+1)
+            active = [term for term, value in zip(active, fitted) if value >= 0]
+        return Time_Model(*(float(value) for value in coefficients))
+    
+    def to_dict(self):
+        return {term: getattr(self, term) for term in self.terms}
+#
+class Job_Stats(object):
+    """Cached estimator results for x, y arrays. Steps and size scale linearly with the multiplier, so a new
+    multiplier or lase time costs O(1). Cumulative steps, square roots of steps and moves are kept every block points
+    for elapsed time lookups under any Time_Model."""
+    block = 1024
+    overhead_ms = 12
+    
+    def __init__(self, x_cords, y_cords):
+        self.x_cords = x_cords
+        self.y_cords = y_cords
+        self.points = len(x_cords)
+        if self.points == 0:
+            self.span = (0, 0)
+            self.block_steps = numpy.zeros(1, dtype=numpy.int64)
+            self.block_roots = numpy.zeros(1)
+            self.block_moves = numpy.zeros(1, dtype=numpy.int64)
+        else:
+            #Table starts at 0, 0 so the origin is always inside the bounds
+            self.span = (max(int(numpy.max(x_cords)), 0) - min(int(numpy.min(x_cords)), 0),
+                         max(int(numpy.max(y_cords)), 0) - min(int(numpy.min(y_cords)), 0))
+            block_sums = ([], [], [])
+            chunk = self.block*1024
+            for start in range(0, self.points, chunk):
+                steps = self.segment_steps(start, min(start+chunk, self.points))
+                block_starts = numpy.arange(0, len(steps), self.block)
+                block_sums[0].append(numpy.add.reduceat(steps, block_starts))
+                block_sums[1].append(numpy.add.reduceat(numpy.sqrt(steps), block_starts))
+                block_sums[2].append(numpy.add.reduceat((steps > 0).astype(numpy.int64), block_starts))
+            self.block_steps, self.block_roots, self.block_moves = (numpy.concatenate([[0]] + sums).cumsum() for sums in block_sums)
+        self.steps = int(self.block_steps[-1])
+        self.default_model = Time_Model(self.overhead_ms)
+    
+    def segment_steps(self, start, stop):
+        """Steps taken moving onto points start to stop-1, the larger axis delta of each move."""
+        first = max(start-1, 0)
+        x_cords = numpy.asarray(self.x_cords[first:stop], dtype=numpy.int64)
+        y_cords = numpy.asarray(self.y_cords[first:stop], dtype=numpy.int64)
+        if start == 0:
+            x_cords = numpy.concatenate(([0], x_cords))
+            y_cords = numpy.concatenate(([0], y_cords))
+        return numpy.maximum(numpy.abs(numpy.diff(x_cords)), numpy.abs(numpy.diff(y_cords)))
+    
+    def estimate(self, multiplier=1):
+        """Same results as Interpreter.estimator: points, steps and size."""
+        return self.points, self.steps*multiplier, (self.span[0]*multiplier+1, self.span[1]*multiplier+1)
+    
+    def total_ms(self, multiplier, lase_time, model=None):
+        """Estimated run time of the whole job in milliseconds."""
+        return self.elapsed_ms(self.points-1, multiplier, lase_time, model)
+    
+    def elapsed_steps(self, index):
+        """Steps taken up to and including point index."""
+        return self.elapsed_features(index)[0]
+    
+    def elapsed_features(self, index):
+        """Steps, summed square roots of steps and moves up to and including point index."""
+        if index < 0:
+            return 0, 0.0, 0
+        block_num = (index+1)//self.block
+        steps = self.segment_steps(block_num*self.block, index+1)
+        return (int(self.block_steps[block_num]) + int(steps.sum()),
+                float(self.block_roots[block_num]) + float(numpy.sqrt(steps).sum()),
+                int(self.block_moves[block_num]) + int(numpy.count_nonzero(steps)))
+    
+    def elapsed_ms(self, index, multiplier, lase_time, model=None):
+        """Estimated run time up to and including point index in milliseconds."""
+        if model == None:
+            model = self.default_model
+        return model.cost(index+1, *self.elapsed_features(index), multiplier, lase_time)
+    
+    def remaining_ms(self, index, multiplier, lase_time, model=None):
+        """Estimated run time left after point index in milliseconds."""
+        return self.total_ms(multiplier, lase_time, model) - self.elapsed_ms(index, multiplier, lase_time, model)
+    
+    def time_profile(self, multiplier, lase_time, model=None):
+        """Cumulative estimated run time in milliseconds after each point, as an array."""
+        if model == None:
+            model = self.default_model
+        return numpy.cumsum(model.point_ms(self.segment_steps(0, self.points)*multiplier, lase_time))
+    
+    def timeline(self, multiplier, lase_time, phases=10, model=None):
+        """Splits the job into phases of equal point counts.
+        Returns (first point, last point, start ms, lase ms, overhead ms, travel ms) for each phase."""
+        if model == None:
+            model = self.default_model
+        rows = []
+        bounds = numpy.linspace(0, self.points, min(phases, self.points)+1).astype(numpy.int64)
+        start_ms = 0
+        before = self.elapsed_features(-1)
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            points = int(stop - start)
+            after = self.elapsed_features(int(stop)-1)
+            travel_ms = model.cost(0, *(end-begin for end, begin in zip(after, before)), multiplier, lase_time)
+            rows.append((int(start), int(stop)-1, start_ms, points*lase_time, points*model.overhead_ms, travel_ms))
+            start_ms += points*(lase_time+model.overhead_ms) + travel_ms
+            before = after
+        return rows
+    
+    def timeline_text(self, multiplier, lase_time, phases=10, model=None):
+        """Human readable timeline, one line per phase and a total."""
+        lines = ["Phase  Points            Start     Lase      Overhead  Travel"]
+        for number, (first, last, start_ms, lase_ms, overhead_ms, travel_ms) in enumerate(self.timeline(multiplier, lase_time, phases, model)):
+            lines.append("%-6d %-17s %s  %s  %s  %s" % (number+1, "%d-%d" % (first, last), Job_Stats.time_string(start_ms),
+                         Job_Stats.time_string(lase_ms), Job_Stats.time_string(overhead_ms), Job_Stats.time_string(travel_ms)))
+        lines.append("Total run time " + Job_Stats.time_string(self.total_ms(multiplier, lase_time, model)))
+        return "\n".join(lines)
+    
+    def time_string(time_ms):
+        """Formats milliseconds as HH:MM:SS."""
+        min, sec = divmod(time_ms/1000, 60)
+        hour, min = divmod(min, 60)
+        return "%02d:%02d:%02d" % (hour, min, sec)
 #
 
-import platform
-import glob
-import serial
+import os
 import struct
+class Binary_Job(object):
+    """Compact job file opened as a read only memory map. Header with multiplier, point count and bounds, followed by packed uint16 x,y pairs."""
+    magic = b'EJB1'
+    header = struct.Struct('<4sHIHHHH')  # magic, multiplier, points, min x, min y, max x, max y
+    point_dtype = numpy.dtype([('x', '<u2'), ('y', '<u2')])
+    
+    def __init__(self, filename):
+        with open(filename, 'rb') as job_file:
+            fields = self.header.unpack(job_file.read(self.header.size))
+        if fields[0] != self.magic:
+            raise Exception("Not a binary job file: ", filename)
+        self.filename = filename
+        self.multiplier = fields[1]
+        points = fields[2]
+        self.bounds = fields[3:]
+        if points:
+            self.data = numpy.memmap(filename, dtype=self.point_dtype, mode='r', offset=self.header.size, shape=(points,))
+        else:
+            self.data = numpy.zeros(0, dtype=self.point_dtype)
+        #Zero copy strided views into the memory map
+        self.x = self.data['x']
+        self.y = self.data['y']
+    
+    def __len__(self):
+        return len(self.data)
+    
+    def is_binary_job(filename):
+        """True if the file at filename starts with the binary job magic bytes."""
+        try:
+            with open(filename, 'rb') as job_file:
+                return job_file.read(len(Binary_Job.magic)) == Binary_Job.magic
+        except OSError:
+            return False
+    
+    def write(filename, x_cords, y_cords, multiplier=1):
+        """Saves x, y arrays as a binary job file. Positions must fit 16 bits, they are not wrapped."""
+        x_cords = numpy.asarray(x_cords)
+        y_cords = numpy.asarray(y_cords)
+        if len(x_cords) and (min(x_cords.min(), y_cords.min()) < 0 or max(x_cords.max(), y_cords.max()) > 65535):
+            raise Exception("Position out of range for a job: ", filename)
+        data = numpy.empty(len(x_cords), dtype=Binary_Job.point_dtype)
+        data['x'] = x_cords
+        data['y'] = y_cords
+        if len(data):
+            bounds = int(data['x'].min()), int(data['y'].min()), int(data['x'].max()), int(data['y'].max())
+        else:
+            bounds = 0, 0, 0, 0
+        with Pic_To_Gcode.atomic_file(filename, 'wb') as job_file:
+            job_file.write(Binary_Job.header.pack(Binary_Job.magic, multiplier, len(data), *bounds))
+            job_file.write(data.tobytes())
+    
+    def from_text(text_filename, job_filename, multiplier=1):
+        """Converts a text G-code file into a binary job file."""
+        with open(text_filename, 'r', encoding='utf-8') as text_file:
+            x_cords, y_cords = Interpreter(1).decode_script(text_file.read())
+        Binary_Job.write(job_filename, x_cords, y_cords, multiplier)
+    
+    def to_text(self, text_filename):
+        """Converts this job into a text G-code file."""
+        ptg = Pic_To_Gcode()
+        ptg.write_gcode(ptg.gcode_chunks(self.x, self.y), text_filename)
+#
+class Job(object):
+    """Immutable loaded job, shared without copies by the interpreter, both previews and the runner. Points are packed
+    uint16 x, y pairs, 4 bytes a point, memory mapped when opened from a binary job. x and y are read only column views
+    of the pairs, bounds is (min x, min y, max x, max y) and stats the Job_Stats worked out once on load."""
+    __slots__ = ('name', 'multiplier', 'data', 'x', 'y', 'bounds', 'stats')
+    
+    def __init__(self, data, multiplier=1, name=None):
+        """data is an array of Binary_Job.point_dtype, kept as is."""
+        data = data.view()
+        data.flags.writeable = False
+        if len(data):
+            bounds = int(data['x'].min()), int(data['y'].min()), int(data['x'].max()), int(data['y'].max())
+        else:
+            bounds = 0, 0, 0, 0
+        for slot, value in zip(self.__slots__, (name, multiplier, data, data['x'], data['y'], bounds, Job_Stats(data['x'], data['y']))):
+            object.__setattr__(self, slot, value)
+    
+    def __setattr__(self, name, value):
+        raise Exception("Job is read only: ", name)
+    
+    def from_positions(x_cords, y_cords, multiplier=1, name=None):
+        """Packs x, y arrays into a Job."""
+        x_cords = numpy.asarray(x_cords)
+        y_cords = numpy.asarray(y_cords)
+        if len(x_cords) and (min(x_cords.min(), y_cords.min()) < 0 or max(x_cords.max(), y_cords.max()) > 65535):
+            raise Exception("Position out of range for a job: ", name)
+        data = numpy.empty(len(x_cords), dtype=Binary_Job.point_dtype)
+        data['x'] = x_cords
+        data['y'] = y_cords
+        return Job(data, multiplier, name)
+    
+    def from_file(filename):
+        """Opens a binary job, memory mapped, or parses a text G-code file."""
+        if Binary_Job.is_binary_job(filename):
+            binary_job = Binary_Job(filename)
+            return Job(binary_job.data, binary_job.multiplier, filename)
+        with open(filename, 'r', encoding='utf-8') as text_file:
+            x_cords, y_cords = Interpreter(1).decode_script(text_file.read())
+        return Job.from_positions(x_cords, y_cords, 1, filename)
+    
+    def __len__(self):
+        return len(self.data)
+    
+    def __iter__(self):
+        """Yields (x, y) int tuples, unscaled."""
+        for start in range(0, len(self.data), 65536):
+            yield from zip(self.x[start:start+65536].tolist(), self.y[start:start+65536].tolist())
+    
+    def pairs(self, start=0, stop=None):
+        """Points start to stop-1 as a read only (n, 2) uint16 view."""
+        return self.data[start:stop].view(numpy.uint16).reshape(-1, 2)
+    
+    def nbytes(self):
+        """Bytes of memory held by the job, points and statistics."""
+        return self.data.nbytes + sum(blocks.nbytes for blocks in (self.stats.block_steps, self.stats.block_roots, self.stats.block_moves))
+    
+    def save(self, filename, multiplier=None):
+        """Writes the job as a binary job file, with its own multiplier unless one is given."""
+        Binary_Job.write(filename, self.x, self.y, self.multiplier if multiplier is None else multiplier)
+#
+
+import time
+import json
+import csv
+class Telemetry(object):
+    """Opt-in per point timing of a job, in perf_counter seconds. Senders only record when one is attached,
+    so a job without telemetry pays a None check per point. Percentiles cover the last window points."""
+    window = 1024
+    columns = ('sent', 'written', 'replied', 'flush', 'displayed')
+    
+    def __init__(self, points):
+        self.points = points
+        self.started = time.perf_counter()
+        for column in self.columns:
+            setattr(self, column, numpy.full(points, numpy.nan))
+        self.ok = numpy.zeros(points, dtype=bool)
+        #Next index for send_positions, which has no index of its own
+        self.count = 0
+        self.first = None
+        #Replies come in order, every point below done has one
+        self.done = 0
+        self.shown = -1
+        #(first, last) spans each holding one reply that went missing in a pipelined run, see record_lost
+        self.lost = []
+    
+    def record_send(self, index, sent, written, flush=0):
+        """Frame for index started at sent after flush seconds of flushInput, and was written at written."""
+        if self.first == None:
+            self.first = index
+            self.shown = index-1
+        self.sent[index] = sent
+        self.written[index] = written
+        self.flush[index] = flush
+        self.count = index+1
+    
+    def record_reply(self, index, replied, ok):
+        self.replied[index] = replied
+        self.ok[index] = ok
+        self.done = index+1
+    
+    def record_lost(self, first, last):
+        """One reply recorded as bad was really lost somewhere in points first to last. Pipelined replies carry no index,
+        so later ones shifted onto older frames and the point that lost its reply cannot be told apart."""
+        self.lost.append((first, last))
+    
+    def record_displayed(self, index, moment):
+        """The UI showed every point up to index at moment."""
+        if index > self.shown:
+            self.displayed[self.shown+1:index+1] = moment
+            self.shown = index
+    
+    def latencies(self, start=0, stop=None):
+        """Round trip, write, flush and UI latency arrays in milliseconds for points start to stop-1."""
+        span = slice(start, stop)
+        return {'round_trip': (self.replied[span]-self.sent[span])*1000,
+                'write': (self.written[span]-self.sent[span])*1000,
+                'flush': self.flush[span]*1000,
+                'ui': (self.displayed[span]-self.replied[span])*1000}
+    
+    def summary(self, rolling=True):
+        """p50, p95 and p99 of each latency in milliseconds and points per second, over the last window points or the whole job."""
+        first = self.first if self.first != None else 0
+        start = max(first, self.done-self.window) if rolling else first
+        result = {'points': self.done-first, 'errors': int(numpy.count_nonzero(~self.ok[first:self.done]))}
+        if self.lost:
+            result['lost_replies'] = [list(span) for span in self.lost]
+        for name, values in self.latencies(start, self.done).items():
+            values = values[~numpy.isnan(values)]
+            if len(values):
+                result[name] = dict(zip(('p50', 'p95', 'p99'), (float(value) for value in numpy.percentile(values, (50, 95, 99)))))
+        replied = self.replied[start:self.done]
+        if len(replied) > 1 and replied[-1] > replied[0]:
+            result['points_per_second'] = float((len(replied)-1)/(replied[-1]-replied[0]))
+        return result
+    
+    def export(self, filename):
+        """Writes per point times in milliseconds from the start of recording, JSON if filename ends in .json else CSV."""
+        first = self.first if self.first != None else 0
+        columns = [(self.__dict__[column][first:self.done]-self.started)*1000 for column in self.columns]
+        columns[3] = self.flush[first:self.done]*1000
+        rows = zip(range(first, self.done), *[column.tolist() for column in columns], self.ok[first:self.done].tolist())
+        header = ('index',) + tuple(column+'_ms' for column in self.columns) + ('ok',)
+        if filename.lower().endswith('.json'):
+            with open(filename, 'w') as file:
+                json.dump({'summary': self.summary(False), 'columns': header,
+                           'points': [[None if value != value else value for value in row] for row in rows]}, file)
+        else:
+            with open(filename, 'w', newline='') as file:
+                writer = csv.writer(file)
+                writer.writerow(header)
+                writer.writerows(('' if value != value else value for value in row) for row in rows)
+#
+
+class Time_Profiles(object):
+    """Time_Model fits per machine, usually the port name. Each machine keeps the summed least squares normal equations
+    in a JSON file, so every logged run adds to its fit without keeping old run data."""
+    min_samples = 100
+    
+    def __init__(self, filename=os.path.join("resource", "time_profiles.json")):
+        self.filename = filename
+        try:
+            with open(filename) as file:
+                self.profiles = json.load(file)
+        except (OSError, ValueError):
+            self.profiles = {}
+    
+    def add_run(self, machine, telemetry, x_cords, y_cords, multiplier, lase_time):
+        """Adds the point times measured by telemetry for a run of x, y arrays and saves. Returns the samples used."""
+        first = telemetry.first if telemetry.first != None else 0
+        done = telemetry.done
+        if done - first < 2:
+            return 0
+        #A point takes from the previous reply to its own, which also counts pipelining and UI gaps
+        replied = telemetry.replied[first:done]
+        durations = (replied - numpy.concatenate(([telemetry.sent[first]], replied[:-1])))*1000 - lase_time
+        x_cords = numpy.asarray(x_cords[max(first-1, 0):done], dtype=numpy.int64)
+        y_cords = numpy.asarray(y_cords[max(first-1, 0):done], dtype=numpy.int64)
+        if first == 0:
+            x_cords = numpy.concatenate(([0], x_cords))
+            y_cords = numpy.concatenate(([0], y_cords))
+        steps = numpy.maximum(numpy.abs(numpy.diff(x_cords)), numpy.abs(numpy.diff(y_cords)))*multiplier
+        keep = telemetry.ok[first:done] & numpy.isfinite(durations)
+        features = Time_Model.features(steps)
+        #Pauses and timeouts are not machine time, drop points far off a first fit
+        model = Time_Model.from_normal_equations(features[keep].T @ features[keep], features[keep].T @ durations[keep])
+        residuals = numpy.abs(model.point_ms(steps, 0) - durations)
+        keep &= residuals <= 10*numpy.median(residuals[keep]) + 50
+        profile = self.profiles.setdefault(machine, {'xtx': numpy.zeros((4, 4)).tolist(), 'xty': [0.0]*4, 'samples': 0})
+        profile['xtx'] = (numpy.asarray(profile['xtx']) + features[keep].T @ features[keep]).tolist()
+        profile['xty'] = (numpy.asarray(profile['xty']) + features[keep].T @ durations[keep]).tolist()
+        profile['samples'] += int(numpy.count_nonzero(keep))
+        self.save()
+        return int(numpy.count_nonzero(keep))
+    
+    def model_for(self, machine):
+        """Fitted Time_Model for machine, None until it has min_samples points."""
+        profile = self.profiles.get(machine)
+        if profile == None or profile['samples'] < self.min_samples:
+            return None
+        return Time_Model.from_normal_equations(profile['xtx'], profile['xty'])
+    
+    def reset(self, machine):
+        self.profiles.pop(machine, None)
+        self.save()
+    
+    def save(self):
+        with open(self.filename, 'w') as file:
+            json.dump(self.profiles, file)
+#
+
+from threading import Thread
+serial = Lazy_Module("serial")
+list_ports = Lazy_Module("serial.tools.list_ports")
 class Serial_Manager(object):
     """Coordinates communication with Thomas Wilson's 2D laser engraver firmware."""
+    #Firmware frame is 'x' + 3 hex chars + 'y' + 3 hex chars, every 3 char value pre-encoded
+    hex_table = [b'%03x' % value for value in range(4096)]
+    hex_array = numpy.frombuffer(b''.join(hex_table), dtype=numpy.uint8).reshape(4096, 3)
+    frame_size = 8
+    
     def __init__(self, serial_port=False):
+        #Optional Telemetry, send_positions records into it
+        self.telemetry = None
         if serial_port:
             self.connect(serial_port)
     
-    def connect(self, serial_port):
-        self.ser = serial.Serial(serial_port, 9600, timeout=5)
+    def connect(self, serial_port, baudrate=9600, timeout=5):
+        """Opens serial_port, a COM port or device path such as a firmware_sim.py pty."""
+        self.ser = serial.Serial(serial_port, baudrate, timeout=timeout)
         
     def list_serial_ports():
-        """Lists available serial ports. Praise Stack-Overflow."""
-        system_name = platform.system()
-        if system_name == "Windows":
-            # Scan for available ports.
-            available = []
-            for i in range(0, 256):
-                try:
-                    s = serial.Serial(i)
-                    available.append(i+1)
-                    s.close()
-                except serial.SerialException:
-                    pass
-            return available
-        elif system_name == "Darwin":
-            # Mac
-            return glob.glob('/dev/tty*') + glob.glob('/dev/cu*')
-        else:
-            # Assume Linux or something else
-            return  glob.glob('/dev/ttyUSB*')# + glob.glob('/dev/ttyS*')
+        """Lists available serial port device names, as the OS reports them, without opening any."""
+        return sorted(port.device for port in list_ports.comports())
         
     def close_connection(self):
         """Closes serial port connection."""
@@ -126,98 +621,1001 @@ class Serial_Manager(object):
         while len(hex_num) < 3:
             hex_num = '0' + hex_num
         return hex_num
+    
+    def encode_frame(self, positions):
+        """Returns the firmware frame for an x,y cord, e.g. b'x00ay02a'."""
+        return b'x' + self.hex_table[positions[0]] + b'y' + self.hex_table[positions[1]]
+    
+    def encode_frames(self, x_cords, y_cords, multiplier=1):
+        """Returns the frames for x, y arrays as one bytes object, frame_size bytes per point."""
+        x_cords = numpy.asarray(x_cords, dtype=numpy.int64)*multiplier
+        y_cords = numpy.asarray(y_cords, dtype=numpy.int64)*multiplier
+        out_of_range = (x_cords < 0) | (x_cords > 4095) | (y_cords < 0) | (y_cords > 4095)
+        if out_of_range.any():
+            raise Exception("Position out of firmware range at point: ", int(numpy.argmax(out_of_range)))
+        frames = numpy.empty((len(x_cords), self.frame_size), dtype=numpy.uint8)
+        frames[:, 0] = ord('x')
+        frames[:, 1:4] = self.hex_array[x_cords]
+        frames[:, 4] = ord('y')
+        frames[:, 5:8] = self.hex_array[y_cords]
+        return frames.tobytes()
         
     def send_positions(self, positions):
-        """Transmits given x,y cord to the 2D laser engraver."""
+        """Transmits given x,y cord to the 2D laser engraver and waits for OK."""
         if positions == False:
             return
-        sent=''
-        hex = self.int_to_3hex(positions[0])
-        sent+='x'
-        self.ser.write(struct.pack('B', ord('x')))
-        for char in hex:
-            sent+=char
-            self.ser.write(struct.pack('B', ord(char)))
-        hex = self.int_to_3hex(positions[1])
-        sent+='y'
-        self.ser.write(struct.pack('B', ord('y')))
-        for char in hex:
-            sent+=char
-            self.ser.write(struct.pack('B', ord(char)))
-        #print(sent)  # Debug string
+        if self.telemetry != None:
+            return self.__send_recorded(positions)
+        #Flush before writing, a fast reply could arrive before a flush done after the write
         self.ser.flushInput()
+        self.ser.write(self.encode_frame(positions))
         if self.ser.readline() == b'OK\r\n':
             self.ser.flushInput()
             return True
         else:
             return False
+    
+    def __send_recorded(self, positions):
+        """send_positions with every stage timed into self.telemetry."""
+        index = self.telemetry.count
+        sent = time.perf_counter()
+        self.ser.flushInput()
+        flushed = time.perf_counter()
+        self.ser.write(self.encode_frame(positions))
+        self.telemetry.record_send(index, sent, time.perf_counter(), flushed-sent)
+        ok = self.ser.readline() == b'OK\r\n'
+        self.telemetry.record_reply(index, time.perf_counter(), ok)
+        if ok:
+            self.ser.flushInput()
+        return ok
+#
+class Port_Finder(object):
+    """Runs Serial_Manager.list_serial_ports() on a background thread so a window never waits for the OS.
+    ports keeps the last list, None until the first scan ends, and scans counts finished scans for pollers."""
+    def __init__(self):
+        self.ports = None
+        self.scans = 0
+        self.error = None
+        self.thread = None
+
+    def refresh(self):
+        """Starts a scan unless one is running and returns at once."""
+        if not self.scanning():
+            self.thread = Thread(target=self.__scan, daemon=True)
+            self.thread.start()
+
+    def scanning(self):
+        return self.thread != None and self.thread.is_alive()
+
+    def __scan(self):
+        try:
+            ports = Serial_Manager.list_serial_ports()
+            self.error = None
+        except Exception as error:
+            ports = []
+            self.error = error
+        self.ports = ports
+        self.scans += 1
 #
 
-from PIL import Image
+import contextlib
+import math
+import uuid
+Image = Lazy_Module("PIL.Image")
+class Band_Reader(object):
+    """Reads horizontal bands of a picture file. Files Pillow lays out as raw rows (BMP, PPM, TGA, uncompressed TIFF)
+    are read band by band from disk, so memory does not grow with the picture height. Other formats are decoded once."""
+    def __init__(self, filename):
+        self.image = Image.open(filename)
+        self.size = self.image.size
+        self.mode = self.image.mode
+        self.raw_tiles = self.__raw_tiles()
+        self.filename = filename
+    
+    def __raw_tiles(self):
+        """(top, bottom, offset, rawmode, stride, ystep) for every tile if all are full width raw rows, else None."""
+        tiles = []
+        for tile in self.image.tile:
+            codec, extents, offset, args = tile[0], tile[1], tile[2], tile[3]
+            if codec != 'raw' or extents[0] != 0 or extents[2] != self.size[0]:
+                return None
+            if isinstance(args, str):
+                args = (args, 0, 1)
+            rawmode, stride, ystep = (tuple(args) + (0, 1))[:3]
+            try:
+                row_bytes = len(Image.new(self.mode, (self.size[0], 1)).tobytes('raw', rawmode))
+            except Exception:
+                return None
+            if stride == 0:
+                stride = row_bytes
+            tiles.append((extents[1], extents[3], offset, rawmode, stride, ystep))
+        return tiles or None
+    
+    def bands(self, band_rows):
+        """Yields (top, Image) for bands of band_rows rows, top band first."""
+        if self.raw_tiles is None:
+            self.image.load()
+            for top in range(0, self.size[1], band_rows):
+                yield top, self.image.crop((0, top, self.size[0], min(top+band_rows, self.size[1])))
+            return
+        with open(self.filename, 'rb') as picture_file:
+            for top in range(0, self.size[1], band_rows):
+                yield top, self.__read_band(picture_file, top, min(top+band_rows, self.size[1]))
+    
+    def __read_band(self, picture_file, top, bottom):
+        band = Image.new(self.mode, (self.size[0], bottom-top))
+        for tile_top, tile_bottom, offset, rawmode, stride, ystep in self.raw_tiles:
+            first, last = max(top, tile_top), min(bottom, tile_bottom)
+            if first >= last:
+                continue
+            #Bottom up files store the last row first
+            if ystep < 0:
+                picture_file.seek(offset + (tile_bottom - last)*stride)
+            else:
+                picture_file.seek(offset + (first - tile_top)*stride)
+            data = picture_file.read((last-first)*stride)
+            band.paste(Image.frombuffer(self.mode, (self.size[0], last-first), data, 'raw', rawmode, stride, ystep), (0, first-top))
+        if self.mode == 'P':
+            band.putpalette(self.image.palette)
+        band.info = dict(self.image.info)
+        return band
+#
 class Pic_To_Gcode(object):
     """Collection of functions for conditioning and converting PIL Image's into G-code."""
+    band_rows = 256
+    #Default output folders, relative to the working directory
+    pictures_dir = "pictures"
+    gcode_dir = "G code"
+    dither_modes = ('floyd-steinberg', 'threshold', 'bayer2', 'bayer4', 'bayer8', 'bayer16', 'blue-noise')
+    #Void and cluster mask, built on first use
+    blue_noise = None
+    blue_noise_size = 64
+    
+    def __init__(self, path_optimizer=None, cache=None, dither='floyd-steinberg', density=None, tiled=False, contour_tracer=None):
+        #Optional Path_Optimizer run between conversion and output
+        self.path_optimizer = path_optimizer
+        #Optional Contour_Tracer, engraves outlines only and takes the place of path_optimizer
+        self.contour_tracer = contour_tracer
+        #One of dither_modes, density is the wanted fraction of black dots or None for the picture's own tone
+        self.dither = dither
+        self.density = density
+        #Optional Conversion_Cache, cache_hit tells if the last conversion came from it
+        self.cache = cache
+        self.cache_hit = False
+        #Read and condition pictures band by band, see condition_file_tiled
+        self.tiled = tiled
+    
     def convert_file(self, filename, size):
         """Loads image at filename and returns G-code string containing all x,y cords."""
-        im = Image.open(filename).convert('RGBA')
-        im = self.condition_image(im, size)
-        im.save(".\pictures\B&W - " + filename.split('\\')[-1])
-        return self.convert_PIL_image(im)
-    
-    def condition_image(self, image, size):
-        """Conditions image for further processing."""
-        image.thumbnail(size, Image.ANTIALIAS)
-        #White all transparent areas
-        pixel_map = image.load()
-        for x in range(0, image.size[0]):
-            for y in range(0, image.size[1]):
-                if pixel_map[x, y][3] < 10:
-                    image.putpixel((x, y), (255, 255, 255, 0))
-        return image.convert('1')
+        return self.convert_PIL_image(self.load_conditioned(filename, size))
+    
+    def load_conditioned(self, filename, size, pictures_dir=None):
+        """Loads image at filename, conditions it and saves the black and white copy in pictures_dir."""
+        im = self.conditioned(filename, size)
+        self.save_conditioned(im, filename, pictures_dir)
+        return im
+    
+    def conditioned(self, filename, size):
+        """Conditioned image of the picture at filename, read whole or in bands by self.tiled."""
+        if self.tiled:
+            return self.condition_file_tiled(filename, size)
+        return self.condition_image(Image.open(filename).convert('RGBA'), size)
+    
+    def save_conditioned(self, im, filename, pictures_dir=None):
+        """Saves the black and white copy of the picture at filename in pictures_dir."""
+        if pictures_dir is None:
+            pictures_dir = self.pictures_dir
+        b_w_file_name = os.path.join(pictures_dir, "B&W - " + os.path.basename(filename))
+        image_format = Image.registered_extensions().get(os.path.splitext(filename)[1].lower(), 'PNG')
+        with Pic_To_Gcode.atomic_file(b_w_file_name, 'wb') as b_w_file_handle:
+            im.save(b_w_file_handle, image_format)
+    
+    def conditioned_positions(self, filename, size):
+        """Conditioned image and x, y arrays of the picture at filename, reordered by path_optimizer if set.
+        Served from cache when it holds the same pixels, size and parameters."""
+        source = None
+        if not self.tiled:
+            source = Image.open(filename).convert('RGBA')
+        self.cache_hit = False
+        if self.cache is not None:
+            if source is None:
+                #Hashing band by band gives the same key as the whole picture
+                reader = Band_Reader(filename)
+                bands = (band.convert('RGBA') for top, band in reader.bands(self.band_rows))
+                key = self.cache.key_bands('RGBA', reader.size, bands, size, **self.conversion_parameters())
+            else:
+                key = self.cache.key(source, size, **self.conversion_parameters())
+            cached = self.cache.get(key)
+            if cached is not None:
+                im, x_cords, y_cords, info = cached
+                self.cache_hit = True
+                for name, value in info.items():
+                    setattr(self.path_stats(), name, value)
+                return im, x_cords, y_cords
+        if source is None:
+            im = self.condition_file_tiled(filename, size)
+        else:
+            im = self.condition_image(source, size)
+        x_cords, y_cords = self.optimized_positions(im)
+        if self.cache is not None:
+            info = {}
+            if self.path_stats() is not None:
+                names = ('points_before', 'points_after', 'steps_before', 'steps_after', 'polylines')
+                info = {name: int(getattr(self.path_stats(), name)) for name in names if hasattr(self.path_stats(), name)}
+            self.cache.put(key, im, x_cords, y_cords, info)
+        return im, x_cords, y_cords
+    
+    def conversion_parameters(self):
+        """Every setting besides pixels and size that changes the conversion output, for cache keys."""
+        path = self.path_optimizer.mode if self.path_optimizer is not None else 'raster'
+        if self.contour_tracer is not None:
+            path = 'contour'
+        return {'path': path, 'dither': self.dither, 'density': self.density}
+    
+    def path_stats(self):
+        """The contour_tracer or path_optimizer whose step counts describe the last conversion, None for plain raster."""
+        if self.contour_tracer is not None:
+            return self.contour_tracer
+        return self.path_optimizer
+    
+    def condition_image(self, image, size, threshold=None):
+        """Conditions image for further processing. Dithers to black and white with self.dither, or cuts at threshold if given."""
+        image = self.flatten_alpha(image)
+        image.thumbnail(size, Image.LANCZOS)
+        if threshold is not None:
+            return image.point(lambda value: 255 if value >= threshold else 0, '1')
+        if self.dither == 'floyd-steinberg':
+            return self.density_image(image).convert('1')
+        return Image.fromarray(~self.dither_array(self.darkness(image)))
+    
+    def condition_file_tiled(self, filename, size, threshold=None):
+        """Same result as condition_image on the whole picture at filename, reading it band_rows rows at a time.
+        Bands are flattened and box reduced as they arrive, as thumbnail does, so memory is bounded by the target size
+        rather than the picture's. Floyd-Steinberg carries its error from band to band so there are no seams."""
+        reader = Band_Reader(filename)
+        width, height = reader.size
+        final_size = Pic_To_Gcode.thumbnail_size(reader.size, size)
+        #thumbnail first reduces by whole factors that leave at least twice the final size
+        factor_x, factor_y = 1, 1
+        if final_size != reader.size:
+            factor_x = int(width/final_size[0]/2) or 1
+            factor_y = int(height/final_size[1]/2) or 1
+        #Whole reduction blocks per band, so reducing bands matches reducing the picture
+        band_rows = -(-self.band_rows//factor_y)*factor_y
+        image = Image.new('L', (-(-width//factor_x), -(-height//factor_y)))
+        for top, band in reader.bands(band_rows):
+            band = self.flatten_alpha(band.convert('RGBA'))
+            if factor_x > 1 or factor_y > 1:
+                band = band.reduce((factor_x, factor_y))
+            image.paste(band, (0, top//factor_y))
+        if final_size != reader.size:
+            image = image.resize(final_size, Image.LANCZOS, box=(0, 0, width/factor_x, height/factor_y))
+        if threshold is not None:
+            return image.point(lambda value: 255 if value >= threshold else 0, '1')
+        if self.dither == 'floyd-steinberg':
+            image = self.density_image(image)
+            im = Image.new('1', image.size)
+            carried = numpy.zeros(image.size[0]+1, dtype=numpy.int64)
+            for top in range(0, image.size[1], self.band_rows):
+                band = numpy.asarray(image.crop((0, top, image.size[0], min(top+self.band_rows, image.size[1]))))
+                black, carried = Pic_To_Gcode.diffuse_band(band, carried)
+                im.paste(Image.fromarray(~black), (0, top))
+            return im
+        return Image.fromarray(~self.dither_array(self.darkness(image)))
+    
+    def thumbnail_size(source_size, size):
+        """Size thumbnail gives a picture of source_size for a maximum of size, rounded the same way."""
+        x, y = int(size[0]), int(size[1])
+        width, height = source_size
+        if x >= width and y >= height:
+            return tuple(source_size)
+        aspect = width/height
+        if x/y >= aspect:
+            candidates = (math.floor(y*aspect), math.ceil(y*aspect))
+            x = max(min(candidates, key=lambda n: abs(aspect - n/y)), 1)
+        else:
+            candidates = (math.floor(x/aspect), math.ceil(x/aspect))
+            y = max(min(candidates, key=lambda n: 0 if n == 0 else abs(aspect - x/n)), 1)
+        return x, y
+    
+    def diffuse_band(pixels, carried):
+        """Floyd-Steinberg dithers a uint8 array of rows with the integer arithmetic of Pillow's convert('1').
+        carried is the error flowing into the band's first row, one value per column plus one, zeros for the first band.
+        Returns (boolean array of black dots, error carried into the next band)."""
+        height, width = pixels.shape
+        levels = pixels.astype(numpy.int64)
+        #Error left at each pixel, padded by a column each side
+        errors = numpy.zeros((height, width+2), dtype=numpy.int64)
+        black = numpy.zeros((height, width), dtype=bool)
+        #A pixel needs the pixel left of it and three above, so pixels on each line x + 2y = step are independent
+        for step in range(width + 2*(height-1)):
+            rows = numpy.arange(max(0, (step-width+2)//2), min(height-1, step//2)+1)
+            columns = step - 2*rows
+            above = numpy.empty(len(rows), dtype=numpy.int64)
+            first = rows == 0
+            if first[0]:
+                above[0] = carried[columns[0]+1]
+            rest = ~first
+            above_rows, above_columns = rows[rest]-1, columns[rest]
+            above[rest] = 3*errors[above_rows, above_columns+2] + 5*errors[above_rows, above_columns+1] + errors[above_rows, above_columns]
+            total = 7*errors[rows, columns] + above
+            #Pillow divides by 16 rounding toward zero
+            total = numpy.where(total < 0, -((-total) >> 4), total >> 4)
+            level = numpy.clip(levels[rows, columns] + total, 0, 255)
+            white = level > 128
+            black[rows, columns] = ~white
+            errors[rows, columns+1] = level - 255*white
+        last = numpy.concatenate(([0], errors[height-1]))
+        return black, 3*last[2:width+3] + 5*last[1:width+2] + last[0:width+1]
+    
+    def density_image(self, image):
+        """'L' image with its darkness scaled to self.density, unchanged if density is None."""
+        if self.density is None:
+            return image
+        return Image.fromarray(255 - numpy.round(self.scale_darkness(self.darkness(image), self.density)*255).astype(numpy.uint8))
+    
+    def darkness(self, image):
+        """'L' image as a float32 array, 0 for white to 1 for black."""
+        return 1 - numpy.asarray(image, dtype=numpy.float32)/255
+    
+    def dither_array(self, darkness):
+        """Boolean array of black dots for a darkness array, by self.dither and self.density. Every mode compares
+        darkness against a threshold mask, so the wanted density is hit by scaling darkness against the mask."""
+        if self.dither == 'threshold':
+            mask = numpy.full((1, 1), 0.5, dtype=numpy.float32)
+        elif self.dither == 'blue-noise':
+            mask = Pic_To_Gcode.blue_noise_mask()
+        elif self.dither.startswith('bayer'):
+            mask = Pic_To_Gcode.bayer_matrix(int(self.dither[5:]))
+        else:
+            raise Exception("Unknown dither mode: ", self.dither)
+        rows = numpy.arange(darkness.shape[0]) % mask.shape[0]
+        columns = numpy.arange(darkness.shape[1]) % mask.shape[1]
+        tiled = mask[numpy.ix_(rows, columns)]
+        if self.density is None:
+            return darkness > tiled
+        #Black where darkness/mask passes a cut; the cut is the quantile giving the wanted share of dots. White never burns
+        ratio = darkness/tiled
+        inked = ratio[darkness > 0]
+        dots = min(int(round(self.density*darkness.size)), len(inked))
+        if dots == 0:
+            return numpy.zeros(darkness.shape, dtype=bool)
+        cut = numpy.partition(inked, len(inked)-dots)[len(inked)-dots]
+        return ratio >= cut
+    
+    def scale_darkness(self, darkness, density):
+        """Darkness multiplied by the gain, clipped at 1, that makes its mean density. Error diffusion keeps the mean tone."""
+        ordered = numpy.sort(darkness, axis=None).astype(numpy.float64)
+        sums = numpy.concatenate(([0], numpy.cumsum(ordered)))
+        def mean_tone(gain):
+            #Pixels darker than 1/gain clip to full black
+            clipped = len(ordered) - numpy.searchsorted(ordered, 1/gain)
+            return (sums[len(ordered)-clipped]*gain + clipped)/len(ordered)
+        low, high = 0.0, 1.0
+        while mean_tone(high) < density and high < 2**20:
+            high *= 2
+        for _ in range(50):
+            middle = (low+high)/2
+            if mean_tone(middle) < density:
+                low = middle
+            else:
+                high = middle
+        return numpy.minimum(darkness*high, 1)
+    
+    def bayer_matrix(size):
+        """Ordered dither thresholds for a power of two size, values evenly spread in (0, 1)."""
+        matrix = numpy.zeros((1, 1), dtype=numpy.int64)
+        while matrix.shape[0] < size:
+            matrix = numpy.block([[4*matrix, 4*matrix+2], [4*matrix+3, 4*matrix+1]])
+        return ((matrix + 0.5)/matrix.size).astype(numpy.float32)
+    
+    def blue_noise_mask():
+        """Tileable blue noise thresholds in (0, 1) by Ulichney's void and cluster method, built once per process."""
+        if Pic_To_Gcode.blue_noise is not None:
+            return Pic_To_Gcode.blue_noise
+        size = Pic_To_Gcode.blue_noise_size
+        #Wrapped Gaussian, rolled onto a pixel it is that pixel's contribution to the energy of every other
+        offsets = numpy.minimum(numpy.arange(size), size - numpy.arange(size))
+        kernel = numpy.exp(-(offsets[:, None]**2 + offsets[None, :]**2)/(2*1.5**2))
+        def energy_of(pattern):
+            return numpy.real(numpy.fft.ifft2(numpy.fft.fft2(pattern)*numpy.fft.fft2(kernel)))
+        random = numpy.random.RandomState(0)
+        pattern = (random.random_sample((size, size)) < 0.1).astype(numpy.float64)
+        energy = energy_of(pattern)
+        #Move the tightest cluster into the largest void until they are the same pixel
+        while True:
+            cluster = numpy.unravel_index(numpy.argmax(numpy.where(pattern == 1, energy, -numpy.inf)), pattern.shape)
+            pattern[cluster] = 0
+            energy -= numpy.roll(kernel, cluster, (0, 1))
+            void = numpy.unravel_index(numpy.argmin(numpy.where(pattern == 0, energy, numpy.inf)), pattern.shape)
+            pattern[void] = 1
+            energy += numpy.roll(kernel, void, (0, 1))
+            if void == cluster:
+                break
+        ranks = numpy.zeros((size, size), dtype=numpy.int64)
+        ones = int(pattern.sum())
+        #Ranks below the starting pattern come from removing clusters, ranks above from filling voids
+        removing, removing_energy = pattern.copy(), energy.copy()
+        for rank in range(ones-1, -1, -1):
+            cluster = numpy.unravel_index(numpy.argmax(numpy.where(removing == 1, removing_energy, -numpy.inf)), pattern.shape)
+            removing[cluster] = 0
+            removing_energy -= numpy.roll(kernel, cluster, (0, 1))
+            ranks[cluster] = rank
+        for rank in range(ones, size*size):
+            void = numpy.unravel_index(numpy.argmin(numpy.where(pattern == 0, energy, numpy.inf)), pattern.shape)
+            pattern[void] = 1
+            energy += numpy.roll(kernel, void, (0, 1))
+            ranks[void] = rank
+        Pic_To_Gcode.blue_noise = ((ranks + 0.5)/ranks.size).astype(numpy.float32)
+        return Pic_To_Gcode.blue_noise
+    
+    def dot_estimate(self, filename, size, multiplier=1, lase_time=100, model=None):
+        """Conditions the picture at filename without saving anything. Returns (dots, estimated run time in ms)."""
+        im = self.conditioned(filename, size)
+        x_cords, y_cords = self.optimized_positions(im)
+        return len(x_cords), Job_Stats(x_cords, y_cords).total_ms(multiplier, lase_time, model)
+    
+    def flatten_alpha(self, image):
+        """Composites image onto white and returns it in 'L' mode. Nearly transparent areas (alpha < 10) become pure white."""
+        if 'A' not in image.getbands():
+            return image.convert('L')
+        alpha = image.getchannel('A').point(lambda value: 0 if value < 10 else value)
+        white = Image.new('L', image.size, 255)
+        return Image.composite(image.convert('L'), white, alpha)
     
     def image_size(self, filename):
         """Finds size of image at filename."""
         im = Image.open(filename)
         return im.size
     
-    def convert_file_save_in_folder(self, filename, size, save_dir):
-        """Load, convert and save G-code from image file."""
-        g_code = self.convert_file(filename, size)
-        g_code_file_name = save_dir+"G code - " + filename.split('\\')[-1].split('.')[0] + ".txt"
-        g_code_file_handle = open(g_code_file_name, 'w')
-        g_code_file_handle.write(g_code)
-        g_code_file_handle.close()
+    def convert_file_save_in_folder(self, filename, size, save_dir=None, pictures_dir=None):
+        """Load, convert and stream G-code from image file into save_dir. Returns the G-code file name."""
+        if save_dir is None:
+            save_dir = self.gcode_dir
+        g_code_file_name = os.path.join(save_dir, "G code - " + os.path.splitext(os.path.basename(filename))[0] + ".txt")
+        if self.cache is not None:
+            im, x_cords, y_cords = self.conditioned_positions(filename, size)
+            self.save_conditioned(im, filename, pictures_dir)
+            self.write_gcode(self.gcode_chunks(x_cords, y_cords), g_code_file_name)
+            return g_code_file_name
+        im = self.load_conditioned(filename, size, pictures_dir)
+        if self.path_stats() is None:
+            self.write_gcode(self.gcode_lines(im), g_code_file_name)
+        else:
+            self.write_gcode(self.gcode_chunks(*self.optimized_positions(im)), g_code_file_name)
+        return g_code_file_name
+    
+    def write_gcode(self, lines, filename, buffer_size=65536):
+        """Writes an iterable of G-code text to filename through a write buffer of buffer_size bytes.
+        The file only appears under filename once complete."""
+        with Pic_To_Gcode.atomic_file(filename, 'w', buffering=buffer_size) as g_code_file_handle:
+            g_code_file_handle.writelines(lines)
+    
+    @contextlib.contextmanager
+    def atomic_file(filename, mode='w', **kwargs):
+        """Opens a temporary file beside filename and renames it over filename on success, removes it on error."""
+        #Unique per process and call so parallel conversions never share a temporary file
+        temp_name = "%s.%s.part" % (filename, uuid.uuid4().hex[:12])
+        try:
+            with open(temp_name, mode.replace('w', 'x'), **kwargs) as file:
+                yield file
+            os.replace(temp_name, filename)
+        except BaseException:
+            try:
+                os.remove(temp_name)
+            except OSError:
+                pass
+            raise
     
     def convert_PIL_image(self, im):
         """Returns a G-code string containing all x,y cords."""
-        #Record pixel locations
-        pixel_map = im.load()
-        script = []
-        for y in range(0, im.size[1]):
-            y_val = im.size[1] - y - 1
-            if y%2==0:
-                for x in range(0, im.size[0]):
-                    if pixel_map[x, y_val] < 10:
-                        script.append([x, y])
-            else:
-                for x in range(im.size[0]-1, -1, -1):
-                    if pixel_map[x, y_val] < 10:
-                        script.append([x, y])
-        #Find minimum values
-        min_x = im.size[0]
-        min_y = im.size[1]
-        for cords in script:
-            x, y = cords
-            if x < min_x:
-                min_x = x
-            if y < min_y:
-                min_y = y
+        return self.format_gcode(*self.optimized_positions(im))
+    
+    def optimized_positions(self, im):
+        """raster_positions, reordered by path_optimizer if one is set, or the outline by contour_tracer if set."""
+        x_cords, y_cords = self.raster_positions(im)
+        if self.contour_tracer is not None:
+            return self.contour_tracer.positions(self.black_pixels(im), x_cords, y_cords)
+        if self.path_optimizer is None:
+            return x_cords, y_cords
+        return self.path_optimizer.optimize(x_cords, y_cords)
+    
+    def raster_positions(self, im):
+        """Returns x, y arrays of black pixel locations in serpentine row order, moved by minimum values."""
+        #Row 0 of the script is the bottom row of the image, odd rows run right to left
+        black = self.black_pixels(im)[::-1].copy()
+        black[1::2] = black[1::2, ::-1]
+        y_cords, x_cords = numpy.nonzero(black)
+        odd = (y_cords & 1).astype(bool)
+        x_cords[odd] = im.size[0] - 1 - x_cords[odd]
         #Move all values by minimum
-        for cords in script:
-            cords[0] = cords[0] - min_x
-            cords[1] = cords[1] - min_y
-        #Create text representation
-        g_code = ""
-        for cords in script:
-            g_code += 'x'+str(cords[0])+" y"+str(cords[1])+'\n'
-        return g_code
-    
\ No newline at end of file
+        if len(x_cords):
+            x_cords -= x_cords.min()
+            y_cords -= y_cords.min()
+        return x_cords, y_cords
+    
+    def black_pixels(self, im, top=0, bottom=None):
+        """Returns boolean array marking the black pixels of image rows top to bottom."""
+        if bottom is None:
+            bottom = im.size[1]
+        if top != 0 or bottom != im.size[1]:
+            im = im.crop((0, top, im.size[0], bottom))
+        pixels = numpy.asarray(im)
+        if pixels.dtype == numpy.bool_:
+            return ~pixels
+        return pixels < 10
+    
+    def black_bands(self, im):
+        """Yields (top, black_pixels) for bands of band_rows image rows, bottom band first."""
+        for bottom in range(im.size[1], 0, -self.band_rows):
+            top = max(bottom - self.band_rows, 0)
+            yield top, self.black_pixels(im, top, bottom)
+    
+    def black_bounds(self, im):
+        """Bounding box prepass, returns minimum x and minimum script row of black pixels. None if image is blank."""
+        min_x = None
+        min_y = None
+        for top, black in self.black_bands(im):
+            columns = numpy.flatnonzero(black.any(axis=0))
+            if len(columns) == 0:
+                continue
+            if min_x is None or columns[0] < min_x:
+                min_x = int(columns[0])
+            if min_y is None:
+                rows = numpy.flatnonzero(black.any(axis=1))
+                min_y = im.size[1] - 1 - (top + int(rows[-1]))
+        if min_x is None:
+            return None
+        return min_x, min_y
+    
+    def gcode_lines(self, im):
+        """Yields G-code text one script row at a time. Same output as convert_PIL_image, holding one band of pixels."""
+        bounds = self.black_bounds(im)
+        if bounds is None:
+            return
+        min_x, min_y = bounds
+        for top, black in self.black_bands(im):
+            for row in range(len(black)-1, -1, -1):
+                y = im.size[1] - 1 - (top + row)
+                x_cords = numpy.flatnonzero(black[row])
+                if len(x_cords) == 0:
+                    continue
+                if y%2 == 1:
+                    x_cords = x_cords[::-1]
+                line = 'x%d y' + str(y - min_y) + '\n'
+                yield (line*len(x_cords)) % tuple((x_cords - min_x).tolist())
+    
+    def gcode_chunks(self, x_cords, y_cords, chunk=65536):
+        """Yields the text representation of x, y arrays, chunk points at a time."""
+        for start in range(0, len(x_cords), chunk):
+            yield self.format_gcode(x_cords[start:start+chunk], y_cords[start:start+chunk])
+    
+    def format_gcode(self, x_cords, y_cords):
+        """Creates text representation of x, y arrays, one 'xN yN' line per point."""
+        pairs = numpy.empty(2*len(x_cords), dtype=numpy.int64)
+        pairs[0::2] = x_cords
+        pairs[1::2] = y_cords
+        return ('x%d y%d\n'*len(x_cords)) % tuple(pairs.tolist())
+#
+
+import hashlib
+class Conversion_Cache(object):
+    """On disk cache of conversions, keyed by a hash of the source pixels, target size and conversion parameters.
+    An entry is the conditioned image as PNG, the positions as a binary job and a JSON file of their digests, checked on every hit.
+    Least recently used entries are evicted once the cache grows past max_bytes."""
+    #Bump when conversion output changes so old entries stop matching
+    version = 1
+    
+    def __init__(self, cache_dir="cache", max_bytes=512*2**20):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self.corrupt = 0
+        self.evictions = 0
+    
+    def key(self, image, size, **parameters):
+        """Hex digest of image pixels, size and parameters."""
+        return self.key_bands(image.mode, image.size, [image], size, **parameters)
+    
+    def key_bands(self, mode, image_size, bands, size, **parameters):
+        """key of a picture given as an iterable of horizontal band images, top band first."""
+        digest = hashlib.sha256(repr((self.version, mode, tuple(image_size), tuple(size), sorted(parameters.items()))).encode())
+        for band in bands:
+            digest.update(band.tobytes())
+        return digest.hexdigest()
+    
+    def paths(self, key):
+        """Image, job and digest file names of an entry. The digest file is written last and marks a complete entry."""
+        return tuple(os.path.join(self.cache_dir, key + extension) for extension in ('.png', '.ejb', '.json'))
+    
+    def file_digest(filename):
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as file:
+            for block in iter(lambda: file.read(2**20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+    
+    def get(self, key):
+        """Returns (conditioned image, x array, y array, info dict) or None. Entries that fail their digest check are removed."""
+        image_name, job_name, meta_name = self.paths(key)
+        if not os.path.exists(meta_name):
+            self.misses += 1
+            return None
+        try:
+            with open(meta_name) as meta_file:
+                meta = json.load(meta_file)
+            if Conversion_Cache.file_digest(image_name) != meta['image'] or Conversion_Cache.file_digest(job_name) != meta['job']:
+                raise Exception("Cache entry failed its digest check: ", key)
+            im = Image.open(image_name)
+            im.load()
+            job = Binary_Job(job_name)
+            #Copies, so the entry can be evicted while the arrays are in use
+            x_cords = numpy.array(job.x, dtype=numpy.int64)
+            y_cords = numpy.array(job.y, dtype=numpy.int64)
+            del job
+        except Exception:
+            self.corrupt += 1
+            self.misses += 1
+            self.remove(key)
+            return None
+        #Modification time of the digest file orders entries for eviction
+        os.utime(meta_name)
+        self.hits += 1
+        return im, x_cords, y_cords, meta['info']
+    
+    def put(self, key, im, x_cords, y_cords, info=None):
+        """Stores a conversion then evicts down to max_bytes."""
+        image_name, job_name, meta_name = self.paths(key)
+        with Pic_To_Gcode.atomic_file(image_name, 'wb') as image_file:
+            im.save(image_file, 'PNG')
+        Binary_Job.write(job_name, x_cords, y_cords)
+        meta = {'image': Conversion_Cache.file_digest(image_name), 'job': Conversion_Cache.file_digest(job_name), 'info': info or {}}
+        with Pic_To_Gcode.atomic_file(meta_name, 'w') as meta_file:
+            json.dump(meta, meta_file)
+        self.evict()
+    
+    def remove(self, key):
+        for filename in self.paths(key):
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+    
+    def entries(self):
+        """(last use, bytes, key) of every complete entry."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            key, extension = os.path.splitext(name)
+            if extension != '.json':
+                continue
+            try:
+                used = os.path.getmtime(os.path.join(self.cache_dir, name))
+                size = sum(os.path.getsize(filename) for filename in self.paths(key))
+            except OSError:
+                #Removed by another process meanwhile
+                continue
+            entries.append((used, size, key))
+        return entries
+    
+    def evict(self):
+        """Removes least recently used entries until the cache fits in max_bytes."""
+        entries = sorted(self.entries())
+        total = sum(size for used, size, key in entries)
+        for used, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            self.remove(key)
+            total -= size
+            self.evictions += 1
+    
+    def clear(self):
+        for used, size, key in self.entries():
+            self.remove(key)
+    
+    def stats(self):
+        """Hit and miss counts of this instance, plus entries and bytes on disk."""
+        entries = self.entries()
+        lookups = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'corrupt': self.corrupt, 'evictions': self.evictions,
+                'hit_rate': self.hits/lookups if lookups else 0, 'entries': len(entries), 'bytes': sum(size for used, size, key in entries)}
+#
+
+class Grid_Index(object):
+    """Bucket grid over x, y points for nearest point queries with removal. Distances are Chebyshev, like the motors."""
+    def __init__(self, x_cords, y_cords):
+        self.x_cords = numpy.asarray(x_cords).tolist()
+        self.y_cords = numpy.asarray(y_cords).tolist()
+        span = max(int(numpy.max(x_cords)), int(numpy.max(y_cords)), 1) if len(x_cords) else 1
+        #About two points per cell
+        self.cell = max(1, int(span/max(len(x_cords)/2, 1)**0.5))
+        self.cells = {}
+        for index, key in enumerate(zip([x//self.cell for x in self.x_cords], [y//self.cell for y in self.y_cords])):
+            self.cells.setdefault(key, []).append(index)
+        self.max_ring = span//self.cell + 1
+        #Points not yet removed
+        self.count = len(self.x_cords)
+    
+    def __len__(self):
+        return self.count
+    
+    def pop_nearest(self, x, y):
+        """Removes and returns the index of the point nearest to x, y. None when empty."""
+        if not self.cells:
+            return None
+        centre_x = x//self.cell
+        centre_y = y//self.cell
+        best = None
+        best_dist = None
+        scanned = 0
+        for ring in range(0, self.max_ring+1):
+            if scanned > len(self.cells):
+                #Few occupied cells left, checking them all is cheaper than more empty rings
+                keys = list(self.cells)
+            elif ring == 0:
+                keys = [(centre_x, centre_y)]
+            else:
+                keys = [(centre_x+dx, centre_y+dy) for dx in range(-ring, ring+1) for dy in (-ring, ring)]
+                keys += [(centre_x+dx, centre_y+dy) for dx in (-ring, ring) for dy in range(-ring+1, ring)]
+            scanned += len(keys)
+            for key in keys:
+                for index in self.cells.get(key, ()):
+                    dist = max(abs(self.x_cords[index]-x), abs(self.y_cords[index]-y))
+                    if best_dist is None or dist < best_dist:
+                        best, best_dist = (key, index), dist
+            #Nothing in the next ring can be closer than ring*cell+1
+            if best is not None and (best_dist <= ring*self.cell or scanned > len(self.cells)):
+                break
+        key, index = best
+        self.cells[key].remove(index)
+        if not self.cells[key]:
+            del self.cells[key]
+        self.count -= 1
+        return index
+    
+    def remove(self, index):
+        """Removes the point at index."""
+        key = (self.x_cords[index]//self.cell, self.y_cords[index]//self.cell)
+        self.cells[key].remove(index)
+        if not self.cells[key]:
+            del self.cells[key]
+        self.count -= 1
+#
+
+class Path_Optimizer(object):
+    """Reorders converted x, y arrays to cut travel between points, run between conversion and output.
+    Modes: 'raster' leaves the order, 'rows' skips empty rows and enters each row from the nearer end,
+    'islands' rasters each 8-connected island in turn, nearest island next, and 'nearest' visits the
+    nearest point next then refines with 2-opt. Work stops at the time budget (seconds)."""
+    modes = ('raster', 'rows', 'islands', 'nearest')
+    
+    def __init__(self, mode='rows', time_budget=5.0):
+        if mode not in self.modes:
+            raise Exception("Unknown path optimization mode: ", mode)
+        self.mode = mode
+        self.time_budget = time_budget
+        self.steps_before = 0
+        self.steps_after = 0
+    
+    def optimize(self, x_cords, y_cords):
+        """Returns reordered x, y arrays. Steps before and after are kept in steps_before and steps_after."""
+        x_cords = numpy.asarray(x_cords, dtype=numpy.int64)
+        y_cords = numpy.asarray(y_cords, dtype=numpy.int64)
+        self.deadline = time.perf_counter() + self.time_budget
+        self.steps_before = Interpreter.estimate_positions(x_cords, y_cords)[1]
+        if self.mode == 'raster' or len(x_cords) < 3:
+            order = numpy.arange(len(x_cords))
+        elif self.mode == 'rows':
+            order = self.row_order(x_cords, y_cords, numpy.arange(len(x_cords)), (0, 0))
+        elif self.mode == 'islands':
+            order = self.island_order(x_cords, y_cords)
+        else:
+            order = self.two_opt(x_cords, y_cords, self.nearest_order(x_cords, y_cords))
+        self.steps_after = Interpreter.estimate_positions(x_cords[order], y_cords[order])[1]
+        if self.steps_after > self.steps_before:
+            #Greedy ordering lost to the input order, dense dithering can do that
+            self.steps_after = self.steps_before
+            return x_cords, y_cords
+        return x_cords[order], y_cords[order]
+    
+    def row_order(self, x_cords, y_cords, indexes, start):
+        """Orders indexes row by row from the end row nearer to start, each row entered from its nearer end."""
+        indexes = indexes[numpy.lexsort((x_cords[indexes], y_cords[indexes]))]
+        rows = numpy.flatnonzero(numpy.diff(y_cords[indexes])) + 1
+        bounds = list(zip(numpy.concatenate(([0], rows)).tolist(), numpy.concatenate((rows, [len(indexes)])).tolist()))
+        first, last = indexes[0], indexes[-1]
+        if abs(int(y_cords[last])-start[1]) < abs(int(y_cords[first])-start[1]):
+            bounds.reverse()
+        pieces = []
+        x, y = start
+        for row_start, row_end in bounds:
+            row = indexes[row_start:row_end]
+            row_y = int(y_cords[row[0]])
+            if max(abs(int(x_cords[row[-1]])-x), abs(row_y-y)) < max(abs(int(x_cords[row[0]])-x), abs(row_y-y)):
+                row = row[::-1]
+            pieces.append(row)
+            x, y = int(x_cords[row[-1]]), row_y
+        return numpy.concatenate(pieces)
+    
+    def label_islands(self, x_cords, y_cords):
+        """Returns an island number per point, points touching on a side or corner share a number."""
+        count = len(x_cords)
+        #Padded by one column and row so neighbour lookups off either edge find -1
+        grid = numpy.full((int(y_cords.max())+2, int(x_cords.max())+2), -1, dtype=numpy.int32)
+        grid[y_cords, x_cords] = numpy.arange(count)
+        first = []
+        second = []
+        for dx, dy in ((1, 0), (0, 1), (1, 1), (-1, 1)):
+            neighbours = grid[y_cords+dy, x_cords+dx]
+            linked = neighbours >= 0
+            first.append(numpy.flatnonzero(linked))
+            second.append(neighbours[linked])
+        first = numpy.concatenate(first)
+        second = numpy.concatenate(second).astype(numpy.int64)
+        #Union find on whole arrays: hook larger roots onto smaller ones, then jump pointers to the roots
+        parent = numpy.arange(count)
+        while True:
+            root_first = parent[first]
+            root_second = parent[second]
+            differ = root_first != root_second
+            if not differ.any():
+                break
+            numpy.minimum.at(parent, numpy.maximum(root_first, root_second)[differ], numpy.minimum(root_first, root_second)[differ])
+            while True:
+                jumped = parent[parent]
+                if numpy.array_equal(jumped, parent):
+                    break
+                parent = jumped
+        return numpy.unique(parent, return_inverse=True)[1]
+    
+    def island_order(self, x_cords, y_cords):
+        """Rasters each island in turn, the next island being the one whose corner point is nearest."""
+        labels = self.label_islands(x_cords, y_cords)
+        by_island = numpy.argsort(labels, kind='stable')
+        island_bounds = numpy.flatnonzero(numpy.diff(labels[by_island])) + 1
+        islands = numpy.split(by_island, island_bounds)
+        #First point of each island stands for it, a corner when the input is in raster order
+        corners = numpy.array([island[0] for island in islands])
+        index = Grid_Index(x_cords[corners], y_cords[corners])
+        pieces = []
+        position = (0, 0)
+        while len(index):
+            if time.perf_counter() > self.deadline:
+                #Out of time, keep the remaining islands in raster order
+                remaining = numpy.concatenate([islands[island_num] for cell in index.cells.values() for island_num in cell])
+                pieces.append(numpy.sort(remaining))
+                break
+            island = islands[index.pop_nearest(*position)]
+            if len(island) > 1:
+                island = self.row_order(x_cords, y_cords, island, position)
+            pieces.append(island)
+            position = int(x_cords[island[-1]]), int(y_cords[island[-1]])
+        return numpy.concatenate(pieces)
+    
+    def nearest_order(self, x_cords, y_cords):
+        """Greedy nearest next point from 0, 0. Points left at the time budget keep raster order."""
+        index = Grid_Index(x_cords, y_cords)
+        order = []
+        position = (0, 0)
+        while len(index):
+            if len(order) % 1024 == 0 and time.perf_counter() > self.deadline:
+                visited = numpy.zeros(len(x_cords), dtype=bool)
+                visited[order] = True
+                return numpy.concatenate((numpy.array(order, dtype=numpy.int64), numpy.flatnonzero(~visited)))
+            point = index.pop_nearest(*position)
+            order.append(point)
+            position = int(x_cords[point]), int(y_cords[point])
+        return numpy.array(order, dtype=numpy.int64)
+    
+    def two_opt(self, x_cords, y_cords, order, window=48):
+        """Reverses stretches of the open path starting at 0, 0 while that shortens it, looking window points
+        ahead of each point, until no move helps or the time budget runs out."""
+        order = order.tolist()
+        xs = x_cords[order].tolist()
+        ys = y_cords[order].tolist()
+        count = len(order)
+        improved = True
+        while improved and time.perf_counter() < self.deadline:
+            improved = False
+            for i in range(-1, count-2):
+                if i % 256 == 0 and time.perf_counter() > self.deadline:
+                    break
+                a_x, a_y = (xs[i], ys[i]) if i >= 0 else (0, 0)
+                for j in range(i+2, min(count, i+window)):
+                    b_x, b_y = xs[i+1], ys[i+1]
+                    #Edges a->b and c->d become a->c and b->d, the last point has no d
+                    c_x, c_y = xs[j], ys[j]
+                    old = max(abs(a_x-b_x), abs(a_y-b_y))
+                    new = max(abs(a_x-c_x), abs(a_y-c_y))
+                    if j+1 < count:
+                        old += max(abs(c_x-xs[j+1]), abs(c_y-ys[j+1]))
+                        new += max(abs(b_x-xs[j+1]), abs(b_y-ys[j+1]))
+                    if new < old:
+                        xs[i+1:j+1] = xs[i+1:j+1][::-1]
+                        ys[i+1:j+1] = ys[i+1:j+1][::-1]
+                        order[i+1:j+1] = order[i+1:j+1][::-1]
+                        improved = True
+        return numpy.array(order, dtype=numpy.int64)
+#
+class Contour_Tracer(object):
+    """Outline conversion for line art. Keeps the black pixels on the edge of each shape, those with a white or outside
+    pixel above, below, left or right, and chains them into polylines of touching pixels. Each polyline starts at the
+    free edge pixel nearest the end of the last one and follows the neighbour with the fewest free neighbours, so it
+    runs along the edge. Points and steps before (raster) and after are kept, as Interpreter.estimator counts them."""
+    #Neighbour offsets as (column, row), clockwise from the right
+    directions = ((1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1))
+    
+    def __init__(self):
+        self.points_before = 0
+        self.points_after = 0
+        self.steps_before = 0
+        self.steps_after = 0
+        self.polylines = 0
+    
+    def edges(self, black):
+        """Boolean array of the edge pixels of a boolean array of black pixels."""
+        padded = numpy.pad(black, 1)
+        inside = padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:]
+        return black & ~inside
+    
+    def positions(self, black, raster_x=None, raster_y=None):
+        """x, y arrays of the traced outline of a boolean array of black pixels, in script terms like
+        Pic_To_Gcode.raster_positions. raster_x, raster_y give the raster positions for the before counts."""
+        height = black.shape[0]
+        rows, columns = numpy.nonzero(self.edges(black))
+        x_cords, y_cords = self.trace(columns, height - 1 - rows)
+        if len(x_cords):
+            #Edges hold the extreme black pixels, so this is the raster offset too
+            x_cords -= x_cords.min()
+            y_cords -= y_cords.min()
+        if raster_x is not None:
+            self.points_before, self.steps_before = Interpreter.estimate_positions(raster_x, raster_y)[:2]
+        self.points_after, self.steps_after = Interpreter.estimate_positions(x_cords, y_cords)[:2]
+        return x_cords, y_cords
+    
+    def trace(self, x_cords, y_cords):
+        """Orders edge pixels x, y into polylines from 0, 0. Returns the reordered x, y arrays."""
+        count = len(x_cords)
+        self.polylines = 0
+        if count == 0:
+            return numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype=numpy.int64)
+        x_cords = numpy.asarray(x_cords, dtype=numpy.int64)
+        y_cords = numpy.asarray(y_cords, dtype=numpy.int64)
+        #Point number per pixel on a flat grid padded by one, -1 where there is none or it is used
+        width = int(x_cords.max()) + 3
+        grid = numpy.full((int(y_cords.max())+3)*width, -1, dtype=numpy.int64)
+        cells = (y_cords+1)*width + x_cords + 1
+        grid[cells] = numpy.arange(count)
+        grid = grid.tolist()
+        cells = cells.tolist()
+        offsets = [dy*width + dx for dx, dy in self.directions]
+        index = Grid_Index(x_cords, y_cords)
+        order = []
+        position = (0, 0)
+        while len(index):
+            point = index.pop_nearest(*position)
+            self.polylines += 1
+            direction = 0
+            while point is not None:
+                order.append(point)
+                cell = cells[point]
+                grid[cell] = -1
+                #Free neighbours, trying the current direction first
+                best = None
+                for turn in range(8):
+                    heading = (direction + turn) % 8
+                    neighbour = grid[cell + offsets[heading]]
+                    if neighbour < 0:
+                        continue
+                    around = cells[neighbour]
+                    degree = sum(1 for offset in offsets if grid[around + offset] >= 0)
+                    if best is None or degree < best[0]:
+                        best = (degree, neighbour, heading)
+                point = None
+                if best is not None:
+                    point, direction = best[1], best[2]
+                    index.remove(point)
+            position = int(x_cords[order[-1]]), int(y_cords[order[-1]])
+        order = numpy.array(order, dtype=numpy.int64)
+        return x_cords[order], y_cords[order]
@@ -0,0 +1,168 @@
+# Copyright (C) 2015  Thomas Wilson, email:supertwilson@Sourceforge.net
+#
+#    This module is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License Version 3 as published by
+#    the Free Software Foundation see <http://www.gnu.org/licenses/>.
+#
+#firmware_sim.py
+#Stand-in for the 2D laser engraver firmware on a Linux pseudo-terminal.
+#Run with: python firmware_sim.py [--lase-ms N] [--step-ms N] [--baud N] [--drop-rate P] [--garble-rate P]
+
+
+import os
+import sys
+import time
+import random
+import select
+import argparse
+from threading import Thread, Event
+
+
+class Firmware_Simulator(Thread):
+    """Opens a pty and answers 'xHHHyHHH' frames with 'OK\\r\\n' after a simulated move and lase.
+    Point to port_name with Serial_Manager.connect. Times are in milliseconds, time_scale 0 answers instantly."""
+    def __init__(self, lase_ms=0, step_ms=0, baud=9600, time_scale=1.0, drop_rate=0, garble_rate=0, seed=0):
+        super().__init__()
+        self.daemon = True
+        self.lase_ms = lase_ms
+        self.step_ms = step_ms
+        self.baud = baud
+        self.time_scale = time_scale
+        self.drop_rate = drop_rate
+        self.garble_rate = garble_rate
+        self.random = random.Random(seed)
+        self.master_fd, self.slave_fd = os.openpty()
+        self.port_name = os.ttyname(self.slave_fd)
+        self.stop_event = Event()
+        self.position = (0, 0)
+        self.frames = 0
+        self.replies = 0
+        self.dropped = 0
+        self.garbled = 0
+        self.bad_bytes = 0
+        self.received = []
+        #Full duplex line model: when the receive line, the motors and the transmit line are next free
+        self.rx_free = 0
+        self.busy_until = 0
+        self.tx_free = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def stop(self):
+        """Stops answering and closes the pty."""
+        self.stop_event.set()
+        if self.is_alive():
+            self.join()
+        for fd in (self.master_fd, self.slave_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def byte_time(self, count):
+        """Seconds to move count bytes at the simulated baud rate, 10 bits per byte."""
+        if self.baud == 0:
+            return 0
+        return count*10/self.baud
+
+    def frame_time(self, position):
+        """Seconds the firmware spends moving to position and lasing."""
+        steps = max(abs(position[0]-self.position[0]), abs(position[1]-self.position[1]))
+        return (self.lase_ms + steps*self.step_ms)/1000
+
+    def reply(self):
+        """Reply bytes for a frame, with fault injection. None drops the reply."""
+        chance = self.random.random()
+        if chance < self.drop_rate:
+            self.dropped += 1
+            return None
+        if chance < self.drop_rate + self.garble_rate:
+            self.garbled += 1
+            return self.random.choice((b'O\r\n', b'KO\r\n', b'OK\n', b'\x00\xff\r\n'))
+        return b'OK\r\n'
+
+    def sleep_until(self, moment):
+        """Sleeps until moment on the simulated clock, which runs time_scale times as fast as perf_counter."""
+        delay = (moment - self.clock())*self.time_scale
+        if delay > 0:
+            time.sleep(delay)
+
+    def clock(self):
+        if self.time_scale == 0:
+            return 0
+        return time.perf_counter()/self.time_scale
+
+    def run(self):
+        buffer = b''
+        while not self.stop_event.is_set():
+            try:
+                readable = select.select([self.master_fd], [], [], 0.05)[0]
+                if not readable:
+                    continue
+                data = os.read(self.master_fd, 4096)
+            except OSError:
+                break
+            self.rx_free = max(self.rx_free, self.clock())
+            buffer += data
+            while len(buffer) >= 8:
+                #Resynchronise on the next 'x' like the firmware does
+                start = buffer.find(b'x')
+                if start < 0:
+                    self.bad_bytes += len(buffer)
+                    buffer = b''
+                    break
+                self.bad_bytes += start
+                buffer = buffer[start:]
+                if len(buffer) < 8:
+                    break
+                frame, buffer = buffer[:8], buffer[8:]
+                #Frame bytes arrive at line speed while the previous frame may still be running
+                self.rx_free += self.byte_time(len(frame))
+                try:
+                    if frame[4:5] != b'y':
+                        raise ValueError
+                    position = int(frame[1:4], 16), int(frame[5:8], 16)
+                except ValueError:
+                    self.bad_bytes += 1
+                    buffer = frame[1:] + buffer
+                    continue
+                self.frames += 1
+                self.received.append(position)
+                self.busy_until = max(self.busy_until, self.rx_free) + self.frame_time(position)
+                self.position = position
+                reply = self.reply()
+                if reply is not None:
+                    self.tx_free = max(self.tx_free, self.busy_until) + self.byte_time(len(reply))
+                    self.sleep_until(self.tx_free)
+                    try:
+                        os.write(self.master_fd, reply)
+                    except OSError:
+                        return
+                    self.replies += 1
+#
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="2D laser engraver firmware simulator on a pseudo-terminal.")
+    parser.add_argument("--lase-ms", type=float, default=100, help="lase time per point")
+    parser.add_argument("--step-ms", type=float, default=1, help="motor time per step")
+    parser.add_argument("--baud", type=int, default=9600, help="simulated baud rate, 0 for no throttling")
+    parser.add_argument("--time-scale", type=float, default=1.0, help="multiplies every simulated delay")
+    parser.add_argument("--drop-rate", type=float, default=0, help="chance of not replying to a frame")
+    parser.add_argument("--garble-rate", type=float, default=0, help="chance of a corrupted reply")
+    args = parser.parse_args()
+    simulator = Firmware_Simulator(args.lase_ms, args.step_ms, args.baud, args.time_scale, args.drop_rate, args.garble_rate)
+    simulator.start()
+    print("Simulated engraver on", simulator.port_name)
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        simulator.stop()
+        print("frames:", simulator.frames, "replies:", simulator.replies, "dropped:", simulator.dropped, "garbled:", simulator.garbled)
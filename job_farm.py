@@ -0,0 +1,250 @@
+# Copyright (C) 2015  Thomas Wilson, email:supertwilson@Sourceforge.net
+#
+#    This module is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License Version 3 as published by
+#    the Free Software Foundation see <http://www.gnu.org/licenses/>.
+#
+#job_farm.py
+#Runs a queue of jobs across a bench of identical engravers, one Job_Runner per port.
+#Run with: python job_farm.py job.txt|job.ejb [...] --ports PORT [PORT ...] [--tiles CxR] [--window N]
+
+
+import sys
+import time
+import asyncio
+import argparse
+import numpy
+from threading import Thread
+from engraver_lib import Job
+from job_runner import Job_Runner, Async_Serial, Dry_Run_Transport
+
+
+class Farm_Job(object):
+    """One queued job. A tile of a sharded job keeps the origin of its tile so the pieces can be put back together."""
+    def __init__(self, name, x_cords, y_cords, multiplier=1, origin=(0, 0)):
+        self.name = name
+        self.x_cords = x_cords
+        self.y_cords = y_cords
+        self.multiplier = multiplier
+        self.origin = origin
+        self.attempts = 0
+        #'queued', 'running', 'done' or 'failed'
+        self.state = 'queued'
+        self.machine = None
+#
+class Machine(object):
+    """Health and throughput of one engraver. After max_failures failed jobs in a row it is taken offline
+    for retry_interval seconds, then given another job as a probe."""
+    def __init__(self, port):
+        self.port = port
+        #'idle', 'busy' or 'offline'
+        self.state = 'idle'
+        self.runner = None
+        self.jobs_done = 0
+        self.failures = 0
+        self.failures_in_row = 0
+        self.offline_until = 0
+        self.points = 0
+        self.busy_seconds = 0
+        self.last_error = None
+
+    def points_per_second(self):
+        if self.busy_seconds == 0:
+            return 0
+        return self.points/self.busy_seconds
+#
+class Job_Farm(object):
+    """Dispatches queued Farm_Job's to the first free healthy Machine, each with its own transport.
+    A job that fails, or whose runner fails itself on its max_errors'th bad reply, is requeued whole up to
+    max_attempts times, since a half engraved piece cannot move to another machine. Jobs aborted by stop() are not."""
+    max_attempts = 3
+    max_errors = 10
+    max_failures = 2
+    retry_interval = 30
+
+    def __init__(self, ports, window=1, transport_factory=Async_Serial):
+        self.machines = [Machine(port) for port in ports]
+        self.window = window
+        self.transport_factory = transport_factory
+        self.jobs = []
+        self.loop = None
+        self.stopping = False
+        self.started = None
+        self.finished = None
+
+    def add_job(self, name, x_cords, y_cords, multiplier=1, origin=(0, 0)):
+        """Queues a job, before or while the farm runs. Not thread safe, call from the farm loop once it runs."""
+        job = Farm_Job(name, x_cords, y_cords, multiplier, origin)
+        self.jobs.append(job)
+        if self.loop != None:
+            self.queue.put_nowait(job)
+        return job
+
+    def add_tiled_job(self, name, x_cords, y_cords, columns, rows, multiplier=1):
+        """Shards a job into columns by rows tiles that run on separate machines in parallel. Returns the tile jobs."""
+        return [self.add_job("%s tile %d" % (name, number+1), tile_x, tile_y, multiplier, origin)
+                for number, (tile_x, tile_y, origin) in enumerate(Job_Farm.shard(x_cords, y_cords, columns, rows))]
+
+    def shard(x_cords, y_cords, columns, rows):
+        """Splits x, y arrays into a grid of tiles over their bounds, keeping point order inside each tile.
+        Returns (x, y, origin) per non empty tile, row by row, with coordinates relative to the tile origin."""
+        x_cords = numpy.asarray(x_cords, dtype=numpy.int64)
+        y_cords = numpy.asarray(y_cords, dtype=numpy.int64)
+        if len(x_cords) == 0:
+            return []
+        left, bottom = int(x_cords.min()), int(y_cords.min())
+        width = -(-(int(x_cords.max())-left+1)//columns)
+        height = -(-(int(y_cords.max())-bottom+1)//rows)
+        tile_ids = ((y_cords-bottom)//height)*columns + (x_cords-left)//width
+        #Stable sort groups tiles without reordering points inside them
+        order = numpy.argsort(tile_ids, kind='stable')
+        ids, starts = numpy.unique(tile_ids[order], return_index=True)
+        tiles = []
+        for tile_id, indexes in zip(ids, numpy.split(order, starts[1:])):
+            origin = (left + int(tile_id % columns)*width, bottom + int(tile_id//columns)*height)
+            tiles.append((x_cords[indexes]-origin[0], y_cords[indexes]-origin[1], origin))
+        return tiles
+
+    def start(self):
+        """Runs the farm on its own event loop thread and returns at once."""
+        self.thread = Thread(target=asyncio.run, args=(self.run(),), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Aborts running jobs and drops the queue. Safe from any thread."""
+        if self.loop != None:
+            self.loop.call_soon_threadsafe(self.__stop)
+
+    def __stop(self):
+        self.stopping = True
+        while not self.queue.empty():
+            self.queue.get_nowait().state = 'failed'
+            self.queue.task_done()
+        for machine in self.machines:
+            if machine.runner != None:
+                machine.runner.abort()
+
+    async def run(self):
+        """Runs every queued job, returns once each is done or out of attempts."""
+        self.loop = asyncio.get_running_loop()
+        self.stopping = False
+        self.queue = asyncio.Queue()
+        for job in self.jobs:
+            if job.state == 'queued':
+                self.queue.put_nowait(job)
+        self.started = time.perf_counter()
+        workers = [asyncio.ensure_future(self.__worker(machine)) for machine in self.machines]
+        try:
+            await self.queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            self.finished = time.perf_counter()
+            self.loop = None
+
+    async def __worker(self, machine):
+        while True:
+            if machine.state == 'offline':
+                await asyncio.sleep(max(0, machine.offline_until - time.perf_counter()))
+                machine.state = 'idle'
+            job = await self.queue.get()
+            job.state = 'running'
+            job.machine = machine.port
+            job.attempts += 1
+            machine.state = 'busy'
+            machine.runner = Job_Runner(job.x_cords, job.y_cords, self.transport_factory(machine.port), job.multiplier, self.window,
+                                        max_errors=self.max_errors)
+            started = time.perf_counter()
+            try:
+                state = await machine.runner.run()
+            finally:
+                machine.busy_seconds += time.perf_counter() - started
+                machine.points += machine.runner.index+1
+            if state == 'done':
+                job.state = 'done'
+                machine.jobs_done += 1
+                machine.failures_in_row = 0
+                machine.state = 'idle'
+            else:
+                machine.last_error = machine.runner.error if machine.runner.error != None else "%d bad replies" % machine.runner.errors
+                machine.failures += 1
+                machine.failures_in_row += 1
+                machine.state = 'idle'
+                if machine.failures_in_row >= self.max_failures:
+                    machine.state = 'offline'
+                    machine.offline_until = time.perf_counter() + self.retry_interval
+                #Only stop() aborts, the error limit fails the run and is retried like any other failure
+                if job.attempts < self.max_attempts and state != 'aborted' and not self.stopping:
+                    job.state = 'queued'
+                    self.queue.put_nowait(job)
+                else:
+                    job.state = 'failed'
+            self.queue.task_done()
+
+    def report(self):
+        """Per machine and aggregate throughput as a dict."""
+        end = self.finished if self.finished != None else time.perf_counter()
+        wall_seconds = end - self.started if self.started != None else 0
+        machines = []
+        points = 0
+        for machine in self.machines:
+            running = 0
+            if machine.state == 'busy' and machine.runner != None:
+                running = machine.runner.index+1
+            points += machine.points + running
+            machines.append({'port': machine.port, 'state': machine.state, 'jobs_done': machine.jobs_done,
+                             'failures': machine.failures, 'points': machine.points + running,
+                             'points_per_second': machine.points_per_second(), 'last_error': str(machine.last_error or '')})
+        states = [job.state for job in self.jobs]
+        return {'machines': machines, 'points': points, 'seconds': wall_seconds,
+                'points_per_second': points/wall_seconds if wall_seconds else 0,
+                'jobs': {state: states.count(state) for state in ('queued', 'running', 'done', 'failed')}}
+
+    def report_text(self):
+        report = self.report()
+        lines = ["%-16s %-8s %5s %8s %10s %9s" % ("Port", "State", "Jobs", "Failures", "Points", "Points/s")]
+        for machine in report['machines']:
+            lines.append("%-16s %-8s %5d %8d %10d %9.1f" % (machine['port'], machine['state'], machine['jobs_done'],
+                         machine['failures'], machine['points'], machine['points_per_second']))
+        jobs = report['jobs']
+        lines.append("Jobs queued %d running %d done %d failed %d, %d points at %.1f points/s" % (jobs['queued'], jobs['running'],
+                     jobs['done'], jobs['failed'], report['points'], report['points_per_second']))
+        return "\n".join(lines)
+#
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Run jobs across several 2D laser engravers at once.")
+    parser.add_argument("jobs", nargs='+', help="G-code .txt or binary .ejb jobs")
+    parser.add_argument("--ports", nargs='+', required=True, help="serial ports of the engravers, or names for a dry run")
+    parser.add_argument("--tiles", help="shard every job into CxR tiles, e.g. 2x2")
+    parser.add_argument("--window", type=int, default=1, help="frames in flight per machine")
+    parser.add_argument("--multiplier", type=int, default=None, help="movement multiplier, binary jobs default to their own")
+    parser.add_argument("--dry-run", type=float, default=None, metavar="TIME_SCALE", help="simulate the machines, 0 is instant")
+    args = parser.parse_args()
+    if args.dry_run != None:
+        farm = Job_Farm(args.ports, args.window, lambda port: Dry_Run_Transport(time_scale=args.dry_run))
+    else:
+        farm = Job_Farm(args.ports, args.window)
+    for filename in args.jobs:
+        job = Job.from_file(filename)
+        x_cords, y_cords, multiplier = job.x, job.y, job.multiplier
+        if args.multiplier != None:
+            multiplier = args.multiplier
+        if args.tiles:
+            columns, rows = (int(value) for value in args.tiles.lower().split('x'))
+            for tile in farm.add_tiled_job(filename, x_cords, y_cords, columns, rows, multiplier):
+                print(tile.name, "at", tile.origin, len(tile.x_cords), "points")
+        else:
+            farm.add_job(filename, x_cords, y_cords, multiplier)
+    farm.start()
+    try:
+        while farm.thread.is_alive():
+            farm.thread.join(2)
+            print(farm.report_text())
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        farm.stop()
+        farm.thread.join()
+        print(farm.report_text())
@@ -0,0 +1,572 @@
+# Copyright (C) 2015  Thomas Wilson, email:supertwilson@Sourceforge.net
+#
+#    This module is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License Version 3 as published by
+#    the Free Software Foundation see <http://www.gnu.org/licenses/>.
+#
+#job_runner.py
+#asyncio job runner shared by the GUI and headless runs.
+#Run with: python job_runner.py job.txt|job.ejb [--port PORT] [--multiplier N] [--window N] [--lase-time MS] [--time-scale S] [--telemetry FILE] [--resume] [--no-journal]
+
+
+import os
+import sys
+import time
+import zlib
+import struct
+import hashlib
+import asyncio
+import argparse
+import numpy
+from collections import deque, namedtuple
+from threading import Thread, Condition
+from engraver_lib import Interpreter, Job_Stats, Time_Model, Time_Profiles, Serial_Manager, Job, Telemetry, Lazy_Module
+serial = Lazy_Module("serial")
+
+
+class Async_Serial(object):
+    """Serial port with an awaitable readline. Frames are short, so writes go straight to pySerial.
+    Reads are driven by the event loop where it can watch the port, else the port is polled."""
+    poll_interval = 0.002
+
+    def __init__(self, serial_port, baudrate=9600, timeout=5):
+        self.serial_port = serial_port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.buffer = b''
+        self.ser = None
+
+    async def open(self):
+        """Opens the port, must be awaited on the loop that will read it."""
+        self.loop = asyncio.get_running_loop()
+        self.ser = serial.Serial(self.serial_port, self.baudrate, timeout=0)
+        self.data_ready = asyncio.Event()
+        try:
+            self.loop.add_reader(self.ser.fileno(), self.__on_readable)
+            self.polling = False
+        except (NotImplementedError, AttributeError, ValueError):
+            self.polling = True
+
+    def __on_readable(self):
+        self.buffer += self.ser.read(max(1, self.ser.in_waiting))
+        self.data_ready.set()
+
+    def write(self, frames):
+        self.ser.write(frames)
+
+    async def readline(self):
+        """Next line including b'\\n', or whatever arrived before timeout like pySerial's readline."""
+        deadline = self.loop.time() + self.timeout
+        while b'\n' not in self.buffer:
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                line, self.buffer = self.buffer, b''
+                return line
+            if self.polling:
+                await asyncio.sleep(min(self.poll_interval, remaining))
+                self.buffer += self.ser.read(self.ser.in_waiting)
+                continue
+            self.data_ready.clear()
+            try:
+                await asyncio.wait_for(self.data_ready.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        line, _, self.buffer = self.buffer.partition(b'\n')
+        return line + b'\n'
+
+    def reset_input(self):
+        """Discards unread replies."""
+        self.ser.reset_input_buffer()
+        self.buffer = b''
+
+    def close(self):
+        if self.ser == None:
+            return
+        if not self.polling:
+            self.loop.remove_reader(self.ser.fileno())
+        self.ser.close()
+#
+class Dry_Run_Transport(object):
+    """Stands in for a serial port when none is selected. Every frame is answered OK after the time model predicts for it,
+    the fixed Job_Stats constants unless a fitted Time_Model is given, multiplied by time_scale. A time_scale of 0 answers instantly."""
+    def __init__(self, lase_time=100, time_scale=1.0, model=None, timeout=5):
+        self.lase_time = lase_time
+        self.time_scale = time_scale
+        self.model = model if model != None else Time_Model(Job_Stats.overhead_ms)
+        self.timeout = timeout
+        #Predicted machine time of every frame answered so far
+        self.predicted_ms = 0
+        self.position = (0, 0)
+
+    async def open(self):
+        self.loop = asyncio.get_running_loop()
+        self.due = deque()
+        self.free = 0
+
+    def write(self, frames):
+        for offset in range(0, len(frames), Serial_Manager.frame_size):
+            #Frames already carry the multiplier, as Time_Model steps do
+            position = int(frames[offset+1:offset+4], 16), int(frames[offset+5:offset+8], 16)
+            steps = max(abs(position[0]-self.position[0]), abs(position[1]-self.position[1]))
+            self.position = position
+            model = self.model
+            frame_ms = self.lase_time + model.overhead_ms + model.step_ms*steps + model.root_ms*steps**0.5 + (model.move_ms if steps else 0)
+            self.free = max(self.free, self.loop.time()) + frame_ms/1000*self.time_scale
+            self.due.append((self.free, frame_ms))
+
+    async def readline(self):
+        if not self.due:
+            await asyncio.sleep(self.timeout)
+            return b''
+        moment, frame_ms = self.due.popleft()
+        #Sleeping 0 still yields, so commands and progress keep flowing at time_scale 0
+        await asyncio.sleep(max(0, moment - self.loop.time()))
+        self.predicted_ms += frame_ms
+        return b'OK\r\n'
+
+    def reset_input(self):
+        pass
+
+    def close(self):
+        pass
+#
+class Job_Journal(object):
+    """Append only checkpoint file holding the last acknowledged point of a job, so a run cut short by a dropped link
+    or a closed program can resume from there. Records are written and fsynced at most once every interval seconds,
+    plus on pauses and stops. The header identifies the job by a digest of its points, multiplier and machine, the port
+    it runs on, so a journal never resumes a different job or the same job on another engraver. Each record carries
+    a CRC, so a torn last write is ignored."""
+    magic = b'EJJ1'
+    header = struct.Struct('<4s32sI')  # magic, sha256 of the job, points
+    record = struct.Struct('<qI')  # last acknowledged index, crc32 of the index
+    
+    def __init__(self, filename, x_cords, y_cords, multiplier=1, interval=1.0, machine=None):
+        self.filename = filename
+        self.interval = interval
+        self.points = len(x_cords)
+        self.machine = machine
+        self.digest = Job_Journal.job_digest(x_cords, y_cords, multiplier, machine)
+        self.file = None
+        self.written = None
+        self.synced_at = 0
+        #Records written and fsync calls made, for measuring the overhead
+        self.syncs = 0
+    
+    def job_digest(x_cords, y_cords, multiplier, machine=None):
+        """sha256 of the points as little endian uint16, the multiplier and the machine name."""
+        digest = hashlib.sha256(struct.pack('<HI', multiplier, len(x_cords)) + (machine or "").encode('utf-8'))
+        for start in range(0, len(x_cords), 1048576):
+            digest.update(numpy.asarray(x_cords[start:start+1048576], dtype='<u2').tobytes())
+            digest.update(numpy.asarray(y_cords[start:start+1048576], dtype='<u2').tobytes())
+        return digest.digest()
+    
+    def read(self):
+        """(last recorded index or -1, number of whole valid records) for this job, None if the file is missing or for another job."""
+        try:
+            with open(self.filename, 'rb') as journal_file:
+                data = journal_file.read()
+        except OSError:
+            return None
+        if len(data) < self.header.size or self.header.unpack_from(data) != (self.magic, self.digest, self.points):
+            return None
+        last = -1
+        valid = 0
+        for offset in range(self.header.size, len(data) - self.record.size + 1, self.record.size):
+            index, crc = self.record.unpack_from(data, offset)
+            if crc != zlib.crc32(struct.pack('<q', index)):
+                break
+            last = index
+            valid += 1
+        return last, valid
+    
+    def resume_index(self):
+        """Index of the point to resume from, 0 when there is nothing to resume."""
+        recorded = self.read()
+        if recorded == None:
+            return 0
+        return recorded[0] + 1
+    
+    def open(self):
+        """Opens the journal for appending. Records of the same job are kept, anything else is started over."""
+        recorded = self.read()
+        if recorded == None:
+            self.file = open(self.filename, 'wb')
+            self.file.write(self.header.pack(self.magic, self.digest, self.points))
+            self.written = None
+        else:
+            self.file = open(self.filename, 'r+b')
+            #Drop a torn record so later ones stay aligned
+            self.file.truncate(self.header.size + recorded[1]*self.record.size)
+            self.file.seek(0, os.SEEK_END)
+            self.written = recorded[0]
+        self.__sync()
+    
+    def checkpoint(self, index, force=False):
+        """Records index as acknowledged, if force or interval seconds have passed since the last record."""
+        if self.file == None or index == self.written:
+            return
+        now = time.perf_counter()
+        if not force and now - self.synced_at < self.interval:
+            return
+        self.file.write(self.record.pack(index, zlib.crc32(struct.pack('<q', index))))
+        self.written = index
+        self.__sync()
+        self.synced_at = now
+    
+    def __sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.syncs += 1
+    
+    def close(self, done=False):
+        """Closes the journal, removing it once the job is done."""
+        if self.file != None:
+            self.file.close()
+            self.file = None
+        if done:
+            try:
+                os.remove(self.filename)
+            except OSError:
+                pass
+#
+#index is the last finished point, -1 before the first. rate is points per second
+Progress = namedtuple('Progress', ['index', 'position', 'errors', 'rate', 'state'])
+
+class Progress_Bridge(object):
+    """Thread safe mailbox holding only the newest Progress, so a slow reader never holds the runner back."""
+    def __init__(self):
+        self.condition = Condition()
+        self.latest = None
+        self.version = 0
+        self.taken = 0
+
+    def publish(self, progress):
+        with self.condition:
+            self.latest = progress
+            self.version += 1
+            self.condition.notify_all()
+
+    def take(self):
+        """Newest Progress, or None if nothing changed since the last take."""
+        with self.condition:
+            if self.version == self.taken:
+                return None
+            self.taken = self.version
+            return self.latest
+
+    def wait(self, timeout=None):
+        """Blocks until there is a Progress not yet taken, then takes it. None on timeout."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != self.taken, timeout)
+        return self.take()
+#
+class Job_Runner(object):
+    """Sends x, y arrays through a transport from an asyncio loop. Start, pause, resume, abort and step are safe to call from any thread.
+    Pausing and stepping stop at a frame boundary once every frame in flight has been answered.
+    With a Job_Journal every acknowledged point is checkpointed, and start=journal.resume_index() resumes a cut short run.
+    With max_errors the run fails on that many bad replies, as each reply comes in.
+    A window over 1 keeps that many frames in flight and matches replies in order. Every sync_interval frames it waits
+    for every reply, so a lost one is caught by the read timeout within sync_interval frames instead of at the end."""
+    states = ('idle', 'running', 'paused', 'stepping', 'aborted', 'done', 'failed')
+    #Progress events per second at most, state changes are always published
+    max_rate = 20
+    #Weight of the newest sample in the smoothed points per second
+    rate_smoothing = 0.3
+    #Frames sent between waits for every reply when pipelined
+    sync_interval = 64
+
+    def __init__(self, x_cords, y_cords, transport, multiplier=1, window=1, bridge=None, start=0, telemetry=None, journal=None, max_errors=None):
+        self.x_cords = x_cords
+        self.y_cords = y_cords
+        self.transport = transport
+        self.multiplier = multiplier
+        self.window = window
+        self.bridge = bridge if bridge != None else Progress_Bridge()
+        self.interp = Interpreter(multiplier)
+        #Optional Telemetry sized for the whole job
+        self.telemetry = telemetry
+        #Optional Job_Journal for the same points and multiplier
+        self.journal = journal
+        self.max_errors = max_errors
+        self.start_index = start
+        if start > 0:
+            #Resuming, the table was last confirmed at the point before start
+            self.interp.state.x = int(x_cords[start-1])*multiplier
+            self.interp.state.y = int(y_cords[start-1])*multiplier
+        self.index = start-1
+        #Last point answered OK, what the journal records
+        self.confirmed = start-1
+        self.errors = 0
+        #(first, last) spans of points with a bad reply. Pipelined replies carry no index, so a lost one is
+        #only known to lie between the point replies last lined up at and the last frame sent, see sync_interval
+        self.failed = []
+        self.rate = 0
+        self.state = 'idle'
+        self.error = None
+        self.loop = None
+        self.thread = None
+        self.step_budget = 0
+        #A pause waits for frames in flight, it is published and checkpointed once the send loop is idle
+        self.settling = False
+
+    def start(self, paused=False):
+        """Runs the job on its own event loop thread and returns at once. Paused starts without sending, ready for step()."""
+        self.state = 'paused' if paused else 'running'
+        self.thread = Thread(target=asyncio.run, args=(self.run(),), daemon=True)
+        self.thread.start()
+
+    def pause(self):
+        self.__command(self.__pause)
+
+    def resume(self):
+        self.__command(self.__resume)
+
+    def step(self):
+        """Sends one more point then pauses."""
+        self.__command(self.__step)
+
+    def abort(self):
+        self.__command(self.__abort)
+
+    def join(self, timeout=None):
+        if self.thread != None:
+            self.thread.join(timeout)
+
+    def finished(self):
+        return self.state in ('aborted', 'done', 'failed')
+
+    def __command(self, command):
+        """Runs command on the loop thread, or directly before the loop exists."""
+        if self.loop == None:
+            command()
+        else:
+            try:
+                self.loop.call_soon_threadsafe(command)
+            except RuntimeError:
+                #Loop already closed, the job is over
+                pass
+
+    def __pause(self):
+        if self.state in ('running', 'stepping'):
+            self.state = 'paused'
+            self.settling = True
+
+    def __resume(self):
+        if self.state in ('idle', 'paused', 'stepping'):
+            self.__set_state('running')
+
+    def __step(self):
+        if self.state in ('idle', 'paused', 'stepping'):
+            self.step_budget += 1
+            self.__set_state('stepping')
+
+    def __abort(self):
+        if not self.finished():
+            self.__set_state('aborted')
+
+    def __set_state(self, state):
+        self.state = state
+        if self.journal != None and self.confirmed >= 0:
+            self.journal.checkpoint(self.confirmed, force=True)
+        if self.loop != None:
+            self.wake.set()
+            self.__publish(force=True)
+
+    def __publish(self, force=False):
+        """Publishes a Progress if force or 1/max_rate seconds have passed since the last one."""
+        now = time.perf_counter()
+        elapsed = now - self.published_at
+        if not force and elapsed < 1/self.max_rate:
+            return
+        if elapsed > 0 and self.index != self.published_index:
+            sample = (self.index - self.published_index)/elapsed
+            self.rate += self.rate_smoothing*(sample - self.rate) if self.rate else sample
+        self.published_at = now
+        self.published_index = self.index
+        position = None
+        if self.index >= 0:
+            position = int(self.x_cords[self.index]), int(self.y_cords[self.index])
+        self.bridge.publish(Progress(self.index, position, self.errors, self.rate, self.state))
+
+    async def run(self):
+        """Sends the whole job, returns the final state. Can be awaited directly for headless use."""
+        self.loop = asyncio.get_running_loop()
+        self.wake = asyncio.Event()
+        self.published_at = time.perf_counter()
+        self.published_index = self.index
+        if self.state == 'idle':
+            self.state = 'running'
+        try:
+            if self.journal != None:
+                self.journal.open()
+            await self.transport.open()
+            await self.__send_loop()
+        except Exception as error:
+            self.error = error
+            self.__set_state('failed')
+        finally:
+            self.transport.close()
+            if self.journal != None:
+                if self.confirmed >= 0:
+                    self.journal.checkpoint(self.confirmed, force=True)
+                self.journal.close(done=self.state == 'done')
+            self.__publish(force=True)
+            self.loop = None
+        return self.state
+
+    async def __send_loop(self):
+        frames = Serial_Manager()
+        in_flight = deque()
+        next_index = self.start_index
+        chunk_start = None
+        #First point sent since replies last lined up with frames
+        unsynced = next_index
+        try:
+            while True:
+                can_send = self.state == 'running' or (self.state == 'stepping' and self.step_budget > 0)
+                #Replies carry no index, so sending stops at the sync point until every reply is in and they line up again
+                if can_send and next_index < len(self.x_cords) and len(in_flight) < self.window and next_index - unsynced < self.sync_interval:
+                    #Frames are encoded a chunk at a time
+                    if chunk_start == None or next_index - chunk_start >= 4096:
+                        chunk_start = next_index
+                        chunk = frames.encode_frames(self.x_cords[chunk_start:chunk_start+4096], self.y_cords[chunk_start:chunk_start+4096], self.multiplier)
+                    offset = (next_index - chunk_start)*frames.frame_size
+                    if self.telemetry != None:
+                        sent = time.perf_counter()
+                    if self.window == 1:
+                        self.transport.reset_input()
+                    if self.telemetry != None:
+                        flushed = time.perf_counter()
+                    self.transport.write(chunk[offset:offset+frames.frame_size])
+                    if self.telemetry != None:
+                        self.telemetry.record_send(next_index, sent, time.perf_counter(), flushed-sent)
+                    in_flight.append(next_index)
+                    next_index += 1
+                    if self.state == 'stepping':
+                        self.step_budget -= 1
+                    if len(in_flight) < self.window and self.state == 'running' and next_index - unsynced < self.sync_interval:
+                        continue
+                if in_flight:
+                    #Replies come back in order, each one belongs to the oldest frame in flight
+                    line = await self.transport.readline()
+                    if line == b'':
+                        #Nothing real is in flight after a timeout, every frame still counted lost its reply
+                        #somewhere since replies last lined up, at most sync_interval frames back, the rest
+                        #having shifted onto older frames
+                        last = in_flight[-1]
+                        while in_flight:
+                            self.__finish(in_flight.popleft(), False, (unsynced, last))
+                        unsynced = last+1
+                        continue
+                    index = in_flight.popleft()
+                    self.__finish(index, line == b'OK\r\n')
+                    if not in_flight:
+                        unsynced = index+1
+                    continue
+                if self.state in ('aborted', 'failed'):
+                    return
+                if next_index >= len(self.x_cords):
+                    self.__set_state('done')
+                    return
+                if self.state == 'stepping' and self.step_budget == 0:
+                    self.state = 'paused'
+                    self.settling = True
+                if self.settling:
+                    #Every reply is in, so the published index and the checkpoint match the machine
+                    self.settling = False
+                    self.__set_state(self.state)
+                #Nothing in flight and not allowed to send, sleep until a command arrives
+                self.wake.clear()
+                await self.wake.wait()
+        finally:
+            #Stopped early, collect replies of frames already sent so the next job starts clean
+            while in_flight:
+                await self.transport.readline()
+                in_flight.popleft()
+
+    def __finish(self, index, ok, span=None):
+        """Records the reply for point index. span is the (first, last) points a bad reply lies in, index alone by default."""
+        self.index = index
+        if span == None:
+            span = (index, index)
+        if self.telemetry != None:
+            self.telemetry.record_reply(index, time.perf_counter(), ok)
+            if span[0] < span[1]:
+                self.telemetry.record_lost(*span)
+        if not ok:
+            self.errors += 1
+            self.failed.append(span)
+            if self.max_errors != None and self.errors >= self.max_errors and not self.finished():
+                self.error = Exception("Too many bad replies: ", self.errors)
+                self.__set_state('failed')
+        else:
+            self.confirmed = index
+            if self.journal != None:
+                self.journal.checkpoint(index)
+        self.interp.state.x = int(self.x_cords[index])*self.multiplier
+        self.interp.state.y = int(self.y_cords[index])*self.multiplier
+        self.__publish()
+#
+
+
+if __name__=="__main__":
+    parser = argparse.ArgumentParser(description="Send a G-code or binary job to the 2D laser engraver without the GUI.")
+    parser.add_argument("job", help="G-code .txt or binary .ejb job")
+    parser.add_argument("--port", help="serial port, e.g. COM3, /dev/ttyUSB0 or a firmware_sim.py pty. Without one the job is simulated")
+    parser.add_argument("--multiplier", type=int, default=None, help="movement multiplier, binary jobs default to their own")
+    parser.add_argument("--window", type=int, default=1, help="frames in flight, 1 is stop and wait")
+    parser.add_argument("--lase-time", type=int, default=100, help="milliseconds per point, used by the timeline and dry runs")
+    parser.add_argument("--time-scale", type=float, default=0, help="dry run speed without a port, 1 is real time and 0 is instant")
+    parser.add_argument("--phases", type=int, default=10, help="phases in the printed timeline")
+    parser.add_argument("--telemetry", help="record per point timing and write it to this .csv or .json file")
+    parser.add_argument("--journal", help="checkpoint file of runs with --port, defaults to the job file name with .journal added")
+    parser.add_argument("--no-journal", action='store_true', help="do not checkpoint, a stopped run starts over")
+    parser.add_argument("--resume", action='store_true', help="continue after the last point the journal confirmed")
+    args = parser.parse_args()
+    job = Job.from_file(args.job)
+    x_cords, y_cords, multiplier = job.x, job.y, job.multiplier
+    if args.multiplier != None:
+        multiplier = args.multiplier
+    #Fitted timing of this port once runs with --telemetry have calibrated it
+    profiles = Time_Profiles()
+    model = profiles.model_for(args.port) if args.port else None
+    print(job.stats.timeline_text(multiplier, args.lase_time, args.phases, model))
+    transport = Async_Serial(args.port) if args.port else Dry_Run_Transport(args.lase_time, args.time_scale)
+    telemetry = Telemetry(len(x_cords)) if args.telemetry else None
+    journal = None
+    start = 0
+    #Dry runs engrave nothing, a checkpoint from one would skip points on the real machine
+    if not args.no_journal and args.port:
+        journal = Job_Journal(args.journal or args.job + ".journal", x_cords, y_cords, multiplier, machine=args.port)
+        if args.resume:
+            start = journal.resume_index()
+            print("Resuming at point", start+1, "of", len(x_cords), Job_Stats.time_string(job.stats.remaining_ms(start-1, multiplier, args.lase_time, model)), "left")
+        elif journal.resume_index():
+            print("Journal found, run with --resume to continue from point", journal.resume_index()+1)
+    runner = Job_Runner(x_cords, y_cords, transport, multiplier, args.window, start=start, telemetry=telemetry, journal=journal)
+    started = time.perf_counter()
+    runner.start()
+    try:
+        while not runner.finished() or runner.thread.is_alive():
+            progress = runner.bridge.wait(0.5)
+            if progress != None:
+                if telemetry != None:
+                    telemetry.record_displayed(progress.index, time.perf_counter())
+                print("%s %d/%d errors: %d %.1f points/s" % (progress.state, progress.index+1, len(x_cords), progress.errors, progress.rate))
+                sys.stdout.flush()
+    except KeyboardInterrupt:
+        runner.abort()
+        runner.join()
+    if not args.port:
+        print("Dry run of", Job_Stats.time_string(transport.predicted_ms), "machine time took %.1f s" % (time.perf_counter()-started))
+    if telemetry != None:
+        telemetry.export(args.telemetry)
+        if args.port:
+            print("Calibrated", args.port, "with", profiles.add_run(args.port, telemetry, x_cords, y_cords, multiplier, args.lase_time), "points")
+        for name, value in telemetry.summary(False).items():
+            print(name, value)
+    if runner.failed:
+        print("Bad replies at points:", ", ".join(str(first+1) if first == last else "somewhere in %d-%d" % (first+1, last+1)
+                                                 for first, last in runner.failed[:20]))
+    if runner.error != None:
+        print("Failed:", runner.error)
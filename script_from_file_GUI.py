@@ -10,12 +10,16 @@
 import tkinter
 from tkinter import ttk, filedialog, messagebox
 import time
+import os
+import sys
 from os.path import expanduser
-from PIL import Image, ImageTk
-from engraver_lib import Interpreter, Serial_Manager, Pic_To_Gcode
-from threading import Thread
-import queue
-import multiprocessing
+import numpy
+from engraver_lib import Job_Stats, Port_Finder, Pic_To_Gcode, Binary_Job, Job, Path_Optimizer, Contour_Tracer, Telemetry, Time_Profiles, Conversion_Cache, Lazy_Module
+#Imported on first use, the window opens without waiting for PIL, pyserial or asyncio
+Image = Lazy_Module("PIL.Image")
+ImageTk = Lazy_Module("PIL.ImageTk")
+job_runner = Lazy_Module("job_runner")
+engraver_daemon = Lazy_Module("engraver_daemon")
 
 class Help_Window(tkinter.Toplevel):
     """Pop-up that displays information from .\\resource\\Help file.txt."""
@@ -35,9 +39,20 @@ class Help_Window(tkinter.Toplevel):
         self.title("Help")
 #
 class Convert_Window(tkinter.Toplevel):
-    """Pop-up that explains and asks for x,y max size values."""
-    def __init__(self, root, filename):
+    """Pop-up that explains and asks for x,y max size values, the dithering and the path optimization."""
+    path_modes = (("Raster", None), ("Skip empty rows", 'rows'), ("Islands", 'islands'), ("Nearest point", 'nearest'),
+                  ("Outline only (line art)", 'contour'))
+    dither_modes = (("Floyd-Steinberg", 'floyd-steinberg'), ("Threshold", 'threshold'), ("Bayer 2x2", 'bayer2'), ("Bayer 4x4", 'bayer4'),
+                    ("Bayer 8x8", 'bayer8'), ("Bayer 16x16", 'bayer16'), ("Blue noise", 'blue-noise'))
+    #Pictures with more pixels than this are read in bands by default
+    tiled_pixels = 2**24
+    
+    def __init__(self, root, filename, cache=None, multiplier=1, lase_time=100, model=None):
         super().__init__(root)
+        self.cache = cache
+        self.multiplier = multiplier
+        self.lase_time = lase_time
+        self.model = model
         tkinter.Label(self, text="Enter maximum size in X or Y\nAspect ratio will be kept:").grid(column=0, row=0, sticky='w')
         ptg = Pic_To_Gcode()
         self.filename = filename
@@ -50,25 +65,69 @@ class Convert_Window(tkinter.Toplevel):
         tkinter.Entry(self, textvariable=self.x_size_tkvar).grid(column=1, row=1, sticky='w')
         tkinter.Label(self, text="Size Y: ").grid(column=0, row=2, sticky='w')
         tkinter.Entry(self, textvariable=self.y_size_tkvar).grid(column=1, row=2, sticky='w')
-        tkinter.Button(self, text="Convert", command=self.__convert_btn).grid(column=0, row=3, sticky='w')
+        tkinter.Label(self, text="Path: ").grid(column=0, row=3, sticky='w')
+        self.path_tkvar = tkinter.StringVar()
+        self.path_tkvar.set(self.path_modes[0][0])
+        tkinter.OptionMenu(self, self.path_tkvar, *[name for name, mode in self.path_modes]).grid(column=1, row=3, sticky='w')
+        tkinter.Label(self, text="Dither: ").grid(column=0, row=4, sticky='w')
+        self.dither_tkvar = tkinter.StringVar()
+        self.dither_tkvar.set(self.dither_modes[0][0])
+        tkinter.OptionMenu(self, self.dither_tkvar, *[name for name, mode in self.dither_modes]).grid(column=1, row=4, sticky='w')
+        tkinter.Label(self, text="Dot density %: ").grid(column=0, row=5, sticky='w')
+        #Blank keeps the picture's own tone
+        self.density_tkvar = tkinter.StringVar()
+        tkinter.Entry(self, textvariable=self.density_tkvar).grid(column=1, row=5, sticky='w')
+        self.tiled_tkvar = tkinter.BooleanVar()
+        self.tiled_tkvar.set(size[0]*size[1] > self.tiled_pixels)
+        tkinter.Checkbutton(self, text="Large picture (tiled)", variable=self.tiled_tkvar).grid(column=0, row=6, columnspan=2, sticky='w')
+        self.estimate_tkvar = tkinter.StringVar()
+        tkinter.Label(self, textvariable=self.estimate_tkvar).grid(column=0, row=7, columnspan=2, sticky='w')
+        tkinter.Button(self, text="Estimate", command=self.__estimate_btn).grid(column=1, row=8, sticky='w')
+        tkinter.Button(self, text="Convert", command=self.__convert_btn).grid(column=0, row=8, sticky='w')
         self.attributes("-topmost", 1)
         self.title("Size")
+    
+    def __converter(self):
+        """Pic_To_Gcode set up from the entered options."""
+        mode = dict(self.path_modes)[self.path_tkvar.get()]
+        density = None
+        if self.density_tkvar.get().strip():
+            density = float(self.density_tkvar.get())/100
+        ptg = Pic_To_Gcode(cache=self.cache, dither=dict(self.dither_modes)[self.dither_tkvar.get()], density=density,
+                           tiled=self.tiled_tkvar.get())
+        if mode == 'contour':
+            ptg.contour_tracer = Contour_Tracer()
+        elif mode is not None:
+            ptg.path_optimizer = Path_Optimizer(mode)
+        return ptg
+    
+    def __estimate_btn(self):
+        """Shows the dot count and run time the entered options would give, without saving anything."""
+        try:
+            size = int(self.x_size_tkvar.get()), int(self.y_size_tkvar.get())
+            dots, time_ms = self.__converter().dot_estimate(self.filename, size, self.multiplier, self.lase_time, self.model)
+        except:
+            messagebox.showinfo("Error", "Estimate failed\nUnsupported file type or options.")
+            return
+        self.estimate_tkvar.set("%d dots, about %s" % (dots, Job_Stats.time_string(time_ms)))
         
     def __convert_btn(self):
-        """Instantiates the file converter and writes G-code file into .\\g code ."""
-        size = int(self.x_size_tkvar.get()), int(self.y_size_tkvar.get())
+        """Instantiates the file converter and writes G-code file into the G code folder."""
         try:
-            ptg = Pic_To_Gcode()
-            g_code = ptg.convert_file(self.filename, size)
-            messagebox.showinfo("Complete", "Conversion complete\nG-code file saved in .\\g code")
+            size = int(self.x_size_tkvar.get()), int(self.y_size_tkvar.get())
+            ptg = self.__converter()
+            g_code_file_name = ptg.convert_file_save_in_folder(self.filename, size)
+            message = "Conversion complete\nG-code file saved as " + g_code_file_name
+            if ptg.cache_hit:
+                message += "\nReused a cached conversion"
+            if ptg.contour_tracer is not None:
+                message += "\nPoints: %d before, %d after outline tracing" % (ptg.contour_tracer.points_before, ptg.contour_tracer.points_after)
+            if ptg.path_stats() is not None:
+                message += "\nSteps: %d before, %d after path optimization" % (ptg.path_stats().steps_before, ptg.path_stats().steps_after)
+            messagebox.showinfo("Complete", message)
             self.destroy()
         except:
             messagebox.showinfo("Error", "Conversion failed\nUnsupported file type or options.")
-        
-        g_code_file_name = ".\\g code\\G code - " + self.filename.split('\\')[-1].split('.')[0] + ".txt"
-        g_code_file_handle = open(g_code_file_name, 'w')
-        g_code_file_handle.write(g_code)
-        g_code_file_handle.close()
 #
 class Multi_Select_Window(tkinter.Toplevel):
     """Pop-up to select a movement multiplier."""
@@ -92,125 +151,122 @@ class Multi_Select_Window(tkinter.Toplevel):
         self.multiplier = int(self.multiplier_tkvar.get())
         self.destroy()
 #
-class Parse_Com_Thread(Thread):
-    """Thread that handles parsing the G-code script and sending commands through serial."""
-    def __init__(self, out_queue, in_queue, script, port=0, multiplier=1):
-        super().__init__()
-        self.out_queue = out_queue
-        self.in_queue = in_queue
-        self.port = port
-        self.script = script
-        self.interp = Interpreter(multiplier)
-        self.serial_man = Serial_Manager()
-        if port != 0:
-            self.serial_man.connect("//./COM" + port)
-    
-    def run(self):
-        exit = False
-        script_len = len(self.script)
-        while True:
-            line_num=1
-            for line in self.script:
-                x_y = self.interp.decode_string_line(line, line_num)
-                if x_y == False:
-                    exit = True
-                    break
-                if self.port != 0:
-                    not_error = self.serial_man.send_positions(x_y)
-                else:
-                    time.sleep(0.1)
-                    not_error = True
-                x_y = int(x_y[0]/self.interp.multiplier), int(x_y[1]/self.interp.multiplier)
-                self.in_queue.put((not_error, line_num/script_len*100, x_y))
-                if line_num == script_len:
-                    exit = True
-                    break
-                line_num+=1
-                try:
-                    out = self.out_queue.get(False)
-                    if out == "exit":
-                        exit = True
-                        break
-                except queue.Empty:
-                    pass
-            if exit:
-                break
-#
 class Instant_Preview(tkinter.Frame):
-    """Frame, housing an image built from a G-code script."""
+    """Frame, housing an image built from a loaded Job.
+    Jobs bigger than the frame are max-pooled down to it, so every dot stays visible, and drawn chunk by chunk from the Tk main loop."""
+    chunk = 262144
+    
     def __init__(self, root, size):
         super().__init__(root)
         tkinter.Label(self, text="Preview").pack(side="top")
         self.label_pic = tkinter.Label(self)
-        self.im = Image.new("L", (size[0], size[1]), "white")
-        self.photo = ImageTk.PhotoImage(self.im)
+        self.display_size = size
+        self.render_job = None
+        self.photo = Instant_Preview.blank_photo(size)
         self.label_pic.configure(image=self.photo)
         self.label_pic.pack(side="top")
         
-    def load_gcode(self, script, size):
-        """Creates new image and populates with pixels from given G-code script"""
-        self.script = script
-        self.im = Image.new("L", (size[0], size[1]), "white")
-        self.im_pixmap = self.im.load()
-        self.photo = ImageTk.PhotoImage(self.im)
-        self.label_pic.configure(image=self.photo)
+    def load_gcode(self, job):
+        """Creates new image and starts populating it with pixels from the job's shared x, y columns"""
+        self.job = job
+        size = job.stats.estimate(1)[2]
+        self.factor = Instant_Preview.pool_factor(size, self.display_size)
+        width, height = -(-size[0]//self.factor), -(-size[1]//self.factor)
+        #Kept flipped top to bottom, True is black
+        self.ink = numpy.zeros((height, width), dtype=bool)
+        self.done = 0
+        if self.render_job != None:
+            self.after_cancel(self.render_job)
         self.__populate_image()
     
+    def blank_photo(size):
+        """White Tk photo of size, made without PIL."""
+        photo = tkinter.PhotoImage(width=size[0], height=size[1])
+        photo.put("white", to=(0, 0, size[0], size[1]))
+        return photo
+    
+    def pool_factor(size, display_size):
+        """Smallest whole number the job size is divided by to fit display_size."""
+        return max(1, -(-size[0]//display_size[0]), -(-size[1]//display_size[1]))
+    
     def __populate_image(self):
-        """Populates the blank image with pixels from G-code script"""
-        interp = Interpreter(1)
-        line_num = 0
-        for line in self.script:
-            x_y = interp.decode_string_line(line, line_num)
-            if x_y != False:
-                x, y = x_y
-                self.im_pixmap[x, y] = 0
-            line_num += 1
+        """Stamps the next chunk of x, y arrays into the image, reschedules itself until all points are drawn"""
+        height, width = self.ink.shape
+        stop = min(self.done + self.chunk, len(self.job))
+        #Integer division of the coordinates is a max-pool of the full size image without allocating it
+        x = numpy.minimum(numpy.asarray(self.job.x[self.done:stop], dtype=numpy.int64)//self.factor, width-1)
+        y = numpy.minimum(numpy.asarray(self.job.y[self.done:stop], dtype=numpy.int64)//self.factor, height-1)
+        self.ink[height-1-y, x] = True
+        self.done = stop
         
-        self.photo = ImageTk.PhotoImage(self.im.transpose(Image.FLIP_TOP_BOTTOM))
+        self.im = Image.fromarray(numpy.where(self.ink, 0, 255).astype(numpy.uint8))
+        self.photo = ImageTk.PhotoImage(self.im)
         self.label_pic.image = self.photo
         self.label_pic.configure(image=self.photo)
-        self.label_pic.update()
+        if self.done < len(self.job):
+            self.render_job = self.after(1, self.__populate_image)
+        else:
+            self.render_job = None
 #
 class Progressive_Preview(tkinter.Frame):
-    """Frame, housing an image progressively built from add_point() calls."""
+    """Frame, housing an image progressively built from add_points() calls.
+    The image is kept flipped top to bottom, and only the changed rectangle is copied to Tk, at most max_fps times a second."""
+    max_fps = 20
+    
     def __init__(self, root, size):
         super().__init__(root)
         tkinter.Label(self, text="Instant View").pack(side="top")
-        self.im = Image.new("L", (size[0], size[1]), "white")
-        self.photo = ImageTk.PhotoImage(self.im)
         self.label_pic = tkinter.Label(self)
-        self.label_pic.configure(image=self.photo)
         self.label_pic.pack(side="top")
         self.size = size
+        self.reset_picture()
     
-    def load_gcode(self, script, size=None):
+    def load_gcode(self, size=None):
         """Creates new blank image."""
         if size == None:
             size = self.size
         self.size = size
-        self.im = Image.new("L", (size[0], size[1]), "white")
-        self.im_pixmap = self.im.load()
-        self.photo = ImageTk.PhotoImage(self.im)
-        self.label_pic.configure(image=self.photo)
+        self.reset_picture()
     
     def add_point(self, x_y_cords):
         """Adds a black pixel at the x,y point specified."""
         if x_y_cords != False:
-            x, y = x_y_cords
-            self.im_pixmap[x, y] = 0
-        
-        self.photo = ImageTk.PhotoImage(self.im.transpose(Image.FLIP_TOP_BOTTOM))
-        self.label_pic.image = self.photo
-        self.label_pic.configure(image=self.photo)
-        self.label_pic.update()
+            self.add_points([x_y_cords])
+    
+    def add_points(self, x_y_cords):
+        """Adds black pixels at a list of x,y points, the display catches up at the next frame."""
+        if len(x_y_cords) == 0:
+            return
+        x_y_cords = numpy.asarray(x_y_cords, dtype=numpy.int64)
+        cols = x_y_cords[:, 0]
+        rows = self.size[1] - 1 - x_y_cords[:, 1]
+        self.pixels[rows, cols] = 0
+        box = int(cols.min()), int(rows.min()), int(cols.max())+1, int(rows.max())+1
+        if self.dirty is None:
+            self.dirty = box
+        else:
+            self.dirty = min(self.dirty[0], box[0]), min(self.dirty[1], box[1]), max(self.dirty[2], box[2]), max(self.dirty[3], box[3])
+        self.flush()
+    
+    def flush(self, force=False):
+        """Copies the changed rectangle into the Tk photo, unless the last frame was under 1/max_fps seconds ago."""
+        now = time.perf_counter()
+        if self.dirty is None or (not force and now - self.last_frame < 1/self.max_fps):
+            return
+        left, top, right, bottom = self.dirty
+        patch = ImageTk.PhotoImage(Image.fromarray(self.pixels[top:bottom, left:right]))
+        self.label_pic.tk.call(str(self.photo), 'copy', str(patch), '-to', left, top)
+        self.dirty = None
+        self.last_frame = now
         
     def reset_picture(self):
         """Alternative to create new blank image, Using same size as previous."""
-        self.im = Image.new("L", (self.size[0], self.size[1]), "white")
-        self.im_pixmap = self.im.load()
-        self.photo = ImageTk.PhotoImage(self.im)
+        self.pixels = numpy.full((self.size[1], self.size[0]), 255, dtype=numpy.uint8)
+        self.photo = Instant_Preview.blank_photo(self.size)
+        self.label_pic.image = self.photo
         self.label_pic.configure(image=self.photo)
+        self.dirty = None
+        self.last_frame = 0
 #
 class Info_Running_Frame(tkinter.Frame):
     """Information frame displayed at the bottom of the main window. Shows percent and time estimation."""
@@ -242,6 +298,13 @@ class Info_Eval_Frame(tkinter.Frame):
 #
 class Window(tkinter.Frame):
     """Main application window."""
+    #Frames in flight when pipelined sending is on, 8 frames fill the firmware's 64 byte serial buffer
+    pipeline_window = 4
+    #Milliseconds between UI queue checks
+    check_interval = 50
+    #Dry run menu choices, scale 0 replays as fast as the UI can follow
+    dry_run_speeds = (('Real time', 1.0), ('10x', 0.1), ('100x', 0.01), ('Instant', 0))
+    
     def __init__(self, root):
         super().__init__(root)
         self.root = root
@@ -254,11 +317,19 @@ class Window(tkinter.Frame):
         self.info_running_frame = Info_Running_Frame(self)
         self.__gen_menu()
         root.config(menu=self.menu)
-        self.parse_com_handle = True
+        self.runner = None
+        self.drawn = -1
+        #Run times fitted per port from runs recorded with telemetry
+        self.time_profiles = Time_Profiles()
+        self.conversion_cache = Conversion_Cache()
         self.multiplier = 1
         self.lase_time = 100
         self.exit = False
-        self.script = []
+        #One immutable Job shared by the previews and the runner
+        self.job = Job.from_positions([], [])
+        #Ports are listed in the background and filled into the Run menu when found
+        self.port_finder = Port_Finder()
+        self.__menu_refresh_ports()
         
     def __gen_menu(self):
         """Generates the main window menu."""
@@ -266,6 +337,8 @@ class Window(tkinter.Frame):
         #File menu
         submenu = tkinter.Menu(self.menu, tearoff=0)
         submenu.add_command(label = 'Open Gcode', command=self.__menu_open_gcode)
+        submenu.add_command(label = 'Export binary job...', command=self.__menu_export_binary)
+        submenu.add_command(label = 'Export telemetry...', command=self.__menu_export_telemetry)
         #submenu.add_command(label = 'Save', command=self.save_file)
         #submenu.add_command(label = 'Save as...', command=self.save_as_file)
         submenu.add_separator()
@@ -277,25 +350,68 @@ class Window(tkinter.Frame):
         self.submenu.entryconfig(0, state=tkinter.DISABLED)
         self.submenu.add_command(label = 'Reset', command=self.__menu___reset_system)
         self.submenu.entryconfig(1, state=tkinter.DISABLED)
+        self.submenu.add_command(label = 'Pause', command=self.__menu_pause)
+        self.submenu.add_command(label = 'Resume', command=self.__menu_resume)
+        self.submenu.add_command(label = 'Step', command=self.__menu_step)
+        for entry in (2, 3, 4):
+            self.submenu.entryconfig(entry, state=tkinter.DISABLED)
         self.submenu.add_separator()
         self.submenu.add_command(label = 'Multiplier', command=self.__menu_select_multiplier)
+        self.pipelined = tkinter.IntVar()
+        self.submenu.add_checkbutton(label = 'Pipelined sending', variable=self.pipelined, onvalue=self.pipeline_window, offvalue=1)
+        #Dry run speed when no port is selected, as a multiple of predicted machine time
+        self.dry_run_scale = tkinter.DoubleVar(value=1.0)
+        speed_menu = tkinter.Menu(self.submenu, tearoff=0)
+        for label, scale in self.dry_run_speeds:
+            speed_menu.add_radiobutton(label = label, variable=self.dry_run_scale, value=scale)
+        self.submenu.add_cascade(label = 'Dry run speed', menu=speed_menu)
+        self.submenu.add_command(label = 'Predicted timeline', command=self.__menu_timeline)
+        self.record_telemetry = tkinter.IntVar()
+        self.submenu.add_checkbutton(label = 'Record telemetry', variable=self.record_telemetry)
+        self.submenu.add_command(label = 'Reset time calibration', command=self.__menu_reset_calibration)
+        #Send runs to engraver_daemon.py, which owns the ports and keeps running when this window closes
+        self.use_daemon = tkinter.IntVar()
+        self.submenu.add_checkbutton(label = 'Run on engraver daemon', variable=self.use_daemon)
         self.submenu.add_separator()
-        self.serial_port = tkinter.IntVar()
-        ports = Serial_Manager.list_serial_ports()
-        if len(ports) < 2:
-            self.submenu.add_command(label = 'No ports')
-        for serial_port in ports:
-            self.submenu.add_checkbutton(label = "COM: "+str(serial_port), variable=self.serial_port, onvalue=serial_port)
+        self.submenu.add_command(label = 'Refresh ports', command=self.__menu_refresh_ports)
+        #Selected port device name, empty for a dry run
+        self.serial_port = tkinter.StringVar()
+        self.port_entries = self.submenu.index('end') + 1
+        self.submenu.add_command(label = 'Searching ports...', state=tkinter.DISABLED)
         self.menu.add_cascade(label='Run', menu=self.submenu)
         #Convert menu
         submenu = tkinter.Menu(self.menu, tearoff=0)
         submenu.add_command(label = 'Convert picture...', command=self.__menu_convert)
+        submenu.add_command(label = 'Cache statistics', command=self.__menu_cache_stats)
+        submenu.add_command(label = 'Clear cache', command=self.__menu_clear_cache)
         self.menu.add_cascade(label='Conversion', menu=submenu)
         #Help menu
         submenu = tkinter.Menu(self.menu, tearoff=0)
         submenu.add_command(label = 'Help', command=self.__menu_help_window)
         self.menu.add_cascade(label='About', menu=submenu)
         
+    def __menu_refresh_ports(self):
+        """Lists the serial ports again in the background, the Run menu changes once the scan ends."""
+        scans = self.port_finder.scans
+        self.port_finder.refresh()
+        self.root.after(self.check_interval, self.__check_ports, scans)
+    
+    def __check_ports(self, scans):
+        """Waits for the port scan after scans to finish, then replaces the port entries at the end of the Run menu."""
+        if self.port_finder.scans == scans:
+            self.root.after(self.check_interval, self.__check_ports, scans)
+            return
+        ports = self.port_finder.ports
+        self.submenu.delete(self.port_entries, 'end')
+        if len(ports) == 0:
+            self.submenu.add_command(label = 'No ports', state=tkinter.DISABLED)
+        for serial_port in ports:
+            self.submenu.add_checkbutton(label = serial_port, variable=self.serial_port, onvalue=serial_port, offvalue="", command=self.__update_estimates)
+        #A port that went away falls back to a dry run
+        if self.serial_port.get() != "" and self.serial_port.get() not in ports:
+            self.serial_port.set("")
+            self.__update_estimates()
+    
     def __menu_help_window(self):
         """Displays the help window by instantiating Help_Window."""
         Help_Window(self.root)
@@ -305,88 +421,190 @@ class Window(tkinter.Frame):
         #Get multiplier from dialogue
         x = Multi_Select_Window(self.root, self.multiplier)
         self.multiplier = x.multiplier
-        #Estimate new UI values
-        points, steps, size = Interpreter.estimator(self.script)
-        time_ms = (points*(self.lase_time+12)+steps*self.multiplier)/1000
-        min, sec = divmod(time_ms, 60)
-        hour, min = divmod(min, 60)
-        time_str = "%02d:%02d:%02d" % (hour, min, sec)
-        #Set new UI values
+        #Cached job statistics scale with the multiplier, no need to estimate again
+        self.__update_estimates()
+    
+    def __update_estimates(self):
+        """Sets time and size estimations from the cached statistics of the loaded job."""
+        points, steps, size = self.job.stats.estimate(1)
+        time_str = self.__time_string(self.job.stats.total_ms(self.multiplier, self.lase_time, self.__time_model()))
         self.info_eval_frame.time_estimation.set(time_str)
         self.info_eval_frame.size_estimation.set(str(round(self.multiplier*size[0]*(0.15/8), 3))+"mm by "+str(round(self.multiplier*size[1]*(0.15/8), 3))+"mm")
         self.info_running_frame.time_estimation.set(time_str)
     
+    def __machine(self):
+        """Time profile name of the selected port, None for dry runs."""
+        port = self.serial_port.get()
+        if port == "":
+            return None
+        return port
+    
+    def __time_model(self):
+        """Fitted Time_Model of the selected port, None uses the fixed constants."""
+        if self.__machine() == None:
+            return None
+        return self.time_profiles.model_for(self.__machine())
+    
+    def __menu_reset_calibration(self):
+        """Forget the fitted run times of the selected port."""
+        if self.__machine() != None:
+            self.time_profiles.reset(self.__machine())
+        self.__update_estimates()
+    
+    def __calibrate(self):
+        """Feeds the telemetry of a finished run on a real port into its time profile."""
+        if self.runner.telemetry != None and self.__machine() != None:
+            self.time_profiles.add_run(self.__machine(), self.runner.telemetry, self.job.x, self.job.y, self.multiplier, self.lase_time)
+            self.__update_estimates()
+    
+    def __time_string(self, time_ms):
+        """Formats milliseconds as HH:MM:SS."""
+        return Job_Stats.time_string(time_ms)
+    
+    def __menu_timeline(self):
+        """Shows the predicted per phase timeline of the loaded job."""
+        if self.job.stats.points == 0:
+            messagebox.showinfo("Error", "Open a G-code file first.")
+            return
+        timeline = self.job.stats.timeline_text(self.multiplier, self.lase_time, model=self.__time_model())
+        messagebox.showinfo("Predicted timeline", timeline)
+    
     def __menu_convert(self):
         """Show File dialogue then instantiate Convert_Window."""
-        pic_folder = expanduser("~")+"\\Pictures"
-        filename = filedialog.askopenfilename(initialdir=pic_folder).replace('/', '\\')
+        pic_folder = os.path.join(expanduser("~"), "Pictures")
+        filename = filedialog.askopenfilename(initialdir=pic_folder)
         if filename:
-            Convert_Window(self.root, filename)
+            Convert_Window(self.root, filename, self.conversion_cache, self.multiplier, self.lase_time, self.__time_model())
+    
+    def __menu_cache_stats(self):
+        """Shows conversion cache hits, misses and size."""
+        stats = self.conversion_cache.stats()
+        messagebox.showinfo("Conversion cache", "Hits: %d\nMisses: %d\nCorrupt entries removed: %d\nEvictions: %d\nEntries: %d\nSize: %.1f MB" % (
+            stats['hits'], stats['misses'], stats['corrupt'], stats['evictions'], stats['entries'], stats['bytes']/2**20))
+    
+    def __menu_clear_cache(self):
+        self.conversion_cache.clear()
     
     def menu_quit(self):
-        """Stop Parse_Com_Thread and periodic self.__check_queue() ."""
+        """Abort the running job and stop periodic self.__check_queue() . Daemon runs carry on."""
         self.exit = True
-        try:
-            self.out_queue.put("exit")
-        except:
-            pass
+        if self.runner != None and not isinstance(self.runner, engraver_daemon.Remote_Runner):
+            self.runner.abort()
         self.root.destroy()
     
     def __menu_open_gcode(self):
         """Show File dialogue then parse file and update UI."""
-        self.filename = filedialog.askopenfilename(defaultextension=".txt", initialdir=".\g code")
-        if self.filename:
-            #Open file with exception safeguards
+        filename = filedialog.askopenfilename(defaultextension=".txt", initialdir=Pic_To_Gcode.gcode_dir, filetypes=[("G-code", "*.txt"), ("Binary job", "*.ejb"), ("All files", "*")])
+        #Some Tk builds return () on cancel. The loaded job keeps its own file name in job.name
+        if filename:
+            #Binary jobs are memory mapped, text is parsed once; statistics are worked out once per load
             try:
-                file = open(self.filename, 'r', encoding='utf-8')
-                temp = file.read()
-                file.close()
-            except:
+                job = Job.from_file(filename)
+            except (UnicodeDecodeError, OSError):
                 messagebox.showinfo("Error", "Encoding error.\nFile->Open G-code\nIs for UTF-8 encoded G-code files")
                 return
-            #Split file into line by line script
-            temp = temp.split('\n')
-            self.script = []
-            for line in temp:
-                if len(line) >0 and line[0] != '#':
-                    self.script.append(line)
-            if len(self.script) < 2:
+            except Exception as error:
+                messagebox.showinfo("Error", "G-code error.\n" + "".join(str(arg) for arg in error.args))
                 return
-            #Calculate UI values
-            points, steps, size = Interpreter.estimator(self.script)
-            time_ms = (points*(self.lase_time+12)+steps*self.multiplier)/1000
-            min, sec = divmod(time_ms, 60)
-            hour, min = divmod(min, 60)
-            time_str = "%02d:%02d:%02d" % (hour, min, sec)
+            if len(job) < 2:
+                return
+            self.job = job
+            if Binary_Job.is_binary_job(filename):
+                self.multiplier = job.multiplier
             #Set UI values, visibility and states
-            self.info_eval_frame.time_estimation.set(time_str)
-            self.info_eval_frame.size_estimation.set(str(round(self.multiplier*size[0]*(0.15/8), 3))+"mm by "+str(round(self.multiplier*size[1]*(0.15/8), 3))+"mm")
+            self.__update_estimates()
             self.info_eval_frame.grid(column=0, row=1, columnspan=2, sticky='w')
-            self.info_running_frame.time_estimation.set(time_str)
             self.info_running_frame.grid_remove()
-            self.instant.load_gcode(self.script, size)
-            self.progressive.load_gcode(self.script, size)
+            self.instant.load_gcode(self.job)
+            self.progressive.load_gcode(self.job.stats.estimate(1)[2])
             self.submenu.entryconfig(0, state=tkinter.NORMAL)
             #Change window size if too small
             if int(self.root.geometry().split('+')[0].split('x')[0]) < 400:
                 self.root.geometry('{}x{}'.format(400, int(self.root.geometry().split('+')[0].split('x')[1])))
     
+    def __menu_export_binary(self):
+        """Save the loaded G-code file as a binary job file."""
+        if len(self.job) == 0:
+            messagebox.showinfo("Error", "Open a G-code file first.")
+            return
+        job_filename = filedialog.asksaveasfilename(defaultextension=".ejb", initialdir=Pic_To_Gcode.gcode_dir, filetypes=[("Binary job", "*.ejb")])
+        if job_filename:
+            self.job.save(job_filename, self.multiplier)
+    
+    def __menu_export_telemetry(self):
+        """Save the telemetry of the last run as CSV or JSON."""
+        if self.runner == None or self.runner.telemetry == None:
+            messagebox.showinfo("Error", "Enable Run->Record telemetry and run a job first.")
+            return
+        filename = filedialog.asksaveasfilename(defaultextension=".csv", initialdir=Pic_To_Gcode.gcode_dir, filetypes=[("CSV", "*.csv"), ("JSON", "*.json")])
+        if filename:
+            self.runner.telemetry.export(filename)
+    
     def __menu_run(self):
-        """Launch Parse_Com_Thread to begin executing loaded G-code script."""
+        """Start a Job_Runner executing the loaded G-code script."""
         self.exit = False
-        if self.parse_com_handle or (not self.parse_com_handle.is_alive()):
-            self.out_queue = queue.Queue()
-            self.in_queue = queue.Queue()
-            self.parse_com_handle = Parse_Com_Thread(self.out_queue, self.in_queue, self.script, self.serial_port.get(), self.multiplier)
-            self.parse_com_handle.deamon = True
-            self.parse_com_handle.start()
-            #Swap info frame
-            self.info_eval_frame.grid_remove()
-            self.info_running_frame.grid(column=0, row=1, columnspan=2, sticky='w')
-            #Change menu
-            self.submenu.entryconfig(1, state=tkinter.NORMAL)
-            #Begin updating UI
-            self.__check_queue()
+        if self.runner == None or self.runner.finished():
+            if self.use_daemon.get():
+                client = engraver_daemon.Daemon_Client()
+                if not client.available():
+                    messagebox.showinfo("Error", "No engraver daemon found.\nStart it with: python engraver_daemon.py serve --ports PORT")
+                    return
+                self.runner = engraver_daemon.Remote_Runner(client, self.job.name, self.multiplier)
+                try:
+                    self.__start_runner()
+                except Exception as error:
+                    messagebox.showinfo("Error", "The engraver daemon refused the job.\n" + "".join(str(arg) for arg in error.args))
+                return
+            port = self.serial_port.get()
+            if port != "":
+                transport = job_runner.Async_Serial(port)
+            else:
+                transport = job_runner.Dry_Run_Transport(self.lase_time, self.dry_run_scale.get())
+            telemetry = Telemetry(len(self.job)) if self.record_telemetry.get() else None
+            #Real runs checkpoint beside the job file, per port, and offer to continue one that was cut short.
+            #Dry runs engrave nothing, so they neither checkpoint nor resume
+            journal = None
+            start = 0
+            if port != "":
+                journal = job_runner.Job_Journal(self.job.name + ".journal", self.job.x, self.job.y, self.multiplier, machine=port)
+                start = journal.resume_index()
+            if start > 0 and not messagebox.askyesno("Resume", "The last run of this job stopped after point %d of %d.\nResume from there?" % (start, len(self.job))):
+                start = 0
+            self.runner = job_runner.Job_Runner(self.job.x, self.job.y, transport, self.multiplier, max(self.pipelined.get(), 1), start=start,
+                                                telemetry=telemetry, journal=journal)
+            self.__start_runner()
+    
+    def __start_runner(self):
+        """Starts self.runner and switches the UI to following it."""
+        self.exit = False
+        self.drawn = -1
+        self.calibrated = False
+        self.runner.start()
+        #Swap info frame
+        self.info_eval_frame.grid_remove()
+        self.info_running_frame.grid(column=0, row=1, columnspan=2, sticky='w')
+        #Change menu
+        self.submenu.entryconfig(1, state=tkinter.NORMAL)
+        self.__set_control_states('running')
+        #Begin updating UI
+        self.__check_queue()
+    
+    def __menu_pause(self):
+        self.runner.pause()
+    
+    def __menu_resume(self):
+        self.runner.resume()
+    
+    def __menu_step(self):
+        self.runner.step()
+    
+    def __set_control_states(self, state):
+        """Enables Pause, Resume and Step to suit the runner state."""
+        pause = state in ('running', 'stepping')
+        resume = state in ('paused', 'stepping')
+        step = state in ('paused', 'stepping')
+        for entry, enabled in ((2, pause), (3, resume), (4, step)):
+            self.submenu.entryconfig(entry, state=tkinter.NORMAL if enabled else tkinter.DISABLED)
     
     def __menu___reset_system(self):
         """Wrapper function to call reset functions."""
@@ -400,30 +618,47 @@ class Window(tkinter.Frame):
         self.info_eval_frame.grid(column=0, row=1, columnspan=2, sticky='w')
         #Change menu
         self.submenu.entryconfig(1, state=tkinter.DISABLED)
+        self.__set_control_states('idle')
         #Change progressive view
         self.progressive.reset_picture()
         #Stop UI queue checks
         self.exit = True
         
     def __reset_system(self):
-        """Resets non UI systems: Exits Parse_Com_Thread."""
-        self.out_queue.put("exit")
+        """Resets non UI systems: Aborts the Job_Runner."""
+        if self.runner != None:
+            self.runner.abort()
             
     def __check_queue(self):
-        """Checks incoming queue to UI. Updates Info_Running_Frame percent and adds points to Progressive_Preview."""
+        """Takes the newest runner progress. Updates Info_Running_Frame percent and remaining time and adds points finished since the last tick to Progressive_Preview."""
         if not self.exit:
-            try:
-                not_error, percent_done, x_y = self.in_queue.get(False)
-                self.progressive.add_point(x_y)
-                self.info_running_frame.percent_done_val.set(str(round(percent_done, 3))+'%')
-            except queue.Empty:
-                pass
-            self.root.after(100, self.__check_queue)
+            progress = self.runner.bridge.take()
+            if progress != None:
+                #Progress is coalesced, every point up to progress.index is finished
+                if self.runner.telemetry != None:
+                    self.runner.telemetry.record_displayed(progress.index, time.perf_counter())
+                if progress.index > self.drawn:
+                    self.progressive.add_points(self.job.pairs(self.drawn+1, progress.index+1))
+                    self.drawn = progress.index
+                if progress.index >= 0:
+                    self.info_running_frame.percent_done_val.set(str(round((progress.index+1)/self.job.stats.points*100, 3))+'%')
+                    self.info_running_frame.time_estimation.set(self.__time_string(self.job.stats.remaining_ms(progress.index, self.multiplier, self.lase_time, self.__time_model())))
+                self.__set_control_states(progress.state)
+                if progress.state in ('done', 'aborted') and not self.calibrated:
+                    self.calibrated = True
+                    self.__calibrate()
+                if progress.state == 'failed':
+                    messagebox.showinfo("Error", "Job stopped.\n" + str(self.runner.error))
+            self.progressive.flush()
+            self.root.after(self.check_interval, self.__check_queue)
 #
 
 
 if __name__=="__main__":
-    multiprocessing.freeze_support()
+    #Only frozen Windows builds need it, skip importing multiprocessing otherwise
+    if getattr(sys, 'frozen', False):
+        import multiprocessing
+        multiprocessing.freeze_support()
     root = tkinter.Tk()
     x = Window(root)
     x.pack()